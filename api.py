@@ -0,0 +1,314 @@
+import json
+from functools import wraps
+from flask import Blueprint, Response, current_app, request, session, stream_with_context
+from common import transaction_group, highlight_html
+import export
+import importing
+from querylog import query_budget
+from sharding import ShardMoving
+from models.todo import Todo
+from models.todolist import TodoList
+from models.users import User
+
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+# maximum number of operations in one batch request
+MAX_BATCH_SIZE = 500
+MAX_PAGE_SIZE = 500
+MAX_SEARCH_RESULTS = 100
+# maximum number of rows of one import request and the smallest chunk of rows saved in one transaction
+MAX_IMPORT_ROWS = 100000
+MIN_IMPORT_CHUNK = 100
+# todo fields which can be changed by update operation
+UPDATABLE_FIELDS = ('name', 'priority', 'due_date', 'description', 'status', 'is_archived')
+
+
+class ApiError(Exception):
+    """Error returned to API client as JSON with given HTTP status"""
+    def __init__(self, message, status=400, **details):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+        self.details = details
+
+
+def json_response(data, status=200):
+    """JSON without whitespace"""
+    return Response(json.dumps(data, separators=(',', ':'), ensure_ascii=False), status=status,
+                    mimetype='application/json')
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    body = {'error': error.message}
+    body.update(error.details)
+    return json_response(body, error.status)
+
+
+@api.errorhandler(ShardMoving)
+def shard_moving(error):
+    response = json_response({'error': 'Data is being moved, retry in a few seconds'}, 503)
+    response.headers['Retry-After'] = str(int(current_app.config['SHARD_MOVE_GRACE']) or 1)
+    return response
+
+
+def api_login_required(f):
+    @wraps(f)
+    def wrap(*args, **kwargs):
+        if 'logged_in' not in session:
+            raise ApiError('Authentication required', 401)
+        return f(*args, **kwargs)
+    return wrap
+
+
+def requested_fields():
+    """returns todo fields chosen with 'fields' argument, all fields if it is missing"""
+    fields = request.args.get('fields')
+    if not fields:
+        return Todo.FIELDS
+    fields = tuple(field.strip() for field in fields.split(','))
+    unknown = [field for field in fields if field not in Todo.FIELDS]
+    if unknown:
+        raise ApiError('Unknown fields: {}'.format(', '.join(unknown)))
+    return fields
+
+
+def todos_response(todos, fields, **extra):
+    """ Serializes todos as list of objects or, with format=compact argument,
+    as one list of field names and list of value rows.
+    """
+    if request.args.get('format') == 'compact':
+        body = {'fields': fields, 'rows': [[getattr(todo, field) for field in fields] for todo in todos]}
+    else:
+        body = {'items': [todo.to_dict(fields) for todo in todos]}
+    body.update(extra)
+    return json_response(body)
+
+
+def get_owned_todo(todo_id):
+    todo = Todo.get_by_id(todo_id)
+    if not todo or (todo.owner_id != session['user_id'] and not session.get('is_admin')):
+        raise ApiError('No such todo item', 404, id=todo_id)
+    return todo
+
+
+@api.route('/todos')
+@api_login_required
+def list_todos():
+    """ Page of logged user todos.
+    Arguments: archived (0|1), sort (column), desc (0|1), after (id of last todo of previous page),
+    limit, fields (comma separated), format (compact)
+    """
+    sort_column = request.args.get('sort', 'create_date')
+    if sort_column not in Todo.SORT_COLUMNS:
+        raise ApiError('Todos can be sorted by: {}'.format(', '.join(Todo.SORT_COLUMNS)))
+    limit = min(request.args.get('limit', 50, type=int), MAX_PAGE_SIZE)
+    after_id = request.args.get('after', type=int)
+    is_archived = request.args.get('archived', 0, type=int) == 1
+    fields = requested_fields()
+    sort_type = dict((column, sort_type) for sort_type, column in TodoList.SORT_TYPES.items())[sort_column]
+    todo_list = TodoList(User(None, id_=session['user_id']), sort_type,
+                         is_desc=request.args.get('desc', 0, type=int) == 1, page_size=max(limit, 1))
+    todos, has_next = todo_list.get_page(is_archived, after_id)
+    return todos_response(todos, fields, next_after=todos[-1].id if has_next else None)
+
+
+@api.route('/todos/search')
+@api_login_required
+def search_todos():
+    """ Logged user todos matching words of 'q' argument, the last word as prefix (for type-ahead),
+    best matches first.
+    Arguments: q, limit, fields (comma separated)
+    Every item has highlight of name and description fragment as HTML with matched words in <mark>.
+    """
+    limit = min(request.args.get('limit', 10, type=int), MAX_SEARCH_RESULTS)
+    fields = requested_fields()
+    items = []
+    for todo, name, description in Todo.search(session['user_id'], request.args.get('q', ''), max(limit, 1)):
+        item = todo.to_dict(fields)
+        item['highlight'] = {'name': str(highlight_html(name)), 'description': str(highlight_html(description))}
+        items.append(item)
+    return json_response({'items': items})
+
+
+@api.route('/todos/<int:todo_id>')
+@api_login_required
+def get_todo(todo_id):
+    """ Todo with given id, also with old id of todo moved to another shard (it has the current one) """
+    fields = requested_fields()
+    return json_response(get_owned_todo(todo_id).to_dict(fields))
+
+
+@api.route('/todos/batch', methods=['POST'])
+@api_login_required
+@query_budget(MAX_BATCH_SIZE * 4)
+def batch():
+    """ Runs list of operations in one transaction on every database they change, nothing is saved
+    if any of them fails.
+    Body: {"operations": [{"op": "create", "data": {...}},
+                          {"op": "update", "id": 1, "data": {...}},
+                          {"op": "delete", "id": 1}]}
+    Returns ids of created, updated and deleted todos in order of operations, current ones for old ids
+    of todos moved to another shard.
+    """
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        raise ApiError('Body should be JSON object with operations list')
+    if len(operations) > MAX_BATCH_SIZE:
+        raise ApiError('Batch can have at most {} operations'.format(MAX_BATCH_SIZE))
+    results = []
+    with transaction_group() as join:
+        for index, operation in enumerate(operations):
+            try:
+                results.append(run_operation(operation, join))
+            except ApiError as error:
+                error.details['operation'] = index
+                raise
+    return json_response({'results': results})
+
+
+def run_operation(operation, join):
+    """ Runs one batch operation and returns its result.
+    Args:
+        join(function): starts transaction of batch on database of todo owner (common.transaction_group)
+    """
+    if not isinstance(operation, dict):
+        raise ApiError('Operation should be JSON object')
+    op = operation.get('op')
+    data = operation.get('data') or {}
+    if not isinstance(data, dict):
+        raise ApiError('Operation data should be JSON object')
+    if op == 'create':
+        error = Todo.validation_error(data.get('name'), data.get('priority'), data.get('due_date'))
+        if error:
+            raise ApiError(error)
+        todo = Todo(data['name'], priority=int(data['priority']), due_date=data.get('due_date'),
+                    owner_id=session['user_id'], description=data.get('description'))
+        join(todo.owner_id)
+        todo.save()
+        return {'op': op, 'id': todo.id}
+    if op == 'update':
+        todo = get_owned_todo(operation.get('id'))
+        unknown = [field for field in data if field not in UPDATABLE_FIELDS]
+        if unknown:
+            raise ApiError('Fields can not be updated: {}'.format(', '.join(unknown)))
+        for field in ('status', 'is_archived'):
+            # JSON strings like "0" or "false" would be true
+            if field in data and not (isinstance(data[field], bool) or data[field] in (0, 1)):
+                raise ApiError('{} should be true, false, 0 or 1'.format(field))
+        # only changed values are checked, older todos can keep values new ones can't have
+        checked = {'name': todo.name, 'priority': 1, 'due_date': None}
+        checked.update((field, data[field]) for field in list(checked)
+                       if field in data and data[field] != getattr(todo, field))
+        error = Todo.validation_error(**checked)
+        if error:
+            raise ApiError(error)
+        join(todo.owner_id)
+        if 'status' in data and int(bool(data['status'])) != todo.status and not todo.is_archived:
+            todo.toggle()
+        for field in ('name', 'priority', 'due_date', 'description'):
+            if field in data:
+                setattr(todo, field, data[field])
+        if 'is_archived' in data and bool(data['is_archived']) != todo.is_archived:
+            todo.is_archived = bool(data['is_archived'])
+            if not todo.is_archived:
+                todo.status = 0
+            todo.save('archive' if todo.is_archived else 'activate')
+        else:
+            todo.save()
+        return {'op': op, 'id': todo.id}
+    if op == 'delete':
+        todo = get_owned_todo(operation.get('id'))
+        join(todo.owner_id)
+        todo.delete()
+        return {'op': op, 'id': todo.id}
+    raise ApiError('Unknown operation {}'.format(op))
+
+
+@api.route('/todos/import', methods=['POST'])
+@api_login_required
+@query_budget(MAX_IMPORT_ROWS // MIN_IMPORT_CHUNK * 4 + 10)
+def import_todos():
+    """ Creates logged user todos from csv (with header line) or ndjson request body, read as stream.
+    Rows have name, priority, due_date, description and status, checked like in new todo form.
+    Arguments: format (csv|ndjson), chunk_size (todos saved in one transaction)
+    Invalid rows are skipped, returns numbers of imported and failed rows and errors of the first
+    failed ones as {"row": number from 1, "error": ...}.
+    """
+    import_format = request.args.get('format', 'csv')
+    if import_format not in importing.FORMATS:
+        raise ApiError('Import formats: {}'.format(', '.join(importing.FORMATS)))
+    chunk_size = max(request.args.get('chunk_size', current_app.config['IMPORT_CHUNK_SIZE'], type=int),
+                     MIN_IMPORT_CHUNK)
+    report = importing.import_todos(request.stream, import_format, session['user_id'], chunk_size,
+                                    max_rows=MAX_IMPORT_ROWS)
+    return json_response(report)
+
+
+def export_user_id():
+    """id of user whose data is exported: 'user_id' argument for admins, logged user otherwise"""
+    user_id = request.args.get('user_id', session['user_id'], type=int)
+    if user_id != session['user_id']:
+        if not session.get('is_admin'):
+            raise ApiError('Only admins can export data of other users', 403)
+        if not User.get_by_id(user_id):
+            raise ApiError('No such user', 404, id=user_id)
+    return user_id
+
+
+def export_response(name, fields, read_rows):
+    """ Streams rows returned by read_rows(after) as csv or ndjson ('format' argument).
+    Rows are read from database cursor while response is sent, so memory use doesn't depend
+    on number of rows.
+    Export ordered by id is resumed with 'after' argument set to id of the last received row,
+    resumed csv has no header line.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        raise ApiError('Export formats: {}'.format(', '.join(sorted(export.FORMATS))))
+    after = request.args.get('after', 0, type=int)
+    rows = read_rows(after)
+    if export_format == 'csv':
+        lines = export.csv_lines(fields, rows, header=not after)
+    else:
+        lines = export.ndjson_lines(fields, rows)
+    headers = {'Content-Disposition': 'attachment; filename={}.{}'.format(name, export_format)}
+    # compressed chunk by chunk by response compression
+    return Response(stream_with_context(export.encode(lines)), mimetype=export.FORMATS[export_format],
+                    headers=headers)
+
+
+@api.route('/export/todos')
+@api_login_required
+def export_todos():
+    """ All todos of logged user (or of user_id for admins), archived ones too, in order of id.
+    Arguments: format (csv|ndjson), after (id of the last received todo), user_id
+    """
+    user_id = export_user_id()
+    return export_response('todos-{}'.format(user_id), Todo.FIELDS,
+                           lambda after: Todo.iter_export(user_id, after))
+
+
+@api.route('/export/history')
+@api_login_required
+def export_history():
+    """ History of all todos of logged user (or of user_id for admins), in order of id.
+    Arguments: format (csv|ndjson), after (id of the last received event), user_id
+    """
+    user_id = export_user_id()
+    return export_response('todo-history-{}'.format(user_id), Todo.HISTORY_FIELDS,
+                           lambda after: Todo.iter_history_export(user_id, after))
+
+
+@api.route('/users/me')
+@api_login_required
+def current_user():
+    user = User.get_by_id(session['user_id'])
+    return json_response({'id': user.id, 'name': user.name, 'email': user.email,
+                          'registration_date': user.registration_date, 'is_admin': user.is_admin,
+                          'active_todos_count': user.active_todos_count,
+                          'active_todos_done_count': user.active_todos_done_count,
+                          'active_todos_undone_count': user.active_todos_undone_count,
+                          'archived_todos_count': user.archived_todos_count})
@@ -0,0 +1,175 @@
+""" Fingerprinted static assets.
+
+Build step copies every file of static directory to output directory under name with hash of its content
+(css/style.css -> css/style.0123456789ab.css), rewrites url() references in stylesheets to fingerprinted
+names, writes gzip (and brotli, when brotli package is installed) variants of compressible files and
+a manifest.json mapping source paths to built ones. Built files never change, so they are served
+with far-future immutable cache headers; templates get their urls from the manifest.
+
+    FLASK_APP=main.py flask build-assets
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from flask import Blueprint, abort, current_app, request, send_file, url_for
+from werkzeug.security import safe_join
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MANIFEST = 'manifest.json'
+# fonts in woff formats and images are compressed already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ttf', '.eot', '.json', '.txt', '.html', '.map')
+# variants in order of preference: (content coding, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([^'")]*)\1\s*\)''')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def fingerprint(path, content):
+    """returns path with the first 12 characters of sha1 of content before extension"""
+    base, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(base, hashlib.sha1(content).hexdigest()[:12], extension)
+
+
+def rewrite_css_urls(css, path, manifest):
+    """replaces relative urls of built files in stylesheet at path with their fingerprinted urls"""
+    directory = os.path.dirname(path)
+
+    def replace(match):
+        quote, url, suffix = match.groups()
+        target = os.path.normpath(os.path.join(directory, url)).replace(os.sep, '/')
+        if '://' in url or url.startswith(('/', 'data:')) or target not in manifest:
+            return match.group(0)
+        built = os.path.relpath(manifest[target], directory or '.').replace(os.sep, '/')
+        return 'url({0}{1}{2}{0})'.format(quote, built, suffix)
+    return CSS_URL.sub(replace, css)
+
+
+def compress(path):
+    """writes precompressed variants next to built file"""
+    with open(path, 'rb') as source:
+        content = source.read()
+    with open(path + '.gz', 'wb') as target:
+        target.write(gzip.compress(content, 9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as target:
+            target.write(brotli.compress(content))
+
+
+def build(static_dir, output_dir):
+    """ Builds fingerprinted and precompressed copies of all files of static_dir in output_dir
+    (recreated from scratch) and their manifest. Stylesheets are built last, after files they refer to.
+    Returns:
+        dict: built paths by source paths, relative to the directories
+    """
+    sources = []
+    for directory, directories, file_names in os.walk(static_dir):
+        # output directory can be inside static directory
+        directories[:] = [name for name in sorted(directories)
+                          if os.path.abspath(os.path.join(directory, name)) != os.path.abspath(output_dir)]
+        for name in sorted(file_names):
+            sources.append(os.path.relpath(os.path.join(directory, name), static_dir).replace(os.sep, '/'))
+    sources.sort(key=lambda path: path.endswith('.css'))
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), 'rb') as source:
+            content = source.read()
+        if path.endswith('.css'):
+            content = rewrite_css_urls(content.decode('utf-8'), path, manifest).encode('utf-8')
+        manifest[path] = fingerprint(path, content)
+        target = os.path.join(output_dir, manifest[path])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as built:
+            built.write(content)
+        if path.endswith(COMPRESSIBLE):
+            compress(target)
+    with open(os.path.join(output_dir, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    return manifest
+
+
+def accepted_encodings(accept_encoding):
+    """content codings allowed by Accept-Encoding header value"""
+    accepted = set()
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.strip().partition(';')
+        quality = params.replace(' ', '')
+        try:
+            if quality.startswith('q=') and float(quality[2:]) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class Assets:
+    """ Resolves urls of static files through manifest of built assets. Without manifest
+    (assets were not built) files are served by the default static handler.
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.manifest = {}
+        self.version = None
+        self.load()
+
+    def load(self):
+        path = os.path.join(self.output_dir, MANIFEST)
+        if os.path.exists(path):
+            with open(path, 'rb') as manifest_file:
+                content = manifest_file.read()
+            self.manifest = json.loads(content.decode('utf-8'))
+            self.version = hashlib.sha1(content).hexdigest()
+        else:
+            self.manifest = {}
+            self.version = None
+
+    def url(self, path):
+        """url of static file, fingerprinted one if assets are built"""
+        if path in self.manifest:
+            return url_for('assets.built_asset', filename=self.manifest[path])
+        return url_for('static', filename=path)
+
+
+blueprint = Blueprint('assets', __name__, url_prefix='/assets')
+
+
+@blueprint.route('/<path:filename>')
+def built_asset(filename):
+    """ Serves built file, precompressed variant if client accepts it, cached by browsers for a year """
+    assets = current_app.extensions['assets']
+    path = safe_join(assets.output_dir, filename)
+    if path is None or filename.endswith(('.gz', '.br')) or filename == MANIFEST or not os.path.isfile(path):
+        abort(404)
+    accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+    encoding = None
+    for coding, suffix in ENCODINGS:
+        if (coding in accepted or '*' in accepted) and os.path.isfile(path + suffix):
+            encoding = coding
+            path += suffix
+            break
+    response = send_file(path, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                         max_age=IMMUTABLE_MAX_AGE, conditional=True, etag=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    """registers assets handler and asset_url template helper"""
+    assets = app.extensions['assets'] = Assets(os.path.join(app.root_path, app.config['ASSETS_DIR']))
+    app.register_blueprint(blueprint)
+    app.add_template_global(assets.url, 'asset_url')
+    return assets
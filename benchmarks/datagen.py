@@ -0,0 +1,103 @@
+""" Synthetic data for benchmarks: database with schema of the configured one filled with
+seeded, reproducible users, todos, todo history and admin permissions.
+
+    python -m benchmarks.datagen --users 100 --todos 200 --output /tmp/bench.db
+"""
+import argparse
+import datetime
+import random
+import shutil
+import sqlite3
+import migrations
+from config import BaseConfig
+
+
+WORDS = ('buy', 'milk', 'bread', 'call', 'mom', 'write', 'report', 'meeting', 'email', 'invoice', 'pay', 'rent',
+         'garden', 'car', 'service', 'dentist', 'book', 'train', 'tickets', 'review', 'code', 'deploy', 'clean',
+         'kitchen', 'plan', 'trip', 'read', 'paper', 'gym', 'fix', 'bike', 'order', 'gift', 'update', 'budget')
+# cleared before generating, other tables (permission types, events) keep their rows
+DATA_TABLES = ('users', 'users_permissions', 'users_history', 'todo_items', 'todo_history',
+               'user_todo_stats', 'user_data_versions')
+ADMIN_PERMISSION_ID = 1
+HISTORY_EVENTS = (1, 3, 4, 5, 6, 7)
+
+
+def user_name(number):
+    return 'user{}'.format(number)
+
+
+def user_password(number):
+    return 'password{}'.format(number)
+
+
+def sentence(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def generate(path, users=100, todos=100, history=3, admins=1, archived=0.3, seed=1):
+    """ Creates database at path with schema of configured database and generated data.
+    Args:
+        users(int): number of users, named user0, user1... with passwords password0, password1...
+        todos(int): number of todos of every user
+        history(int): number of history events of every todo
+        admins(int): number of users (the first ones) with admin permission
+        archived(float): share of archived todos
+        seed(int): seed of random generator, the same seed gives the same data
+    Returns:
+        dict: ids of generated users, as {'users': [...], 'admins': [...]}
+    """
+    rnd = random.Random(seed)
+    shutil.copy(BaseConfig.DATABASE, path)
+    db = sqlite3.connect(path)
+    migrations.upgrade(db)
+    for table in DATA_TABLES:
+        db.execute("DELETE FROM `{}`;".format(table))
+    db.commit()
+    start = datetime.datetime(2017, 1, 1)
+    user_ids = []
+    for number in range(users):
+        cursor = db.execute("INSERT INTO `users` (`name`, `password`, `email`, `registration_date`) "
+                            "VALUES (?, ?, ?, ?);",
+                            (user_name(number), user_password(number), '{}@example.com'.format(user_name(number)),
+                             (start + datetime.timedelta(minutes=number)).strftime("%Y-%m-%d %H:%M")))
+        user_ids.append(cursor.lastrowid)
+    db.executemany("INSERT INTO `users_permissions` (`user_id`, `permission_id`) VALUES (?, ?);",
+                   [(user_id, ADMIN_PERMISSION_ID) for user_id in user_ids[:admins]])
+    for user_id in user_ids:
+        rows = []
+        for _ in range(todos):
+            created = start + datetime.timedelta(minutes=rnd.randint(0, 525600))
+            is_archived = rnd.random() < archived
+            rows.append((sentence(rnd, rnd.randint(1, 4)), 1 if is_archived else rnd.randint(0, 1),
+                         created.strftime("%Y-%m-%d %H:%M"), user_id, int(is_archived),
+                         (created + datetime.timedelta(days=rnd.randint(1, 60))).strftime("%Y-%m-%d")
+                         if rnd.random() < 0.7 else None,
+                         rnd.randint(1, 5), sentence(rnd, rnd.randint(0, 40)) or None))
+        db.executemany("INSERT INTO `todo_items` (`name`, `status`, `create_date`, `owner_id`, `is_archived`, "
+                       "`due_date`, `priority`, `description`) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows)
+        # ids grow in order of inserted rows
+        item_ids = [row[0] for row in db.execute("SELECT `id` FROM `todo_items` WHERE `owner_id` = ? ORDER BY `id`;",
+                                                 (user_id, ))]
+        events = [(item_id, '{} 12:00'.format(row[2][:10]), rnd.choice(HISTORY_EVENTS), user_id)
+                  for item_id, row in zip(item_ids, rows) for _ in range(history)]
+        db.executemany("INSERT INTO `todo_history` (`item_id`, `change_date`, `event_id`, `owner_id`) "
+                       "VALUES (?, ?, ?, ?);", events)
+        db.commit()
+    db.close()
+    return {'users': user_ids, 'admins': user_ids[:admins]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', required=True, help='path of created database')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--todos', type=int, default=100, help='todos of every user')
+    parser.add_argument('--history', type=int, default=3, help='history events of every todo')
+    parser.add_argument('--admins', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    generate(args.output, args.users, args.todos, args.history, args.admins, seed=args.seed)
+    print('{} users with {} todos each written to {}'.format(args.users, args.todos, args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+""" Latency and throughput of the key routes, measured in process with Flask test client
+on a generated database.
+
+Every route is requested --requests times by randomly chosen generated users (admin panel by admins),
+by --concurrency threads at once. Throughput is the number of requests finished per second of wall
+clock time of the route, so it shows how requests of concurrent users wait for each other (locks of
+the database, the GIL), which latency of sequential requests doesn't. Results are printed, saved as JSON with --output and compared with a saved run with --baseline:
+the benchmark fails (exit status 1) when p95 latency of a route grew or its throughput dropped
+by more than --threshold (throughput only of runs with the same concurrency).
+
+    python -m benchmarks.routes --users 50 --todos 200 --output results.json
+    python -m benchmarks.routes --users 50 --todos 200 --baseline results.json --threshold 0.2
+    python -m benchmarks.routes --concurrency 8 --output results-8.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import datagen
+from config import BaseConfig
+
+
+SORT_TYPES = ('priority', 'name', 'due date', 'create date', 'status')
+
+
+def percentile(values, share):
+    """value below which given share of sorted values lies (nearest rank)"""
+    if not values:
+        return 0.0
+    index = max(0, int(round(share * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(durations, errors, wall, concurrency=1):
+    """ returns statistics of route from list of request durations and wall clock time of all of them
+    (run by concurrency threads) in seconds
+    """
+    durations = sorted(durations)
+    total = sum(durations)
+    return {'requests': len(durations),
+            'errors': errors,
+            'concurrency': concurrency,
+            'mean_ms': total / len(durations) * 1000 if durations else 0.0,
+            'p50_ms': percentile(durations, 0.50) * 1000,
+            'p95_ms': percentile(durations, 0.95) * 1000,
+            'p99_ms': percentile(durations, 0.99) * 1000,
+            'throughput_rps': len(durations) / wall if wall else 0.0}
+
+
+class RouteBenchmark:
+    """ Runs requests of key routes against application using generated database.
+    Every request is built by a function of index of generated user returning
+    (expected status, method, url, form data).
+    """
+    def __init__(self, app, users, admins, todo_ids, seed=1):
+        self.app = app
+        self.users = users
+        self.admins = admins
+        self.todo_ids = todo_ids
+        self.rnd = random.Random(seed)
+        self.routes = [
+            ('login', False, self.login),
+            ('td_list GET', True, lambda user: (200, 'GET', '/', None)),
+            ('td_list POST sort', True, lambda user: (200, 'POST', '/', {'sort': self.rnd.choice(SORT_TYPES)})),
+            ('add', True, self.add),
+            ('toggle', True, lambda user: (302, 'GET', '/todo/{}/toggle'.format(self.todo_of(user)), None)),
+            ('archive', True, lambda user: (302, 'GET', '/todo/{}/archive'.format(self.todo_of(user)), None)),
+            ('admin_panel', True, lambda user: (200, 'GET', '/admin', None)),
+            ('show_user', True, lambda user: (200, 'GET', '/users/{}'.format(self.users[user]), None)),
+        ]
+
+    def todo_of(self, user):
+        return self.rnd.choice(self.todo_ids[self.users[user]])
+
+    def login(self, user):
+        return 302, 'POST', '/login', {'username': datagen.user_name(user), 'password': datagen.user_password(user)}
+
+    def add(self, user):
+        return 302, 'POST', '/todo/new', {'item_name': datagen.sentence(self.rnd, 3), 'priority': '3',
+                                          'due_date': '', 'description': datagen.sentence(self.rnd, 10)}
+
+    def client(self, user, logged_in):
+        client = self.app.test_client()
+        if logged_in:
+            with client.session_transaction() as session:
+                session['logged_in'] = True
+                session['user_id'] = self.users[user]
+                session['user_name'] = datagen.user_name(user)
+                session['is_admin'] = True if self.users[user] in self.admins else None
+                session['sort_type'] = 'create date'
+                session['sort_direct'] = 'desc'
+        return client
+
+    def request(self, name, logged_in, build):
+        """ Runs one request of route, returns its duration and whether it had expected status.
+        Every request has its own client, so no flashed messages are left from previous ones.
+        """
+        if name == 'admin_panel':
+            user = self.users.index(self.rnd.choice(self.admins))
+        else:
+            user = self.rnd.randrange(len(self.users))
+        client = self.client(user, logged_in)
+        status, method, url, data = build(user)
+        started = time.perf_counter()
+        try:
+            ok = client.open(url, method=method, data=data).status_code == status
+        except Exception as error:
+            # errors propagate in debug mode (like going over query budget)
+            print('{} {}: {!r}'.format(method, url, error), file=sys.stderr)
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def run(self, requests, warmup=5, concurrency=1):
+        """ Runs requests of every route by concurrency threads, the first warmup ones are run one by one
+        and not measured.
+        Returns:
+            dict: statistics of routes by name
+        """
+        results = {}
+        with ThreadPoolExecutor(concurrency) as executor:
+            for name, logged_in, build in self.routes:
+                for number in range(warmup):
+                    self.request(name, logged_in, build)
+                started = time.perf_counter()
+                outcomes = list(executor.map(lambda number: self.request(name, logged_in, build), range(requests)))
+                wall = time.perf_counter() - started
+                results[name] = summarize([duration for duration, ok in outcomes],
+                                          sum(1 for duration, ok in outcomes if not ok), wall, concurrency)
+        return results
+
+
+def compare(results, baseline, threshold):
+    """ Compares routes statistics with baseline ones.
+    Returns:
+        list(str): descriptions of regressions: more errors, p95 latency or throughput worse by more
+        than threshold; throughput is compared only with baseline run with the same concurrency
+    """
+    regressions = []
+    for name, stats in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if stats['errors'] > base['errors']:
+            regressions.append('{}: {} errors, baseline {}'.format(name, stats['errors'], base['errors']))
+        if stats['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append('{}: p95 {:.2f} ms, baseline {:.2f} ms'.format(name, stats['p95_ms'], base['p95_ms']))
+        if base.get('concurrency') == stats['concurrency'] and \
+                stats['throughput_rps'] < base['throughput_rps'] * (1 - threshold):
+            regressions.append('{}: throughput {:.1f} req/s, baseline {:.1f} req/s'.format(
+                name, stats['throughput_rps'], base['throughput_rps']))
+    return regressions
+
+
+def print_results(results):
+    print('{:<20} {:>8} {:>7} {:>9} {:>9} {:>9} {:>10}'.format('route', 'requests', 'errors', 'p50 ms', 'p95 ms',
+                                                                'p99 ms', 'req/s'))
+    for name, stats in results.items():
+        print('{:<20} {:>8} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f}'.format(
+            name, stats['requests'], stats['errors'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['throughput_rps']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--todos', type=int, default=200, help='todos of every user')
+    parser.add_argument('--history', type=int, default=3, help='history events of every todo')
+    parser.add_argument('--admins', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests of every route')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1, help='threads sending requests at once')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--baseline', help='compare with results saved before')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'todo.db')
+        generated = datagen.generate(path, args.users, args.todos, args.history, args.admins, seed=args.seed)
+        # application modules read database path when imported
+        BaseConfig.DATABASE = path
+        import main as application
+        with application.app.app_context():
+            todo_ids = {}
+            for item_id, owner_id in application.get_db().execute(
+                    "SELECT `id`, `owner_id` FROM `todo_items` WHERE `is_archived` = 0;"):
+                todo_ids.setdefault(owner_id, []).append(item_id)
+        benchmark = RouteBenchmark(application.app, generated['users'], generated['admins'], todo_ids, args.seed)
+        results = benchmark.run(args.requests, args.warmup, max(args.concurrency, 1))
+        application.history_writer.stop()
+        application.DB.get_pool(path).close()
+    finally:
+        shutil.rmtree(directory)
+
+    print_results(results)
+    report = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+              'python': platform.python_version(),
+              'options': vars(args),
+              'routes': results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['routes']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regressions over {:.0%}'.format(args.threshold))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+""" Memory used by todo lists of one user with many todos.
+
+Compares todos with per instance __dict__ (how Todo was built before), slotted todos,
+list projection without description and iteration over todos without keeping the list.
+
+    python -m benchmarks.todo_memory --rows 100000
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from flask import Flask
+import migrations
+from common import get_db
+from config import BaseConfig
+from dbhandle import DB
+from models.todo import Todo
+
+
+class DictTodo(object):
+    """todo with attributes kept in __dict__, like Todo before it got __slots__"""
+    def __init__(self, *args):
+        Todo.__init__(self, *args)
+
+
+def create_database(path, rows, description_length):
+    """creates database with schema of configured database and rows todos of one user"""
+    shutil.copy(BaseConfig.DATABASE, path)
+    db = sqlite3.connect(path)
+    migrations.upgrade(db)
+    db.execute("DELETE FROM `todo_items`;")
+    description = 'x' * description_length
+    values = (('todo {}'.format(i), i % 2, '2017-03-{:02d} 12:00'.format(i % 28 + 1), 1, 0,
+               '2017-04-{:02d}'.format(i % 28 + 1), i % 5 + 1, description) for i in range(rows))
+    db.executemany("INSERT INTO `todo_items` (`name`, `status`, `create_date`, `owner_id`, `is_archived`, "
+                   "`due_date`, `priority`, `description`) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", values)
+    db.commit()
+    db.close()
+
+
+def measure(load):
+    """returns peak of memory allocated while load runs (in bytes) and its time (in seconds)"""
+    tracemalloc.start()
+    started = time.time()
+    result = load()
+    elapsed = time.time() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak, elapsed
+
+
+def consume(todos):
+    count = 0
+    for _ in todos:
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--description-length', type=int, default=300)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'todo.db')
+    create_database(path, args.rows, args.description_length)
+    BaseConfig.DATABASE = path
+    query = "SELECT `name`, `id`, `status`, `create_date`, `priority`, `due_date`, `owner_id`, " \
+            "`is_archived`, `description` FROM `todo_items` WHERE `is_archived` = ? AND `owner_id` = ? " \
+            "ORDER BY create_date DESC;"
+    cases = [
+        ('dict todos, full rows',
+         lambda: [DictTodo(*row) for row in DB.execute_select_query(get_db(), query, (0, 1))]),
+        ('slotted todos, full rows', lambda: Todo.get_all(1)),
+        ('slotted todos, list projection', lambda: Todo.get_all(1, with_description=False)),
+        ('iterated todos, list projection', lambda: consume(Todo.iter_all(1, with_description=False))),
+    ]
+    app = Flask(__name__)
+    try:
+        with app.app_context():
+            print('{} todos'.format(args.rows))
+            baseline = None
+            for name, load in cases:
+                peak, elapsed = measure(load)
+                baseline = baseline or peak
+                print('{:<34} {:>9.1f} MiB  {:>6.0f} B/todo  {:>5.1f}x less  {:>6.2f}s'.format(
+                    name, peak / 1048576.0, float(peak) / args.rows, float(baseline) / peak, elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import importlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """ Thread safe, size bounded cache of one process.
+    Least recently used entry is evicted when cache is full, entries older than ttl seconds
+    are treated as missing (no expiry if ttl is None).
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """returns value stored for key or default if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored = entry
+                if self.ttl is None or time.time() - stored < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """returns usage counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'backend': 'process',
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class SharedCache:
+    """ Cache kept in store shared by all processes (like memcached or redis), used through
+    client object with get(key) and set(key, value) methods. Keys are hashed to prefixed strings.
+    Store errors are logged and treated as cache misses, so pages work without the store.
+    """
+    def __init__(self, client, prefix=''):
+        self.client = client
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key):
+        return self.prefix + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key, default=None):
+        try:
+            value = self.client.get(self._key(key))
+        except Exception:
+            logger.warning("Reading from shared cache failed", exc_info=True)
+            value = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        try:
+            self.client.set(self._key(key), value)
+        except Exception:
+            logger.warning("Writing to shared cache failed", exc_info=True)
+            with self._lock:
+                self.errors += 1
+
+    def delete(self, key):
+        try:
+            self.client.delete(self._key(key))
+        except Exception:
+            logger.warning("Deleting from shared cache failed", exc_info=True)
+
+    def stats(self):
+        """returns usage counters of this process"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'backend': 'shared',
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'errors': self.errors,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+def make_cache(maxsize=1024, ttl=None, client=None, prefix=''):
+    """ Creates process local LRUCache or, when client is given, SharedCache using it.
+    Args:
+        client: shared store client or its import path as 'module:attribute'
+        prefix(str): prefix of keys in shared store
+    """
+    if client is None:
+        return LRUCache(maxsize, ttl)
+    if isinstance(client, str):
+        module_name, _, attribute = client.partition(':')
+        client = getattr(importlib.import_module(module_name), attribute)
+    return SharedCache(client, prefix)
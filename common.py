@@ -1,7 +1,16 @@
-from flask import flash, url_for, redirect, session, g
+from flask import flash, url_for, redirect, session, g, has_request_context
+from markupsafe import Markup, escape
 from functools import wraps
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 from dbhandle import DB
 from config import BaseConfig
+from sharding import shard_map
+
+
+# control characters wrapping matched words in search results, they never appear in typed text
+MATCH_START = '\x02'
+MATCH_END = '\x03'
 
 
 # login required decorator
@@ -27,8 +36,154 @@ def admin_only(f):
     return wrap
 
 
-def get_db():
-    db = getattr(g, '_database', None)
-    if not db:
-        db = g._database = DB.connect(BaseConfig.DATABASE)
+def db_pool_options():
+    return dict(size=BaseConfig.DB_POOL_SIZE, timeout=BaseConfig.DB_POOL_TIMEOUT,
+                cached_statements=BaseConfig.DB_CACHED_STATEMENTS, pragmas=BaseConfig.DB_PRAGMAS)
+
+
+def connection(database):
+    """connection of current context to database file, taken from pool on first use"""
+    databases = g.setdefault('_databases', {})
+    db = databases.get(database)
+    if db is None:
+        db = databases[database] = DB.acquire(database, **db_pool_options())
+        if has_request_context():
+            # all writes of request are committed together by commit_db
+            DB.begin_unit(db)
     return db
+
+
+def get_db(owner_id=None, for_write=False):
+    """ Returns connection of current context to the main database (users), or with owner_id
+    to database with todos and todo history of that user (see sharding).
+    Args:
+        for_write(bool): user data will be changed, raises ShardMoving while it is moved to another shard
+    """
+    db = connection(shard_map.catalog)
+    if owner_id is None:
+        return db
+    return connection(shard_map.database_for(db, owner_id, for_write))
+
+
+def get_db_of_id(row_id):
+    """connection to database with todo (or todo history row) of given id, None for id of unknown shard"""
+    database = shard_map.database_of_id(row_id)
+    return connection(database) if database is not None else None
+
+
+def fan_out(function, databases=None):
+    """ Runs function(database, db) for every database (all of them by default) with its own
+    pooled connection, in parallel by thread pool when there are more databases. A single database
+    is queried at once with connection of current context.
+    Returns:
+        list: results in order of databases
+    """
+    databases = list(shard_map.databases() if databases is None else databases)
+    if len(databases) == 1:
+        return [function(databases[0], connection(databases[0]))]
+
+    def run(database):
+        db = DB.acquire(database, **db_pool_options())
+        try:
+            return function(database, db)
+        finally:
+            DB.release(database, db)
+    with ThreadPoolExecutor(min(len(databases), BaseConfig.SHARD_FAN_OUT_THREADS) or 1) as executor:
+        return list(executor.map(run, databases))
+
+
+def commit_db():
+    """ Commits unit of work of current request and runs callbacks registered by after_commit.
+    Every database commits on its own, the main one last.
+    """
+    databases = g.get('_databases', {})
+    for database in sorted(databases, key=lambda database: database == shard_map.catalog):
+        if DB.in_unit(databases[database]):
+            DB.end_unit(databases[database])
+    for callback in g.pop('_after_commit', []):
+        callback()
+
+
+def after_commit(callback, once=False):
+    """ Runs callback when current request is committed, at once outside of request.
+    Args:
+        once(bool): callback equal to one registered already in current request isn't added again
+    """
+    if has_request_context():
+        callbacks = g.setdefault('_after_commit', [])
+        if not once or callback not in callbacks:
+            callbacks.append(callback)
+    else:
+        callback()
+
+
+@contextmanager
+def transaction(owner_id=None):
+    """ DB.transaction on connection of current context, to database of owner's data if it is given.
+    When the block is rolled back and the exception is handled, callbacks it registered
+    by after_commit are dropped too.
+    """
+    callbacks = len(g.get('_after_commit', [])) if has_request_context() else 0
+    try:
+        with DB.transaction(get_db(owner_id, for_write=owner_id is not None)) as db:
+            yield db
+    except BaseException:
+        if has_request_context():
+            del g.get('_after_commit', [])[callbacks:]
+        raise
+
+
+@contextmanager
+def transaction_group():
+    """ Transactions on databases of several owners which end together. The block gets function
+    join(owner_id) starting transaction on database of owner's data, unless it was started already.
+    When the block raises, all of them are rolled back and their after_commit callbacks are dropped.
+    """
+    callbacks = len(g.get('_after_commit', [])) if has_request_context() else 0
+    try:
+        with ExitStack() as transactions:
+            started = set()
+
+            def join(owner_id):
+                db = get_db(owner_id, for_write=True)
+                if id(db) not in started:
+                    transactions.enter_context(DB.transaction(db))
+                    started.add(id(db))
+                return db
+            yield join
+    except BaseException:
+        if has_request_context():
+            del g.get('_after_commit', [])[callbacks:]
+        raise
+
+
+@contextmanager
+def separate_unit():
+    """ Runs block in unit of work of its own, with its own connections, committed (with its after_commit
+    callbacks) when the block ends and rolled back when it raises, apart from unit of current request.
+    Databases the request has changed already are locked until it ends, the block must not write to them.
+    """
+    outer = g.pop('_databases', {}), g.pop('_after_commit', [])
+    try:
+        yield
+        commit_db()
+    finally:
+        try:
+            release_db()
+        finally:
+            g._databases, g._after_commit = outer
+
+
+def release_db(exception=None):
+    """gives connections used in current context back to pool, uncommitted writes are rolled back"""
+    databases = g.pop('_databases', {})
+    for database, db in databases.items():
+        try:
+            DB.end_unit(db, commit=False)
+        finally:
+            DB.release(database, db)
+
+
+def highlight_html(text):
+    """escapes search result text and marks matched words with <mark> tag"""
+    return escape(text or '').replace(MATCH_START, Markup('<mark>')).replace(MATCH_END, Markup('</mark>'))
@@ -0,0 +1,144 @@
+""" Compression of dynamic responses (rendered pages, JSON) with gzip, or brotli when brotli package
+is installed and client prefers it. Responses smaller than minimum size or of other content types
+are sent as they are; streamed responses are compressed chunk by chunk.
+Compression ratio and CPU time are counted per endpoint and shown in admin metrics.
+"""
+import threading
+import time
+import zlib
+from flask import request
+from assets import accepted_encodings
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressionStats:
+    """Bytes before and after compression and CPU time spent on it, per endpoint"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, encoding, size, compressed_size, cpu_time):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {'responses': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                                          'cpu_seconds': 0.0, 'encodings': {}})
+            stats['responses'] += 1
+            stats['bytes_in'] += size
+            stats['bytes_out'] += compressed_size
+            stats['cpu_seconds'] += cpu_time
+            stats['encodings'][encoding] = stats['encodings'].get(encoding, 0) + 1
+
+    def stats(self):
+        """returns counters by endpoint with compression ratio (compressed / original size)"""
+        with self._lock:
+            result = {}
+            for endpoint, stats in self._endpoints.items():
+                result[endpoint] = dict(stats, encodings=dict(stats['encodings']),
+                                        ratio=stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else None)
+            return result
+
+
+class Compressor:
+    """compressor of one response in chosen content coding, used like zlib compressobj"""
+    def __init__(self, encoding, level, brotli_quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=brotli_quality)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data, flush=False):
+        """compresses chunk of data, with flush everything so far can be decompressed by client"""
+        if self.encoding == 'br':
+            return self._compressor.process(data) + (self._compressor.flush() if flush else b'')
+        return self._compressor.compress(data) + (self._compressor.flush(zlib.Z_SYNC_FLUSH) if flush else b'')
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class Compression:
+    """ Compresses responses of application in after request hook.
+    Options are read from application config: COMPRESS_LEVEL (gzip 1-9), COMPRESS_BROTLI_QUALITY (0-11),
+    COMPRESS_MIN_SIZE (bytes) and COMPRESS_MIMETYPES.
+    """
+    def __init__(self, app=None):
+        self.stats = CompressionStats()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.level = app.config['COMPRESS_LEVEL']
+        self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.mimetypes = set(app.config['COMPRESS_MIMETYPES'])
+        app.after_request(self.after_request)
+        app.extensions['compression'] = self
+
+    def choose_encoding(self):
+        """content coding for current request: br if accepted and available, else gzip, None if none is"""
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted or '*' in accepted:
+            return 'gzip'
+        return None
+
+    def after_request(self, response):
+        if response.mimetype not in self.mimetypes:
+            return response
+        if ('Content-Encoding' in response.headers or response.direct_passthrough
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code < 200 or response.status_code in (204, 206, 304) or request.method == 'HEAD':
+            return response
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = self.compress_stream(response.response, encoding, request.endpoint)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            started = time.thread_time()
+            compressor = Compressor(encoding, self.level, self.brotli_quality)
+            compressed = compressor.compress(data) + compressor.finish()
+            self.stats.record(request.endpoint, encoding, len(data), len(compressed), time.thread_time() - started)
+            response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        # compressed body is a different representation, its validator can be weak only
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compress_stream(self, chunks, encoding, endpoint):
+        """compresses streamed response chunk by chunk, every chunk is flushed to client at once"""
+        compressor = Compressor(encoding, self.level, self.brotli_quality)
+        size = compressed_size = 0
+        cpu_time = 0.0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                started = time.thread_time()
+                data = compressor.compress(chunk, flush=True)
+                cpu_time += time.thread_time() - started
+                size += len(chunk)
+                compressed_size += len(data)
+                if data:
+                    yield data
+            data = compressor.finish()
+            compressed_size += len(data)
+            yield data
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.stats.record(endpoint, encoding, size, compressed_size, cpu_time)
@@ -1,13 +1,184 @@
+import binascii
+import json
+import logging
 import os
+import tempfile
+import time
+
+
+logger = logging.getLogger(__name__)
 
 # default config
 
 
 class BaseConfig(object):
     DEBUG = True
-    SECRET_KEY = os.urandom(24)
+    # sessions signed with key shared by all processes: SECRET_KEY if set, otherwise key kept in
+    # SECRET_KEY_FILE (created on first start)
+    SECRET_KEY = None
+    SECRET_KEY_FILE = 'data/secret_key'
     DATABASE = 'data/todo.db'
+    # apply pending schema migrations when the application starts
+    AUTO_MIGRATE = True
+    # connection pool: connections per database file and seconds to wait for a free one
+    DB_POOL_SIZE = 5
+    DB_POOL_TIMEOUT = 10
+    DB_CACHED_STATEMENTS = 256
+    # applied once to every new connection
+    DB_PRAGMAS = (('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('cache_size', -16000),  # in KiB
+                  ('mmap_size', 268435456),
+                  ('temp_store', 'MEMORY'))
+    # todo history events are written in batches by background thread,
+    # synchronous mode writes them at once (useful in tests)
+    HISTORY_BATCH_SIZE = 500
+    HISTORY_FLUSH_INTERVAL = 2.0
+    HISTORY_SYNCHRONOUS = False
+    # users cached in each process: maximum number of cache entries and their lifetime in seconds
+    USER_CACHE_SIZE = 3000
+    USER_CACHE_TTL = 60
+    # rendered todo list items: maximum number of fragments cached in each process, or
+    # import path ('module:attribute') of shared store client with get/set methods used instead
+    FRAGMENT_CACHE_SIZE = 5000
+    FRAGMENT_CACHE_CLIENT = None
+    # queries taking longer (in seconds) are logged as slow
+    SLOW_QUERY_THRESHOLD = 0.1
+    # maximum number of queries of one request (views can set their own with querylog.query_budget),
+    # requests over budget are logged, in testing mode or with QUERY_BUDGET_STRICT the query over budget
+    # raises QueryBudgetExceeded (the request fails)
+    QUERY_BUDGET = 20
+    QUERY_BUDGET_STRICT = False
+    # compression of responses: gzip level (1-9), brotli quality (0-11, when brotli package is installed),
+    # smaller responses and other content types are not compressed
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 4
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/csv', 'application/json',
+                          'application/javascript', 'application/x-ndjson', 'image/svg+xml')
+    # directory of fingerprinted static files built by `flask build-assets`
+    ASSETS_DIR = 'static/dist'
+    # number of todos loaded at once in todo list view
+    TODOS_PAGE_SIZE = 50
+    # number of users on one page of admin users list
+    USERS_PAGE_SIZE = 50
+    # number of days shown in admin statistics
+    STATS_DAYS = 30
+    # maximum number of todos shown on search page
+    SEARCH_RESULTS = 50
+    # users with more todos are removed at once but their data is deleted by background job,
+    # batch size todos or history rows in one transaction
+    USER_DELETE_SYNC_LIMIT = 2000
+    USER_DELETE_BATCH = 500
+    # imported todos saved in one transaction
+    IMPORT_CHUNK_SIZE = 1000
+    # todo history older than retention (in days) is exported to gzipped csv files in archive directory,
+    # counted in per-todo summaries and deleted, delete batch size rows in one short transaction
+    # followed by a pause (in seconds) letting other writers take the write lock
+    HISTORY_RETENTION_DAYS = 365
+    HISTORY_ARCHIVE_DIR = 'data/history_archive'
+    HISTORY_DELETE_BATCH = 1000
+    HISTORY_DELETE_PAUSE = 0.05
+    # database files with todos and todo history of users (shards), DATABASE keeps users and permissions
+    # (catalog) and todos of users not placed in any shard. New users are placed in shard user id modulo
+    # number of shards; new shards are only appended, index of shard is stored with every user.
+    # Empty: all data in DATABASE
+    SHARDS = ()
+    # seconds user placements are cached in each process, moving user waits more than that
+    # (and history flush interval, and longer than the longest request) before and after the switch
+    SHARD_MAP_TTL = 2
+    SHARD_MOVE_GRACE = 10.0
+    # rows copied or deleted in one transaction when user is moved to another shard
+    SHARD_MOVE_BATCH = 500
+    # threads of admin queries running on all shards at once
+    SHARD_FAN_OUT_THREADS = 8
 
 
 class DevelopConfig(BaseConfig):
     DEBUG = True
+
+
+# environment variables overriding config values are named with this prefix and name of value,
+# like TODO_DATABASE, values of tuples (and of values without default) are JSON
+ENVIRONMENT_PREFIX = 'TODO_'
+# environment variable with path of python file with config values
+CONFIG_FILE_VARIABLE = 'TODO_CONFIG'
+
+
+def parse_value(text, default):
+    """converts environment variable text to type of default value"""
+    if isinstance(default, bool):
+        return text.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(text)
+    if isinstance(default, float):
+        return float(text)
+    if isinstance(default, str):
+        return text
+    if isinstance(default, (tuple, list)):
+        return tuple(tuple(item) if isinstance(item, list) else item for item in json.loads(text))
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def read_secret_key(path, attempts=50):
+    """ Returns secret key stored in file, creates file with new random key if it doesn't exist.
+    Key is written to a temporary file linked under the final name, which fails if another process
+    created it first, so processes starting together end up with the same complete key.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix='.secret_key', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'w') as key_file:
+            key = binascii.hexlify(os.urandom(32)).decode('ascii')
+            key_file.write(key)
+            key_file.flush()
+            os.fsync(key_file.fileno())
+        try:
+            os.link(temp_path, path)
+            return key
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(temp_path)
+    # file created by older version can be seen before the key is written
+    for attempt in range(attempts):
+        with open(path) as key_file:
+            key = key_file.read().strip()
+        if key:
+            return key
+        time.sleep(0.1)
+    raise OSError('Secret key file {} is empty'.format(path))
+
+
+def configure(config=BaseConfig, environ=os.environ):
+    """ Overrides config values with upper case names from python file named by TODO_CONFIG variable
+    and then with TODO_<NAME> environment variables, and sets secret key.
+    Application modules read config when they are imported, so it is called before (by importing this module).
+    """
+    path = environ.get(CONFIG_FILE_VARIABLE)
+    if path:
+        values = {'__file__': path}
+        with open(path) as config_file:
+            exec(compile(config_file.read(), path, 'exec'), values)
+        for name, value in values.items():
+            if name.isupper():
+                setattr(config, name, value)
+    for variable, text in environ.items():
+        name = variable[len(ENVIRONMENT_PREFIX):]
+        if variable.startswith(ENVIRONMENT_PREFIX) and variable != CONFIG_FILE_VARIABLE and name.isupper():
+            setattr(config, name, parse_value(text, getattr(config, name, None)))
+    if not config.SECRET_KEY:
+        try:
+            config.SECRET_KEY = read_secret_key(config.SECRET_KEY_FILE)
+        except OSError:
+            logger.warning("Secret key file %s can't be used, sessions are valid in this process only",
+                           config.SECRET_KEY_FILE)
+            config.SECRET_KEY = os.urandom(24)
+
+
+configure()
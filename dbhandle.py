@@ -1,8 +1,147 @@
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection became free in time"""
+
+
+class ConnectionPool:
+    """ Pool of configured sqlite connections to one database file.
+    Thread gets back connection it used last time if it is free, so its page and
+    statement caches stay warm.
+    """
+    def __init__(self, db_name, size=5, timeout=10, cached_statements=256, pragmas=()):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+        self._idle = []
+        self._opened = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+
+    def _open(self):
+        db = sqlite3.connect(self.db_name, cached_statements=self.cached_statements, check_same_thread=False)
+        for name, value in self.pragmas:
+            db.execute("PRAGMA {} = {};".format(name, value))
+        return db
+
+    @staticmethod
+    def _is_healthy(db):
+        try:
+            db.execute("SELECT 1;").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def checkout(self):
+        """Returns free connection, opens new one if pool is not full or waits for released one"""
+        started = time.time()
+        waited = False
+        with self._condition:
+            while True:
+                db = self._take_idle()
+                if db is not None:
+                    break
+                if self._opened < self.size:
+                    self._opened += 1
+                    db = None
+                    break
+                remaining = self.timeout - (time.time() - started)
+                if remaining <= 0:
+                    raise PoolTimeoutError("No free connection to {} after {}s".format(self.db_name, self.timeout))
+                waited = True
+                self._condition.wait(remaining)
+            self.checkouts += 1
+            if waited:
+                wait_time = time.time() - started
+                self.waits += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+        if db is not None and not self._is_healthy(db):
+            self._discard(db)
+            self.reconnects += 1
+            db = None
+        if db is None:
+            try:
+                db = self._open()
+            except Exception:
+                with self._condition:
+                    self._opened -= 1
+                    self._condition.notify()
+                raise
+        self._local.db = db
+        return db
+
+    def _take_idle(self):
+        last = getattr(self._local, 'db', None)
+        if last is not None and last in self._idle:
+            self._idle.remove(last)
+            return last
+        return self._idle.pop() if self._idle else None
+
+    def _discard(self, db):
+        try:
+            db.close()
+        except sqlite3.Error:
+            pass
+
+    def checkin(self, db):
+        """Gives connection back to pool, unfinished transaction is rolled back"""
+        DB.scopes.pop(id(db), None)
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            self._discard(db)
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            return
+        with self._condition:
+            self._idle.append(db)
+            self._condition.notify()
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._condition:
+            for db in self._idle:
+                self._discard(db)
+            self._opened -= len(self._idle)
+            self._idle = []
+
+    def stats(self):
+        """returns pool usage counters"""
+        with self._condition:
+            return {'database': self.db_name,
+                    'size': self.size,
+                    'opened': self._opened,
+                    'idle': len(self._idle),
+                    'checkouts': self.checkouts,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'max_wait_time': self.max_wait_time,
+                    'reconnects': self.reconnects}
 
 
 class DB:
 
+    pools = {}
+    _pools_lock = threading.Lock()
+    # number of open transaction scopes (unit of work and savepoints) for id of connection
+    scopes = {}
+    query_hooks = []
+
     @classmethod
     def connect(cls, db_name):
         """Connect with database"""
@@ -12,34 +151,200 @@ class DB:
     def close(cls, db):
         db.close()
 
+    @classmethod
+    def get_pool(cls, db_name, **options):
+        """Returns connection pool for database, creates it with given options on first use"""
+        pool = cls.pools.get(db_name)
+        if pool is None:
+            with cls._pools_lock:
+                pool = cls.pools.get(db_name)
+                if pool is None:
+                    pool = cls.pools[db_name] = ConnectionPool(db_name, **options)
+        return pool
+
+    @classmethod
+    def forget_pools(cls):
+        """ Drops pools inherited by forked process without using their connections (sqlite connection
+        must not be used across fork), new ones are opened on first use in the child.
+        """
+        cls.pools = {}
+        cls._pools_lock = threading.Lock()
+        cls.scopes = {}
+
+    @classmethod
+    def acquire(cls, db_name, **options):
+        """Takes connection with database from pool"""
+        return cls.get_pool(db_name, **options).checkout()
+
+    @classmethod
+    def release(cls, db_name, db):
+        """Gives connection taken by acquire back to pool"""
+        cls.pools[db_name].checkin(db)
+
+    @classmethod
+    def pool_stats(cls):
+        return [pool.stats() for pool in cls.pools.values()]
+
+    @classmethod
+    def begin_unit(cls, db):
+        """ Starts unit of work on connection: writes are not committed one by one
+        but together by end_unit. Transaction is opened lazily by the first write,
+        so read only units never take the write lock.
+        """
+        cls.scopes[id(db)] = 1
+
+    @classmethod
+    def end_unit(cls, db, commit=True):
+        """Commits (or rolls back) all writes made in unit of work and ends it"""
+        try:
+            if db.in_transaction:
+                db.commit() if commit else db.rollback()
+        finally:
+            cls.scopes.pop(id(db), None)
+
+    @classmethod
+    def in_unit(cls, db):
+        return bool(cls.scopes.get(id(db)))
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, db):
+        """ Makes all queries executed inside with block atomic.
+        Inside unit of work (or other transaction) it uses savepoint, so only
+        this block is rolled back on exception, otherwise it commits at the end.
+        """
+        depth = cls.scopes.get(id(db), 0)
+        cls._begin_write(db)
+        savepoint = 'scope_{}'.format(depth)
+        if depth:
+            db.execute("SAVEPOINT {};".format(savepoint))
+        cls.scopes[id(db)] = depth + 1
+        try:
+            yield db
+        except BaseException:
+            if depth:
+                db.execute("ROLLBACK TO {};".format(savepoint))
+                db.execute("RELEASE {};".format(savepoint))
+            else:
+                db.rollback()
+            raise
+        else:
+            if depth:
+                db.execute("RELEASE {};".format(savepoint))
+            else:
+                db.commit()
+        finally:
+            if depth:
+                cls.scopes[id(db)] = depth
+            else:
+                cls.scopes.pop(id(db), None)
+
+    @classmethod
+    def _begin_write(cls, db):
+        """takes write lock at once, so transaction never has to upgrade its read snapshot"""
+        if not db.in_transaction:
+            db.execute("BEGIN IMMEDIATE;")
+
+    @classmethod
+    def _before_write(cls, db):
+        if cls.in_unit(db):
+            cls._begin_write(db)
+
+    @classmethod
+    def _after_write(cls, db):
+        """commits at once if query was executed outside of unit of work or transaction"""
+        if not cls.in_unit(db):
+            db.commit()
+
+    @classmethod
+    def add_query_hook(cls, hook):
+        """ Registers function called after every query executed by execute_* methods
+        with (query, args, duration in seconds)
+        """
+        cls.query_hooks.append(hook)
+
+    @classmethod
+    def _after_query(cls, query, args, started):
+        duration = time.perf_counter() - started
+        for hook in cls.query_hooks:
+            hook(query, args, duration)
+
     @classmethod
     def execute_update_query(cls, db, query, args):
-        """Execute query based on provided parameters"""
-        cur = db.cursor()
-        if type(args) is tuple:
-            args = [args]
-        cur.executemany(query, args)
-        db.commit()
+        """Execute query based on provided parameters and return number of changed rows"""
+        started = time.perf_counter()
+        try:
+            cls._before_write(db)
+            cur = db.cursor()
+            if type(args) is tuple:
+                args = [args]
+            cur.executemany(query, args)
+            cls._after_write(db)
+            return cur.rowcount
+        finally:
+            cls._after_query(query, args, started)
 
     @classmethod
     def execute_delete_query(cls, db, query, args):
-        """Execute query based on provided parameters"""
-        cur = db.cursor()
-        cur.execute(query, args)
-        db.commit()
+        """Execute query based on provided parameters and return number of deleted rows"""
+        started = time.perf_counter()
+        try:
+            cls._before_write(db)
+            cur = db.cursor()
+            cur.execute(query, args)
+            cls._after_write(db)
+            return cur.rowcount
+        finally:
+            cls._after_query(query, args, started)
 
     @classmethod
     def execute_insert_query(cls, db, query, args):
         """Execute insert query and return new record id"""
-        cur = db.cursor()
-        cur.execute(query, args)
-        last_id = cur.lastrowid
-        db.commit()
-        return last_id
+        started = time.perf_counter()
+        try:
+            cls._before_write(db)
+            cur = db.cursor()
+            cur.execute(query, args)
+            last_id = cur.lastrowid
+            cls._after_write(db)
+            return last_id
+        finally:
+            cls._after_query(query, args, started)
 
     @classmethod
     def execute_select_query(cls, db, query, args=None):
+        started = time.perf_counter()
+        try:
+            cur = db.cursor()
+            cur.execute(query, args) if args else cur.execute(query)
+            return cur.fetchall()
+        finally:
+            cls._after_query(query, args, started)
+
+    @classmethod
+    def iter_select_query(cls, db, query, args=None, batch_size=500):
+        """ Execute select query and yield rows, fetching batch_size rows at once.
+        Only time spent in the database is reported to query hooks, not time of processing rows.
+        """
+        started = time.perf_counter()
+        paused = None
         cur = db.cursor()
-        cur.execute(query, args) if args else cur.execute(query)
-        return cur.fetchall()
+        try:
+            cur.execute(query, args) if args else cur.execute(query)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    return
+                paused = time.perf_counter()
+                for row in rows:
+                    yield row
+                started += time.perf_counter() - paused
+                paused = None
+        finally:
+            if paused is not None:
+                started += time.perf_counter() - paused
+            cur.close()
+            cls._after_query(query, args, started)
+
 
+os.register_at_fork(after_in_child=DB.forget_pools)
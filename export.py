@@ -0,0 +1,43 @@
+import csv
+import io
+import json
+
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def csv_lines(fields, rows, header=True):
+    """yields rows as csv lines, with line of field names first"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(fields)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def ndjson_lines(fields, rows):
+    """yields rows as lines with one JSON object each"""
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), separators=(',', ':'), ensure_ascii=False) + '\n'
+
+
+def encode(lines, chunk_size=65536):
+    """joins text lines into utf-8 chunks of about chunk_size bytes, so response isn't written line by line"""
+    chunk = []
+    size = 0
+    for line in lines:
+        data = line.encode('utf-8')
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
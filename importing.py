@@ -0,0 +1,122 @@
+import codecs
+import csv
+import json
+from common import separate_unit
+from models.todo import Todo
+
+
+FORMATS = ('csv', 'ndjson')
+# columns of imported todo, other ones (like id of exported todo) are ignored
+FIELDS = ('name', 'priority', 'due_date', 'description', 'status')
+
+
+def read_lines(stream, chunk_size=65536):
+    """ Reads utf-8 text from binary stream chunk by chunk and yields it line by line,
+    with line endings kept (csv reader needs them for values spanning lines).
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    rest = ''
+    while True:
+        data = stream.read(chunk_size)
+        lines = (rest + decoder.decode(data, final=not data)).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if not data:
+            break
+    if rest:
+        yield rest
+
+
+def read_records(stream, import_format):
+    """ Parses csv (with header line) or ndjson stream.
+    Returns:
+        generator(tuple): (dict of values, error) for every record, error is None for valid one
+    """
+    lines = read_lines(stream)
+    if import_format == 'csv':
+        reader = csv.DictReader(lines)
+        while True:
+            try:
+                record = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                # reader can't find start of the next record
+                yield None, 'Invalid csv: {}'.format(error)
+                return
+            yield record, None
+    else:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield None, 'Invalid JSON'
+                continue
+            yield (record, None) if isinstance(record, dict) else (None, 'Line should be JSON object')
+
+
+def record_todo(record):
+    """ Checks record with the same rules as new todo form.
+    Returns:
+        tuple: (Todo, None) for valid record, (None, description of the problem) otherwise
+    """
+    values = dict((field, record.get(field)) for field in FIELDS)
+    # empty csv values are missing ones
+    values = dict((field, value if value != '' else None) for field, value in values.items())
+    if values['due_date'] is not None and not isinstance(values['due_date'], str):
+        return None, 'Date should have YYYY-MM-DD format'
+    error = Todo.validation_error(values['name'], values['priority'], values['due_date'])
+    if error:
+        return None, error
+    status = str(values['status'] if values['status'] is not None else 0).lower()
+    if status not in ('0', '1', 'false', 'true'):
+        return None, 'Status should be 0 or 1'
+    return Todo(str(values['name']), status=1 if status in ('1', 'true') else 0, priority=int(values['priority']),
+                due_date=values['due_date'], description=values['description']), None
+
+
+def import_todos(stream, import_format, owner_id, chunk_size=1000, max_rows=None, max_errors=100):
+    """ Imports todos from csv or ndjson stream, chunk_size todos in one transaction.
+    Invalid records are skipped and reported, committed chunks stay when import is interrupted.
+    Args:
+        max_rows(int): records after this number are not imported, no limit if None
+        max_errors(int): number of reported errors, the next ones are counted only
+    Returns:
+        dict: {'imported': number of todos, 'failed': number of skipped records,
+               'errors': [{'row': record number from 1, 'error': description}, ...]}
+    """
+    report = {'imported': 0, 'failed': 0, 'errors': []}
+
+    def fail(row, error):
+        report['failed'] += 1
+        if len(report['errors']) < max_errors:
+            report['errors'].append({'row': row, 'error': error})
+
+    chunk = []
+    for row, (record, error) in enumerate(read_records(stream, import_format), 1):
+        if max_rows is not None and row > max_rows:
+            fail(row, 'Import can have at most {} rows'.format(max_rows))
+            break
+        todo, error = record_todo(record) if error is None else (None, error)
+        if error:
+            fail(row, error)
+            continue
+        chunk.append(todo)
+        if len(chunk) >= chunk_size:
+            report['imported'] += save_chunk(chunk, owner_id)
+            chunk = []
+    if chunk:
+        report['imported'] += save_chunk(chunk, owner_id)
+    return report
+
+
+def save_chunk(todos, owner_id):
+    """ Inserts todos in unit of work of their own, committed at once without committing anything else
+    of current request. Returns number of todos.
+    """
+    with separate_unit():
+        Todo.insert_many(todos, owner_id)
+    return len(todos)
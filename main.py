@@ -1,21 +1,168 @@
 from models.todo import Todo
 from models.todolist import TodoList
-from models.users import User
-from flask import Flask, render_template, request, session, redirect, g, url_for, flash
-from common import login_required, admin_only
+from models.users import User, user_cache
+from models.user_stats import UserTodoStats
+from models.history import history_writer
+from models.data_version import DataVersion
+from models.daily_stats import DailyTodoStats
+from models.history_retention import HistoryRetention
+from models.user_deletion import UserDeletion, deletion_worker
+from models.shard_move import ShardMove, ShardRebalancer
+from flask import Flask, render_template, request, session, redirect, url_for, flash, jsonify, make_response, g
+from common import login_required, admin_only, get_db, connection, commit_db, release_db, highlight_html
+from dbhandle import DB
+from cache import make_cache
+from markupsafe import Markup
+import assets
 import config
-import datetime
+from compression import Compression
+import migrations
+import sharding
+from sharding import shard_map, ShardMoving
+from api import api
+from querylog import QueryStats, record_query, log_request, query_budget
+import importing
+import click
+import hashlib
+import os
+import time
 
 
 app = Flask(__name__)
 app.config.from_object(config.BaseConfig)
+app.register_blueprint(api)
+app.add_template_filter(highlight_html, 'highlight')
+static_assets = assets.init_app(app)
+# registered before other after request hooks, so it runs after them
+compression = Compression(app)
+
+if app.config['AUTO_MIGRATE']:
+    sharding.upgrade_databases()
+
+
+DB.add_query_hook(record_query)
+
+
+def rollup_daily_stats():
+    """ Adds todo history written by history writer to daily statistics. Synchronous history writer
+    calls it after request committed, rollups are committed in unit of work of their own then.
+    """
+    with app.app_context():
+        DailyTodoStats.rollup_all()
+        commit_db()
+
+
+history_writer.flush_callbacks.append(rollup_daily_stats)
+
+
+def delete_removed_users_data():
+    """deletes data of removed users with many todos, run by deletion worker thread"""
+    with app.app_context():
+        UserDeletion(app.config['USER_DELETE_BATCH']).run_pending()
+
+
+deletion_worker.target = delete_removed_users_data
+
+
+def resume_user_deletions():
+    """ Wakes deletion worker when deletions of removed users were left unfinished by previous run
+    (restart or crash), called when server starts. Workers resuming the same deletion together
+    only find fewer rows to delete.
+    """
+    with app.app_context():
+        pending = UserDeletion.pending()
+    if pending:
+        deletion_worker.wake()
+
+
+@app.before_request
+def start_query_stats():
+    view = app.view_functions.get(request.endpoint)
+    g.query_stats = QueryStats(budget=getattr(view, 'query_budget', app.config['QUERY_BUDGET']),
+                               strict=app.testing or app.config['QUERY_BUDGET_STRICT'])
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def report_query_stats(response):
+    """adds Server-Timing header with database time and logs query statistics of request"""
+    stats = g.get('query_stats')
+    if stats is not None:
+        total = time.perf_counter() - g.request_started
+        response.headers['Server-Timing'] = stats.server_timing(total)
+        log_request(stats, request.method, request.path, request.endpoint, response.status_code, total)
+    return response
+
+
+@app.after_request
+def commit_unit_of_work(response):
+    commit_db()
+    return response
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    release_db(exception)
+
+
+def get_templates_version():
+    """hash of templates modification times, pages cached by browsers are not reused after templates change"""
+    mtimes = []
+    for directory, _, file_names in os.walk(os.path.join(app.root_path, app.template_folder)):
+        mtimes += [(name, os.path.getmtime(os.path.join(directory, name))) for name in sorted(file_names)]
+    return hashlib.sha1(repr(mtimes).encode('utf-8')).hexdigest()
+
+
+TEMPLATES_VERSION = get_templates_version()
+
+
+def conditional_page(user_id, render=None):
+    """ Returns 304 Not Modified if browser already has the page built from current data version
+    of user with given id, otherwise response of render() with ETag of this version.
+    Page depends on session (viewer, sort order) too, so it is part of ETag. Last-Modified is
+    sent for information only, pages are validated by ETag alone.
+    Args:
+        user_id(int): id of user whose data is shown on the page
+        render(function): builds the page, called only when it is not modified; without it None is
+                          returned instead, so view can revalidate page before reading its data
+    """
+    if request.method != 'GET' or '_flashes' in session:
+        return render() if render is not None else None
+    data_version = DataVersion.get_by_user_id(user_id)
+    key = (TEMPLATES_VERSION, static_assets.version, request.full_path, user_id, session.get('user_id'),
+           session.get('is_admin'), session.get('sort_type'), session.get('sort_direct'), data_version.version)
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    # weak, compressed page is the same page
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    elif render is None:
+        return None
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    if data_version.last_modified is not None:
+        response.last_modified = data_version.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+# rendered todo list items by version of todo, stale ones are never hit and get evicted
+fragment_cache = make_cache(app.config['FRAGMENT_CACHE_SIZE'], client=app.config['FRAGMENT_CACHE_CLIENT'],
+                            prefix='todo-item:')
+
+
+@app.template_global()
+def todo_item_fragment(item):
+    """todo list item markup, rendered only if this version of item is not in fragment cache"""
+    key = (TEMPLATES_VERSION, request.script_root, item.row_version())
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        fragment = render_template('includes/todo_list_scheme.html', item=item)
+        fragment_cache.set(key, fragment)
+    return Markup(fragment)
 
 
 @app.route("/", methods=['GET', 'POST'])
@@ -24,29 +171,56 @@ def td_list():
     """ Shows list of todo items stored in the database.
     """
 
-    user = User.get_by_id(session['user_id'])
-    new_todolist = TodoList(user)
-    sort_types = {'name': new_todolist.sort_by_name,
-                  'priority': new_todolist.sort_by_priority,
-                  'due date': new_todolist.sort_by_due_date,
-                  'create date': new_todolist.sort_by_create_date,
-                  'status': new_todolist.sort_by_status}
-    if request.method == 'GET':
-        session['sort_type'] = 'create date'
-        session['sort_direct'] = 'asc'
-        sort_types[session['sort_type']](is_desc=True if session['sort_direct'] == 'desc' else False)
-    if request.method == "POST" and new_todolist:
+    if request.method == "POST" and request.form.get('sort') in TodoList.SORT_TYPES:
         sort_type = request.form['sort']
-        if session['sort_type'] == sort_type:
+        if session.get('sort_type') == sort_type:
             session['sort_direct'] = 'asc' if session['sort_direct'] == 'desc' else 'desc'
         else:
             session['sort_direct'] = 'asc'
-        sort_types[sort_type](is_desc=session['sort_direct'] == 'desc')
-
         session['sort_type'] = sort_type
-    todo_list = new_todolist.active_todos
-    archive_list = new_todolist.archived_todos
-    return render_template('index.html', todo_list=todo_list, archive_list=archive_list)
+
+    def render():
+        todo_list, next_after = get_todos_page(is_archived=False)
+        return render_template('index.html', todo_list=todo_list, next_after=next_after)
+    return conditional_page(session['user_id'], render)
+
+
+@app.route("/todo/list")
+@login_required
+def td_list_page():
+    """ Renders page of active or archived todo items (selected by 'archived' and 'after' arguments)
+    as list fragment, sorted the same way as todo list view.
+    """
+    is_archived = request.args.get('archived', 0, type=int) == 1
+    after_id = request.args.get('after', type=int)
+
+    def render():
+        items, next_after = get_todos_page(is_archived, after_id)
+        return render_template('includes/todo_items.html', items=items, archived=is_archived,
+                               next_after=next_after, is_first_page=after_id is None)
+    return conditional_page(session['user_id'], render)
+
+
+def get_todos_page(is_archived, after_id=None):
+    """returns page of logged user todos sorted as chosen in session and id to start next page from"""
+    if session.get('sort_type') not in TodoList.SORT_TYPES:
+        session['sort_type'] = 'create date'
+        session['sort_direct'] = 'asc'
+    user = User.get_by_id(session['user_id'])
+    todo_list = TodoList(user, session['sort_type'], is_desc=session.get('sort_direct') == 'desc',
+                         page_size=app.config['TODOS_PAGE_SIZE'])
+    items, has_next = todo_list.get_page(is_archived, after_id)
+    next_after = items[-1].id if has_next else None
+    return items, next_after
+
+
+@app.route("/todo/search")
+@login_required
+def search():
+    """ Shows logged user todos whose name or description contain words typed in 'q' argument """
+    text = request.args.get('q', '')
+    results = Todo.search(session['user_id'], text, limit=app.config['SEARCH_RESULTS'])
+    return render_template('search.html', text=text, results=results)
 
 
 @app.route("/login", methods=['GET', 'POST'])
@@ -54,10 +228,8 @@ def login():
     error = None
     if request.method == 'POST':
         user_name = request.form['username']
-        if User.is_user_with_name_in_user_list(user_name) \
-                or User.is_user_with_email_in_user_list(user_name):
-            user = User.get_by_name(user_name) if User.is_user_with_name_in_user_list(user_name) \
-                else User.get_by_email(user_name)
+        user = User.get_by_login(user_name)
+        if user:
             if request.form['password'] != user.get_password():
                 error = "Wrong password. Try again"
             else:
@@ -101,13 +273,12 @@ def add():
         item_priority = request.form['priority']
         item_due_date = request.form['due_date'] if request.form['due_date'] else None
         item_description = request.form['description'] if request.form['description'] else None
-        if item_due_date:
-            year, month, day = list(map(lambda x: int(x), item_due_date.split('-')))
-            if datetime.date(year, month, day) < datetime.date.today():
-                flash('Date should be current or future')
-                temp_item = Todo(item_name, priority=item_priority, description=item_description)
-                return render_template('todo_form.html', action=url_for('add'),
-                                       submit_title="Add", item=temp_item)
+        error = Todo.validation_error(item_name, item_priority, item_due_date)
+        if error:
+            flash(error)
+            temp_item = Todo(item_name, priority=item_priority, description=item_description)
+            return render_template('todo_form.html', action=url_for('add'),
+                                   submit_title="Add", item=temp_item)
         new_todo = Todo(item_name, due_date=item_due_date, priority=item_priority,
                         owner_id=session['user_id'], description=item_description)
         new_todo.save()
@@ -120,12 +291,19 @@ def add():
 @app.route("/todo/<int:item_id>")
 @login_required
 def show_todo(item_id):
+    # page of own todo is revalidated without reading the todo: its ETag matches only page built for this
+    # owner from their current data version, which every change of the todo (removal, new owner) bumps
+    if request.if_none_match:
+        response = conditional_page(session['user_id'])
+        if response is not None:
+            return response
     item_to_show = Todo.get_by_id(item_id)
     if not item_to_show:
         flash("No such todo item")
         return redirect('/')
     if item_to_show.owner_id == session['user_id'] or session['is_admin']:
-        return render_template('show_todo.html', item=item_to_show)
+        return conditional_page(item_to_show.owner_id,
+                                lambda: render_template('show_todo.html', item=item_to_show))
     else:
         flash('Access denied')
         return redirect('/')
@@ -194,7 +372,6 @@ def toggle(todo_id):
         flash("No such todo item")
         return redirect('/')
     item_to_edit.toggle()
-    item_to_edit.save()
     return redirect(url_for('td_list'))
 
 
@@ -206,13 +383,12 @@ def archive(todo_id):
         flash("No such todo item")
         return redirect('/')
     item_to_archive.is_archived = True
-    item_to_archive.save()
-    item_to_archive.update_history('archive')
+    item_to_archive.save('archive')
     flash('Item {} moved to archive'.format(item_to_archive.name.encode('utf-8')))
     return redirect(url_for('td_list'))
 
 
-@app.route("/todo/<todo_id>/activate")
+@app.route("/todo/<int:todo_id>/activate")
 @login_required
 def activate(todo_id):
     item_to_activate = Todo.get_by_id(todo_id)
@@ -221,12 +397,36 @@ def activate(todo_id):
         return redirect('/')
     item_to_activate.is_archived = False
     item_to_activate.status = 0
-    item_to_activate.save()
-    item_to_activate.update_history('activate')
+    item_to_activate.save('activate')
     flash('Item {} is active again'.format(item_to_activate.name.encode('utf-8')))
     return redirect(url_for('td_list'))
 
 
+@app.route("/todo/bulk", methods=['POST'])
+@login_required
+def bulk():
+    """ Toggles, archives or removes todo items selected on the list, all in one transaction """
+    actions = {'toggle': (Todo.toggle_many, '{} items toggled'),
+               'archive': (Todo.archive_many, '{} items moved to archive'),
+               'remove': (Todo.delete_many, '{} items removed')}
+    action = request.form.get('action')
+    ids = request.form.getlist('ids', type=int)
+    if action not in actions or not ids:
+        flash('Choose items and action')
+        return redirect(url_for('td_list'))
+    bulk_operation, message = actions[action]
+    flash(message.format(bulk_operation(session['user_id'], ids)))
+    return redirect(url_for('td_list'))
+
+
+@app.route("/todo/archive-done", methods=['POST'])
+@login_required
+def archive_done():
+    """ Moves all done todo items to archive """
+    flash('{} items moved to archive'.format(Todo.archive_done(session['user_id'])))
+    return redirect(url_for('td_list'))
+
+
 @app.route("/signup", methods=['GET', 'POST'])
 def signup():
     if request.method == 'POST':
@@ -264,11 +464,11 @@ def signup():
 @admin_only
 @login_required
 def users_list():
-    users = User.get_users_list()
+    users, next_after = get_users_page()
     if not users:
         flash("There are no users.")
         return redirect('/')
-    return render_template('includes/users_list.html', users=users)
+    return render_template('includes/users_list.html', users=users, next_after=next_after)
 
 
 @app.route("/users/new", methods=['GET', 'POST'])
@@ -361,6 +561,7 @@ def remove_user(user_id):
 
 @app.route("/users/<int:user_id>/remove/confirm", methods=['GET', 'POST'])
 @login_required
+@query_budget(40)
 def remove_user_confirm(user_id):
     """  """
     if session['user_id'] == user_id or session['is_admin']:
@@ -398,26 +599,63 @@ def remove_user_confirm(user_id):
 @app.route("/users/<int:user_id>")
 @login_required
 def show_user(user_id):
-    user_to_show = User.get_by_id(user_id)
-    if not user_to_show:
-        flash("No such user")
-        return redirect('/')
+    def render():
+        user_to_show = User.get_by_id(user_id)
+        if not user_to_show:
+            flash("No such user")
+            return redirect('/')
+        if session['user_id'] == user_id or session['is_admin']:
+            return render_template('show_user.html', user=user_to_show)
+        else:
+            flash('Access denied')
+            return redirect('/')
     if session['user_id'] == user_id or session['is_admin']:
-        return render_template('show_user.html', user=user_to_show)
-    else:
-        flash('Access denied')
-        return redirect('/')
+        return conditional_page(user_id, render)
+    return render()
 
 
 @app.route("/admin")
 @login_required
 @admin_only
 def admin_panel():
-    users = User.get_users_list()
+    users, next_after = get_users_page()
     if not users:
         flash("No users")
         return redirect('/')
-    return render_template('admin_panel.html', users=users)
+    statistics = DailyTodoStats.get_days(days=app.config['STATS_DAYS'])
+    return render_template('admin_panel.html', users=users, next_after=next_after, statistics=statistics,
+                           statistics_total=DailyTodoStats.total(statistics))
+
+
+def get_users_page():
+    """returns users page selected by 'after' request argument and id to start next page from"""
+    after_id = request.args.get('after', type=int)
+    users, has_next = User.get_users_page(after_id, app.config['USERS_PAGE_SIZE'])
+    next_after = users[-1].id if has_next else None
+    return users, next_after
+
+
+@app.route("/admin/metrics")
+@login_required
+@admin_only
+def metrics():
+    """ Shows usage counters of database connection pools, history writer, caches and response compression """
+    return jsonify(pools=DB.pool_stats(), history=history_writer.stats(), user_cache=user_cache.stats(),
+                   fragment_cache=fragment_cache.stats(), compression=compression.stats.stats(),
+                   shards=shard_map.stats())
+
+
+@app.route("/admin/statistics")
+@login_required
+@admin_only
+def statistics():
+    """ Daily todo statistics of all users or of one user (chosen by 'user_id' argument)
+    from the last 'days' days as JSON
+    """
+    user_id = request.args.get('user_id', DailyTodoStats.ALL_USERS, type=int)
+    days = DailyTodoStats.get_days(user_id, request.args.get('days', app.config['STATS_DAYS'], type=int))
+    return jsonify(user_id=user_id, days=[day.to_dict() for day in days],
+                   total=DailyTodoStats.total(days, user_id).to_dict())
 
 
 @app.errorhandler(404)
@@ -425,6 +663,184 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(ShardMoving)
+def shard_moving(e):
+    """ Writes of user whose data is being moved to another shard are rejected for a few seconds """
+    response = make_response('Your todos are being moved, try again in a few seconds.', 503)
+    response.headers['Retry-After'] = str(int(app.config['SHARD_MOVE_GRACE']) or 1)
+    return response
+
+
+@app.cli.command('migrate')
+@click.option('--target', type=int, default=None, help='Last migration version to apply.')
+def migrate(target):
+    """ Applies pending schema migrations to the main database and every shard, creating missing shards """
+    for database, version, name in sharding.upgrade_databases(target):
+        click.echo('{}: applied migration {}: {}'.format(database, version, name))
+    for database in shard_map.databases():
+        click.echo('{}: schema version {}'.format(database, migrations.current_version(connection(database))))
+
+
+@app.cli.command('todo-stats')
+@click.option('--rebuild', is_flag=True, help='Recompute counters from scratch after the check.')
+def todo_stats(rebuild):
+    """ Compares per-user todo counters with todo_items of every database and reports drift """
+    drifted = 0
+    for database in shard_map.databases():
+        drift = UserTodoStats.find_drift(database)
+        for stored, expected in drift:
+            click.echo('{}: user {}: stored {} expected {}'.format(database, stored.user_id, stored.as_tuple()[1:],
+                                                                   expected.as_tuple()[1:]))
+        drifted += len(drift)
+        if rebuild:
+            UserTodoStats.rebuild(database)
+    click.echo('{} users with drifted counters'.format(drifted))
+    if rebuild:
+        click.echo('Counters rebuilt')
+    elif drifted:
+        raise click.ClickException('Counters drifted, run with --rebuild')
+
+
+@app.cli.command('stats-rollup')
+def stats_rollup():
+    """ Adds todo history rows which are not counted yet to daily statistics """
+    for database, last_id in DailyTodoStats.rollup_all().items():
+        click.echo('{}: todo history rolled up to row {}'.format(database, last_id))
+
+
+@app.cli.command('history-retention')
+@click.option('--days', type=int, default=None, help='Days of kept history, HISTORY_RETENTION_DAYS by default.')
+@click.option('--batch-size', type=int, default=None, help='Rows deleted in one transaction.')
+@click.option('--archive-dir', default=None, help='Directory of archive files, HISTORY_ARCHIVE_DIR by default.')
+@click.option('--setup-vacuum', is_flag=True, help='Switch database to incremental auto vacuum first (full VACUUM).')
+def history_retention(days, batch_size, archive_dir, setup_vacuum):
+    """ Archives, summarizes and deletes todo history older than retention period in every database """
+    for database in shard_map.databases():
+        if setup_vacuum:
+            HistoryRetention.enable_incremental_vacuum(connection(database))
+            click.echo('{}: incremental auto vacuum enabled'.format(database))
+        # ids of shards don't overlap, so archive file names of all databases are unique
+        retention = HistoryRetention(archive_dir or app.config['HISTORY_ARCHIVE_DIR'],
+                                     days if days is not None else app.config['HISTORY_RETENTION_DAYS'],
+                                     batch_size or app.config['HISTORY_DELETE_BATCH'],
+                                     app.config['HISTORY_DELETE_PAUSE'], database)
+        archives = retention.run()
+        for archive in archives:
+            click.echo('{}: {} rows archived, {} deleted'.format(archive['file_name'], archive['rows'],
+                                                                 archive['deleted']))
+        click.echo('{}: history before {} archived in {} files'.format(database, retention.cutoff_date(),
+                                                                        len(archives)))
+
+
+@app.cli.command('import-todos')
+@click.argument('file_name', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user-id', type=int, required=True, help='Owner of imported todos.')
+@click.option('--format', 'import_format', type=click.Choice(importing.FORMATS), default=None,
+              help='File format, by default from file extension.')
+@click.option('--chunk-size', type=int, default=None, help='Todos saved in one transaction.')
+def import_todos(file_name, user_id, import_format, chunk_size):
+    """ Creates todos of user from csv or ndjson file, reporting rows which can't be imported """
+    if not User.get_by_id(user_id):
+        raise click.ClickException('No user with id {}'.format(user_id))
+    import_format = import_format or ('ndjson' if file_name.endswith(('.ndjson', '.jsonl')) else 'csv')
+    started = time.perf_counter()
+    with open(file_name, 'rb') as stream:
+        report = importing.import_todos(stream, import_format, user_id,
+                                        chunk_size or app.config['IMPORT_CHUNK_SIZE'], max_errors=1000)
+    for error in report['errors']:
+        click.echo('row {}: {}'.format(error['row'], error['error']))
+    click.echo('{} todos imported, {} rows failed in {:.1f} s'.format(report['imported'], report['failed'],
+                                                                     time.perf_counter() - started))
+
+
+@app.cli.command('delete-users')
+@click.option('--sweep-orphans', is_flag=True, help='Also delete rows of users removed without their data.')
+def delete_users(sweep_orphans):
+    """ Deletes data of removed users waiting for background deletion """
+    deletion = UserDeletion(app.config['USER_DELETE_BATCH'])
+    click.echo('{} rows of scheduled users deleted'.format(deletion.run_pending()))
+    if sweep_orphans:
+        for user_id, deleted in sorted(deletion.sweep_orphans().items()):
+            click.echo('user {}: {} rows deleted'.format(user_id, deleted))
+
+
+@app.cli.command('shards')
+def shards():
+    """ Shows databases with number of users and todos placed in them and users being moved """
+    loads = ShardRebalancer.loads()
+    for shard in sorted(loads):
+        click.echo('{:>2} {}: {} users, {} todos'.format(shard, shard_map.database(shard), len(loads[shard]),
+                                                        sum(loads[shard].values())))
+    query = "SELECT `user_id`, `shard`, `moving_to` FROM `user_shards` WHERE `moving_to` IS NOT NULL;"
+    for user_id, shard, moving_to in DB.execute_select_query(get_db(), query):
+        click.echo('user {} is being moved from {} to {}'.format(user_id, shard, moving_to))
+
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+@click.option('--abort', is_flag=True, help='Stop interrupted move and delete rows copied so far instead.')
+def move_user(user_id, shard, abort):
+    """ Moves todos and statistics of user to shard (index in SHARDS, 'main' for the main database) """
+    if not User.get_by_id(user_id):
+        raise click.ClickException('No user with id {}'.format(user_id))
+    if shard == 'main':
+        shard = sharding.MAIN_DATABASE
+    elif shard.isdigit() and int(shard) < len(shard_map.shards):
+        shard = int(shard)
+    else:
+        raise click.ClickException('No shard {}, SHARDS has {}'.format(shard, len(shard_map.shards)))
+    mover = ShardMove(app.config['SHARD_MOVE_BATCH'], app.config['SHARD_MOVE_GRACE'])
+    if abort:
+        click.echo('Move aborted, {} copied rows deleted'.format(mover.abort(user_id)))
+        return
+    try:
+        results = mover.move_many([(user_id, shard)])
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for result in results:
+        click.echo('user {}: {} todos and {} history rows moved from {} to {}, {} rows deleted'.format(
+            result['user_id'], result['todos'], result['history'], result['source'], result['target'],
+            result['deleted']))
+
+
+@app.cli.command('rebalance-shards')
+@click.option('--max-moves', type=int, default=20, help='Most users moved by one run.')
+@click.option('--dry-run', is_flag=True, help='Only print planned moves.')
+def rebalance_shards(max_moves, dry_run):
+    """ Moves users from the main database and from overloaded shards to the least loaded ones """
+    moves = ShardRebalancer(max_moves).plan()
+    for user_id, source, target, todos in moves:
+        click.echo('user {} ({} todos): {} -> {}'.format(user_id, todos, source, target))
+    if dry_run or not moves:
+        click.echo('{} moves planned'.format(len(moves)))
+        return
+    mover = ShardMove(app.config['SHARD_MOVE_BATCH'], app.config['SHARD_MOVE_GRACE'])
+    results = mover.move_many([(user_id, target) for user_id, source, target, todos in moves])
+    click.echo('{} users moved'.format(len(results)))
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """ Builds fingerprinted and precompressed static files and their manifest """
+    manifest = assets.build(os.path.join(app.root_path, 'static'), static_assets.output_dir)
+    static_assets.load()
+    click.echo('{} static files built in {}{}'.format(len(manifest), static_assets.output_dir,
+                                                      '' if assets.brotli else ' (without brotli)'))
+
+
+@app.cli.command('check-queries')
+def check_queries():
+    """ Fails if any query from models scans a whole table """
+    scans = migrations.find_table_scans(get_db())
+    for file_name, line, query, detail in scans:
+        click.echo('{}:{}: {}\n    {}'.format(file_name, line, detail, query))
+    if scans:
+        raise click.ClickException('{} queries scan a table'.format(len(scans)))
+    click.echo('No table scans found')
+
+
 if __name__ == "__main__":
+    resume_user_deletions()
     app.run()
 
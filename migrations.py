@@ -0,0 +1,387 @@
+import ast
+import importlib
+import os
+import re
+import sqlite3
+import time
+
+
+# ordered list of schema migrations: (version, name, list of sql statements)
+# a new migration always gets the next version number, applied migrations are never edited
+MIGRATIONS = [
+    (1, 'todo items owner indexes', [
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner_archived_create_date` "
+        "ON `todo_items` (`owner_id`, `is_archived`, `create_date`);",
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner_archived_status` "
+        "ON `todo_items` (`owner_id`, `is_archived`, `status`);",
+    ]),
+    (2, 'unique user name and email', [
+        "CREATE UNIQUE INDEX IF NOT EXISTS `users_name` ON `users` (`name`);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS `users_email` ON `users` (`email`);",
+    ]),
+    (3, 'todo history item index', [
+        "CREATE INDEX IF NOT EXISTS `todo_history_item_change_date` "
+        "ON `todo_history` (`item_id`, `change_date`);",
+    ]),
+    (4, 'users permissions user index', [
+        "CREATE INDEX IF NOT EXISTS `users_permissions_user_permission` "
+        "ON `users_permissions` (`user_id`, `permission_id`);",
+    ]),
+    (5, 'user todo stats table and triggers', [
+        "CREATE TABLE IF NOT EXISTS `user_todo_stats` ("
+        "`user_id` INTEGER PRIMARY KEY, "
+        "`active_count` INTEGER NOT NULL DEFAULT 0, "
+        "`active_done_count` INTEGER NOT NULL DEFAULT 0, "
+        "`active_undone_count` INTEGER NOT NULL DEFAULT 0, "
+        "`archived_count` INTEGER NOT NULL DEFAULT 0);",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_stats_insert` AFTER INSERT ON `todo_items` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_todo_stats` (`user_id`) SELECT NEW.`owner_id` WHERE NEW.`owner_id` IS NOT NULL; "
+        "UPDATE `user_todo_stats` SET "
+        "`active_count` = `active_count` + (CASE WHEN NEW.`is_archived` = 0 THEN 1 ELSE 0 END), "
+        "`active_done_count` = `active_done_count` "
+        "+ (CASE WHEN NEW.`is_archived` = 0 AND NEW.`status` = 1 THEN 1 ELSE 0 END), "
+        "`active_undone_count` = `active_undone_count` "
+        "+ (CASE WHEN NEW.`is_archived` = 0 AND NEW.`status` = 0 THEN 1 ELSE 0 END), "
+        "`archived_count` = `archived_count` + (CASE WHEN NEW.`is_archived` = 1 THEN 1 ELSE 0 END) "
+        "WHERE `user_id` = NEW.`owner_id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_stats_delete` AFTER DELETE ON `todo_items` "
+        "BEGIN "
+        "UPDATE `user_todo_stats` SET "
+        "`active_count` = `active_count` - (CASE WHEN OLD.`is_archived` = 0 THEN 1 ELSE 0 END), "
+        "`active_done_count` = `active_done_count` "
+        "- (CASE WHEN OLD.`is_archived` = 0 AND OLD.`status` = 1 THEN 1 ELSE 0 END), "
+        "`active_undone_count` = `active_undone_count` "
+        "- (CASE WHEN OLD.`is_archived` = 0 AND OLD.`status` = 0 THEN 1 ELSE 0 END), "
+        "`archived_count` = `archived_count` - (CASE WHEN OLD.`is_archived` = 1 THEN 1 ELSE 0 END) "
+        "WHERE `user_id` = OLD.`owner_id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_stats_update` "
+        "AFTER UPDATE OF `owner_id`, `is_archived`, `status` ON `todo_items` "
+        "BEGIN "
+        "UPDATE `user_todo_stats` SET "
+        "`active_count` = `active_count` - (CASE WHEN OLD.`is_archived` = 0 THEN 1 ELSE 0 END), "
+        "`active_done_count` = `active_done_count` "
+        "- (CASE WHEN OLD.`is_archived` = 0 AND OLD.`status` = 1 THEN 1 ELSE 0 END), "
+        "`active_undone_count` = `active_undone_count` "
+        "- (CASE WHEN OLD.`is_archived` = 0 AND OLD.`status` = 0 THEN 1 ELSE 0 END), "
+        "`archived_count` = `archived_count` - (CASE WHEN OLD.`is_archived` = 1 THEN 1 ELSE 0 END) "
+        "WHERE `user_id` = OLD.`owner_id`; "
+        "INSERT OR IGNORE INTO `user_todo_stats` (`user_id`) SELECT NEW.`owner_id` WHERE NEW.`owner_id` IS NOT NULL; "
+        "UPDATE `user_todo_stats` SET "
+        "`active_count` = `active_count` + (CASE WHEN NEW.`is_archived` = 0 THEN 1 ELSE 0 END), "
+        "`active_done_count` = `active_done_count` "
+        "+ (CASE WHEN NEW.`is_archived` = 0 AND NEW.`status` = 1 THEN 1 ELSE 0 END), "
+        "`active_undone_count` = `active_undone_count` "
+        "+ (CASE WHEN NEW.`is_archived` = 0 AND NEW.`status` = 0 THEN 1 ELSE 0 END), "
+        "`archived_count` = `archived_count` + (CASE WHEN NEW.`is_archived` = 1 THEN 1 ELSE 0 END) "
+        "WHERE `user_id` = NEW.`owner_id`; "
+        "END;",
+        "INSERT OR REPLACE INTO `user_todo_stats` "
+        "(`user_id`, `active_count`, `active_done_count`, `active_undone_count`, `archived_count`) "
+        "SELECT `owner_id`, "
+        "SUM(CASE WHEN `is_archived` = 0 THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN `is_archived` = 0 AND `status` = 1 THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN `is_archived` = 0 AND `status` = 0 THEN 1 ELSE 0 END), "
+        "SUM(CASE WHEN `is_archived` = 1 THEN 1 ELSE 0 END) "
+        "FROM `todo_items` GROUP BY `owner_id` HAVING `owner_id` IS NOT NULL;",
+    ]),
+    (6, 'todo items sort indexes', [
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner_archived_name` "
+        "ON `todo_items` (`owner_id`, `is_archived`, `name`);",
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner_archived_priority` "
+        "ON `todo_items` (`owner_id`, `is_archived`, `priority`);",
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner_archived_due_date` "
+        "ON `todo_items` (`owner_id`, `is_archived`, `due_date`);",
+    ]),
+    (7, 'user data versions table and triggers', [
+        "CREATE TABLE IF NOT EXISTS `user_data_versions` ("
+        "`user_id` INTEGER PRIMARY KEY, "
+        "`version` INTEGER NOT NULL DEFAULT 0, "
+        "`modified_date` TEXT);",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_version_insert` AFTER INSERT ON `todo_items` "
+        "WHEN NEW.`owner_id` IS NOT NULL "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (NEW.`owner_id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = NEW.`owner_id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_version_update` AFTER UPDATE ON `todo_items` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) "
+        "SELECT NEW.`owner_id` WHERE NEW.`owner_id` IS NOT NULL; "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` IN (OLD.`owner_id`, NEW.`owner_id`); "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_version_delete` AFTER DELETE ON `todo_items` "
+        "BEGIN "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = OLD.`owner_id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `users_version_update` AFTER UPDATE ON `users` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (NEW.`id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` IN (OLD.`id`, NEW.`id`); "
+        "END;",
+        # row of removed user is kept and bumped, so a reused id never repeats an old version
+        "CREATE TRIGGER IF NOT EXISTS `users_version_delete` AFTER DELETE ON `users` "
+        "BEGIN "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = OLD.`id`; "
+        "END;",
+    ]),
+    (8, 'todo items full text index', [
+        # owner id is indexed as a token, so search intersects owner and word lists inside the index
+        "CREATE VIRTUAL TABLE IF NOT EXISTS `todo_items_fts` USING fts5("
+        "`name`, `description`, `owner_id`, "
+        "content='todo_items', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3');",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_fts_insert` AFTER INSERT ON `todo_items` "
+        "BEGIN "
+        "INSERT INTO `todo_items_fts` (`rowid`, `name`, `description`, `owner_id`) "
+        "VALUES (NEW.`id`, NEW.`name`, NEW.`description`, NEW.`owner_id`); "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_fts_delete` AFTER DELETE ON `todo_items` "
+        "BEGIN "
+        "INSERT INTO `todo_items_fts` (`todo_items_fts`, `rowid`, `name`, `description`, `owner_id`) "
+        "VALUES ('delete', OLD.`id`, OLD.`name`, OLD.`description`, OLD.`owner_id`); "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `todo_items_fts_update` "
+        "AFTER UPDATE OF `name`, `description`, `owner_id` ON `todo_items` "
+        "BEGIN "
+        "INSERT INTO `todo_items_fts` (`todo_items_fts`, `rowid`, `name`, `description`, `owner_id`) "
+        "VALUES ('delete', OLD.`id`, OLD.`name`, OLD.`description`, OLD.`owner_id`); "
+        "INSERT INTO `todo_items_fts` (`rowid`, `name`, `description`, `owner_id`) "
+        "VALUES (NEW.`id`, NEW.`name`, NEW.`description`, NEW.`owner_id`); "
+        "END;",
+        "INSERT INTO `todo_items_fts` (`todo_items_fts`) VALUES ('rebuild');",
+    ]),
+    (9, 'todo history owner and daily stats rollups', [
+        # owner is kept with event, history of removed todos can't be joined with todo_items
+        "ALTER TABLE `todo_history` ADD COLUMN `owner_id` INTEGER;",
+        "UPDATE `todo_history` SET `owner_id` = "
+        "(SELECT `owner_id` FROM `todo_items` WHERE `todo_items`.`id` = `todo_history`.`item_id`);",
+        # user_id 0 is a row of all users
+        "CREATE TABLE IF NOT EXISTS `daily_todo_stats` ("
+        "`day` TEXT NOT NULL, "
+        "`user_id` INTEGER NOT NULL, "
+        "`created` INTEGER NOT NULL DEFAULT 0, "
+        "`completed` INTEGER NOT NULL DEFAULT 0, "
+        "`archived` INTEGER NOT NULL DEFAULT 0, "
+        "`removed` INTEGER NOT NULL DEFAULT 0, "
+        "`done_hours_total` REAL NOT NULL DEFAULT 0, "
+        "`done_count` INTEGER NOT NULL DEFAULT 0, "
+        "PRIMARY KEY (`user_id`, `day`));",
+        # id of the last todo_history row already counted in rollups
+        "CREATE TABLE IF NOT EXISTS `stats_rollup_state` ("
+        "`name` TEXT PRIMARY KEY, "
+        "`last_id` INTEGER NOT NULL);",
+    ]),
+    (10, 'todo history retention summaries and archives', [
+        # counts of events of todo removed from todo_history by retention
+        "CREATE TABLE IF NOT EXISTS `todo_history_summary` ("
+        "`item_id` INTEGER PRIMARY KEY, "
+        "`owner_id` INTEGER, "
+        "`first_change` TEXT, "
+        "`last_change` TEXT, "
+        "`events` INTEGER NOT NULL DEFAULT 0, "
+        "`created` INTEGER NOT NULL DEFAULT 0, "
+        "`removed` INTEGER NOT NULL DEFAULT 0, "
+        "`archived` INTEGER NOT NULL DEFAULT 0, "
+        "`activated` INTEGER NOT NULL DEFAULT 0, "
+        "`updated` INTEGER NOT NULL DEFAULT 0, "
+        "`done` INTEGER NOT NULL DEFAULT 0, "
+        "`undone` INTEGER NOT NULL DEFAULT 0);",
+        # files with exported todo_history rows, rows are deleted from database after file is written
+        "CREATE TABLE IF NOT EXISTS `history_archives` ("
+        "`id` INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "`file_name` TEXT NOT NULL, "
+        "`first_id` INTEGER NOT NULL, "
+        "`last_id` INTEGER NOT NULL, "
+        "`cutoff_date` TEXT NOT NULL, "
+        "`rows` INTEGER NOT NULL, "
+        "`archived_date` TEXT, "
+        "`deleted` INTEGER NOT NULL DEFAULT 0);",
+    ]),
+    (11, 'todo and history owner indexes in id order', [
+        # rowid is the last column of every index, so rows of one owner are read in order of id
+        "CREATE INDEX IF NOT EXISTS `todo_items_owner` ON `todo_items` (`owner_id`);",
+        "CREATE INDEX IF NOT EXISTS `todo_history_owner` ON `todo_history` (`owner_id`);",
+    ]),
+    (12, 'user deletion jobs and user indexes', [
+        # users removed from users table whose todos and history are still being deleted in batches
+        "CREATE TABLE IF NOT EXISTS `user_deletions` ("
+        "`user_id` INTEGER PRIMARY KEY, "
+        "`requested_date` TEXT);",
+        "CREATE INDEX IF NOT EXISTS `users_history_user` ON `users_history` (`user_id`);",
+        "CREATE INDEX IF NOT EXISTS `todo_history_summary_owner` ON `todo_history_summary` (`owner_id`);",
+    ]),
+    (13, 'user shard placements', [
+        # shard (index of config SHARDS, -1 for the main database) with todos of user,
+        # moving_to is set while they are copied to another one
+        "CREATE TABLE IF NOT EXISTS `user_shards` ("
+        "`user_id` INTEGER PRIMARY KEY, "
+        "`shard` INTEGER NOT NULL, "
+        "`moving_to` INTEGER);",
+    ]),
+    (14, 'ids of moved todos and history', [
+        # todos and history rows copied to another shard with their owner get new ids there,
+        # old ids (in bookmarks, API clients, export positions) are resolved to new ones by this table
+        "CREATE TABLE IF NOT EXISTS `moved_ids` ("
+        "`table_name` TEXT NOT NULL, "
+        "`old_id` INTEGER NOT NULL, "
+        "`new_id` INTEGER NOT NULL, "
+        "`owner_id` INTEGER NOT NULL, "
+        "PRIMARY KEY (`table_name`, `old_id`)) WITHOUT ROWID;",
+        "CREATE INDEX IF NOT EXISTS `moved_ids_owner` ON `moved_ids` (`owner_id`, `table_name`, `old_id`);",
+    ]),
+    (15, 'user versions bumped by permissions and removal', [
+        # cached users are checked against their version, so every change of user has to bump it:
+        # removal of user whose version row didn't exist yet and changes of permissions too
+        "DROP TRIGGER IF EXISTS `users_version_delete`;",
+        "CREATE TRIGGER IF NOT EXISTS `users_version_delete` AFTER DELETE ON `users` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (OLD.`id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = OLD.`id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `users_permissions_version_insert` AFTER INSERT ON `users_permissions` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (NEW.`user_id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = NEW.`user_id`; "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `users_permissions_version_update` AFTER UPDATE ON `users_permissions` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (NEW.`user_id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` IN (OLD.`user_id`, NEW.`user_id`); "
+        "END;",
+        "CREATE TRIGGER IF NOT EXISTS `users_permissions_version_delete` AFTER DELETE ON `users_permissions` "
+        "BEGIN "
+        "INSERT OR IGNORE INTO `user_data_versions` (`user_id`) VALUES (OLD.`user_id`); "
+        "UPDATE `user_data_versions` SET `version` = `version` + 1, "
+        "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now') "
+        "WHERE `user_id` = OLD.`user_id`; "
+        "END;",
+    ]),
+]
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+QUERY_PATTERN = re.compile(r'^\s*(/\*.*?\*/\s*)?(SELECT|INSERT|UPDATE|DELETE|REPLACE)\s', re.IGNORECASE)
+# maintenance queries which have to read whole tables start with this comment
+FULL_SCAN_MARK = '/* full scan */'
+
+
+def create_version_table(db):
+    """creates table with applied migrations if it doesn't exist yet"""
+    db.execute("CREATE TABLE IF NOT EXISTS `schema_version` ("
+               "`version` INTEGER PRIMARY KEY, "
+               "`name` TEXT, "
+               "`applied_date` TEXT);")
+    db.commit()
+
+
+def current_version(db):
+    """returns number of the last applied migration (0 for database without migrations)"""
+    create_version_table(db)
+    return db.execute("SELECT MAX(`version`) FROM `schema_version`;").fetchone()[0] or 0
+
+
+def upgrade(db, target=None):
+    """Applies pending migrations in order, each one in its own transaction.
+    Args:
+        db: database connection
+        target(int): last version to apply, all pending migrations if None
+    Returns:
+        list(tuple): applied migrations as (version, name)
+    """
+    version = current_version(db)
+    applied = []
+    for number, name, statements in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        try:
+            db.execute("BEGIN;")
+            for statement in statements:
+                db.execute(statement)
+            db.execute("INSERT INTO `schema_version` (`version`, `name`, `applied_date`) VALUES (?, ?, ?);",
+                       (number, name, time.strftime("%Y-%m-%d %H:%M")))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append((number, name))
+    return applied
+
+
+def collect_model_queries(models_dir=MODELS_DIR):
+    """ Finds all sql queries of models modules. Complete queries are string literals ending with ';'.
+    Queries built at run time (templates completed with str.format, literals joined with +) are taken
+    in every allowed form from query_variants() function of their module.
+    Returns:
+        list(tuple): (file name, line number or name of variant, query), query is None for built queries
+        of modules without query_variants
+    """
+    queries = []
+    for file_name in sorted(os.listdir(models_dir)):
+        if not file_name.endswith('.py'):
+            continue
+        with open(os.path.join(models_dir, file_name)) as source:
+            tree = ast.parse(source.read(), file_name)
+        built = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str) and QUERY_PATTERN.match(node.value):
+                if '{' in node.value or not node.value.rstrip().endswith(';'):
+                    built.append(node.lineno)
+                else:
+                    queries.append((file_name, node.lineno, node.value))
+        if not built:
+            continue
+        module = importlib.import_module('models.' + file_name[:-3])
+        if not hasattr(module, 'query_variants'):
+            queries += [(file_name, line, None) for line in sorted(built)]
+            continue
+        queries += [(file_name, name, query) for name, query in module.query_variants()]
+    return queries
+
+
+def find_table_scans(db, queries=None):
+    """ Runs EXPLAIN QUERY PLAN for every model query and returns those which scan a table.
+    Only queries marked with FULL_SCAN_MARK read the whole table on purpose and are not reported.
+    Full scans of an index are reported too, they grow with table size the same way.
+    Queries which can't be explained (built ones without variants, invalid sql) are reported as well.
+    Returns:
+        list(tuple): (file name, line number or name of variant, query, plan detail)
+    """
+    scans = []
+    tables = set(row[0] for row in db.execute("SELECT `name` FROM `sqlite_master` WHERE `type` = 'table';"))
+    for file_name, line, query in queries if queries is not None else collect_model_queries():
+        if query is None:
+            scans.append((file_name, line, '', 'built query not checked, add it to query_variants()'))
+            continue
+        if FULL_SCAN_MARK in query:
+            continue
+        args = (None, ) * query.count('?')
+        try:
+            plan = db.execute("EXPLAIN QUERY PLAN " + query, args).fetchall()
+        except sqlite3.Error as error:
+            scans.append((file_name, line, ' '.join(query.split()), 'not explained: {}'.format(error)))
+            continue
+        for row in plan:
+            detail = row[-1]
+            # scans of subquery results are bounded by the subquery itself,
+            # virtual tables (full text index) are searched by their own index
+            if detail.startswith('SCAN ') and detail.split()[1] in tables and 'VIRTUAL TABLE' not in detail:
+                scans.append((file_name, line, ' '.join(query.split()), detail))
+    return scans
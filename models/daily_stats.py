@@ -0,0 +1,151 @@
+import datetime
+from common import connection, fan_out, get_db
+from dbhandle import DB
+from sharding import shard_map
+
+
+# Counts events of todo_history rows with ids in (?, ?] and adds them to daily rollups.
+# Event ids: 1 create, 2 remove, 3 archive, 6 status done (see Todo.HISTORY_EVENTS).
+ROLLUP_COLUMNS = """SUM(CASE WHEN `event_id` = 1 THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN `event_id` = 6 THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN `event_id` = 3 THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN `event_id` = 2 THEN 1 ELSE 0 END),
+                    TOTAL(CASE WHEN `event_id` = 6
+                          THEN (julianday(`change_date`) - julianday(`todo_items`.`create_date`)) * 24 END),
+                    SUM(CASE WHEN `event_id` = 6 AND julianday(`change_date`) IS NOT NULL
+                             AND julianday(`todo_items`.`create_date`) IS NOT NULL THEN 1 ELSE 0 END)"""
+ROLLUP_UPSERT = """ON CONFLICT (`user_id`, `day`) DO UPDATE SET
+                   `created` = `created` + excluded.`created`,
+                   `completed` = `completed` + excluded.`completed`,
+                   `archived` = `archived` + excluded.`archived`,
+                   `removed` = `removed` + excluded.`removed`,
+                   `done_hours_total` = `done_hours_total` + excluded.`done_hours_total`,
+                   `done_count` = `done_count` + excluded.`done_count`;"""
+ROLLUP_INSERT = """INSERT INTO `daily_todo_stats`
+                   (`day`, `user_id`, `created`, `completed`, `archived`, `removed`, `done_hours_total`, `done_count`)"""
+USERS_ROLLUP_QUERY = ROLLUP_INSERT + """
+    SELECT substr(`change_date`, 1, 10), `todo_history`.`owner_id`, """ + ROLLUP_COLUMNS + """
+    FROM `todo_history` LEFT JOIN `todo_items` ON `todo_items`.`id` = `todo_history`.`item_id`
+    WHERE `todo_history`.`id` > ? AND `todo_history`.`id` <= ? AND `todo_history`.`owner_id` IS NOT NULL
+    GROUP BY substr(`change_date`, 1, 10), `todo_history`.`owner_id` """ + ROLLUP_UPSERT
+ALL_USERS_ROLLUP_QUERY = ROLLUP_INSERT + """
+    SELECT substr(`change_date`, 1, 10), 0, """ + ROLLUP_COLUMNS + """
+    FROM `todo_history` LEFT JOIN `todo_items` ON `todo_items`.`id` = `todo_history`.`item_id`
+    WHERE `todo_history`.`id` > ? AND `todo_history`.`id` <= ?
+    GROUP BY substr(`change_date`, 1, 10) """ + ROLLUP_UPSERT
+# adds rollups of one day and user given as values, used when statistics are copied to another shard
+ROLLUP_VALUES_QUERY = ROLLUP_INSERT + " VALUES (?, ?, ?, ?, ?, ?, ?, ?) " + ROLLUP_UPSERT
+
+
+class DailyTodoStats:
+    """ Class representing todo events of one user (or of all users for user_id 0) in one day.
+    Rollups are updated incrementally from todo_history rows newer than the last rolled up one,
+    so reading statistics never touches history. Every shard rolls up its own history, statistics
+    of all users are summed from all of them.
+    """
+    ALL_USERS = 0
+    STATE_NAME = 'todo_history'
+
+    def __init__(self, day, user_id, created=0, completed=0, archived=0, removed=0, done_hours_total=0.0,
+                 done_count=0):
+        self.day = day
+        self.user_id = user_id
+        self.created = created
+        self.completed = completed
+        self.archived = archived
+        self.removed = removed
+        self.done_hours_total = done_hours_total
+        self.done_count = done_count
+
+    @property
+    def avg_hours_to_done(self):
+        """average time from creating todo to marking it done, None if no todo was done"""
+        return self.done_hours_total / self.done_count if self.done_count else None
+
+    def add(self, other):
+        self.created += other.created
+        self.completed += other.completed
+        self.archived += other.archived
+        self.removed += other.removed
+        self.done_hours_total += other.done_hours_total
+        self.done_count += other.done_count
+
+    def to_dict(self):
+        return {'day': self.day, 'created': self.created, 'completed': self.completed, 'archived': self.archived,
+                'removed': self.removed, 'avg_hours_to_done': self.avg_hours_to_done}
+
+    @classmethod
+    def get_days(cls, user_id=ALL_USERS, days=30):
+        """ Retrieves daily rollups of user from the last days.
+        Args:
+            user_id(int): user id, ALL_USERS for statistics of all users
+            days(int): number of days, including today
+        Returns:
+            list(DailyTodoStats): days with any events, the oldest first
+        """
+        since = (datetime.date.today() - datetime.timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        query = """SELECT `day`, `user_id`, `created`, `completed`, `archived`, `removed`, `done_hours_total`,
+                          `done_count`
+                   FROM `daily_todo_stats`
+                   WHERE `user_id` = ? AND `day` >= ?
+                   ORDER BY `day`;"""
+        values = (user_id, since)
+        if user_id != cls.ALL_USERS:
+            return [DailyTodoStats(*row) for row in DB.execute_select_query(get_db(user_id), query, values)]
+        days_stats = {}
+        for rows in fan_out(lambda database, db: DB.execute_select_query(db, query, values)):
+            for row in rows:
+                day_stats = DailyTodoStats(*row)
+                if day_stats.day in days_stats:
+                    days_stats[day_stats.day].add(day_stats)
+                else:
+                    days_stats[day_stats.day] = day_stats
+        return [days_stats[day] for day in sorted(days_stats)]
+
+    @classmethod
+    def total(cls, days_stats, user_id=ALL_USERS):
+        """returns sum of daily rollups"""
+        total = DailyTodoStats(None, user_id)
+        for day_stats in days_stats:
+            total.add(day_stats)
+        return total
+
+    @classmethod
+    def rollup(cls, batch_size=5000, database=None):
+        """ Adds todo_history rows newer than the last rolled up one to daily rollups, batch_size
+        rows in one transaction. Writes to todo_history are serialized by the database write lock,
+        so no row with lower id can be committed after a higher one was rolled up.
+        Args:
+            database(str): database file, the main database by default
+        Returns:
+            int: id of the last rolled up history row
+        """
+        db = connection(database or shard_map.catalog)
+        while True:
+            with DB.transaction(db):
+                query = "SELECT `last_id` FROM `stats_rollup_state` WHERE `name` = ?;"
+                state = DB.execute_select_query(db, query, (cls.STATE_NAME, ))
+                last_id = state[0][0] if state else 0
+                query = """SELECT MAX(`id`) FROM (SELECT `id` FROM `todo_history` WHERE `id` > ?
+                                                  ORDER BY `id` LIMIT ?);"""
+                upper_id = DB.execute_select_query(db, query, (last_id, batch_size))[0][0]
+                if upper_id is None:
+                    return last_id
+                DB.execute_update_query(db, USERS_ROLLUP_QUERY, (last_id, upper_id))
+                DB.execute_update_query(db, ALL_USERS_ROLLUP_QUERY, (last_id, upper_id))
+                query = "REPLACE INTO `stats_rollup_state` (`name`, `last_id`) VALUES (?, ?);"
+                DB.execute_update_query(db, query, (cls.STATE_NAME, upper_id))
+
+    @classmethod
+    def rollup_all(cls, batch_size=5000):
+        """ Rolls up history of the main database and every shard.
+        Returns:
+            dict: id of the last rolled up history row by database
+        """
+        return dict((database, cls.rollup(batch_size, database)) for database in shard_map.databases())
+
+
+def query_variants():
+    """rollup queries built from parts, explained by flask check-queries"""
+    return [('USERS_ROLLUP_QUERY', USERS_ROLLUP_QUERY), ('ALL_USERS_ROLLUP_QUERY', ALL_USERS_ROLLUP_QUERY),
+            ('ROLLUP_VALUES_QUERY', ROLLUP_VALUES_QUERY)]
@@ -0,0 +1,55 @@
+import datetime
+from common import connection, get_db
+from dbhandle import DB
+from sharding import shard_map
+
+
+class DataVersion:
+    """ Class representing version of data shown on pages of one user (his profile and todos).
+    Triggers on users and todo_items bump it with every change, so pages built from the same
+    version are the same and can be validated without reading todos. Users are changed in the main
+    database and todos in shard of user, version of user in shard is the sum of both.
+    """
+    def __init__(self, user_id, version=0, modified_date=None):
+        self.user_id = user_id
+        self.version = version
+        self.modified_date = modified_date
+
+    @property
+    def last_modified(self):
+        """time of the last change as UTC datetime, None if data was not changed since versions are kept"""
+        if not self.modified_date:
+            return None
+        return datetime.datetime.strptime(self.modified_date, "%Y-%m-%d %H:%M:%S").replace(
+            tzinfo=datetime.timezone.utc)
+
+    @classmethod
+    def get_by_user_id(cls, user_id):
+        """ Retrieves data version of user with given id from database.
+        Args:
+            user_id(int): user id
+        Returns:
+            DataVersion: version of user data, 0 for user whose data was never changed
+        """
+        query = "SELECT `user_id`, `version`, `modified_date` FROM `user_data_versions` WHERE `user_id` = ?;"
+        values = (user_id, )
+        data_version = DataVersion(user_id)
+        db, user_db = get_db(), get_db(user_id)
+        for db in (db, ) if user_db is db else (db, user_db):
+            for _, version, modified_date in DB.execute_select_query(db, query, values):
+                data_version.version += version
+                data_version.modified_date = max(data_version.modified_date or '', modified_date or '') or None
+        return data_version
+
+    @classmethod
+    def bump_all(cls, database=None):
+        """ Makes pages of all users with data in database (the main one by default) stale,
+        used when their data is changed without triggers
+        """
+        db = connection(database or shard_map.catalog)
+        with DB.transaction(db):
+            query = "/* full scan */ INSERT OR IGNORE INTO `user_data_versions` (`user_id`) SELECT `id` FROM `users`;"
+            DB.execute_update_query(db, query, ())
+            query = "/* full scan */ UPDATE `user_data_versions` SET `version` = `version` + 1, " \
+                    "`modified_date` = strftime('%Y-%m-%d %H:%M:%S', 'now');"
+            DB.execute_update_query(db, query, ())
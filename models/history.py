@@ -0,0 +1,166 @@
+import atexit
+import functools
+import logging
+import os
+import threading
+import time
+from common import connection, get_db_of_id, db_pool_options, after_commit
+from config import BaseConfig
+from dbhandle import DB
+from sharding import shard_map
+
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """ Write-behind writer of todo_history events.
+    Events are kept in memory and inserted in batches by background thread when batch_size
+    events are waiting or flush_interval seconds passed. Events added during request are
+    queued only after request commits its unit of work, so rolled back changes leave no history.
+    In synchronous mode every event is inserted at once in current transaction and flush callbacks
+    run once after it commits, as they do after background thread wrote events.
+    Events are written to database of their todo, known from its id.
+    """
+    query = "INSERT INTO `todo_history` (`item_id`, `change_date`, `event_id`, `owner_id`) VALUES (?, ?, ?, ?);"
+
+    def __init__(self, batch_size=500, flush_interval=2.0, synchronous=False):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.synchronous = synchronous
+        self._events = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        # functions called after some events were written
+        self.flush_callbacks = []
+        self.flushes = 0
+        self.written = 0
+
+    def add(self, item_id, change_date, event_id, owner_id=None):
+        """adds event to history"""
+        event = (item_id, change_date, event_id, owner_id)
+        if self.synchronous:
+            DB.execute_insert_query(get_db_of_id(item_id), self.query, event)
+            after_commit(self._run_flush_callbacks, once=True)
+        else:
+            after_commit(functools.partial(self.enqueue, [event]))
+
+    def add_many(self, events):
+        """adds list of (item id, change date, event id, owner id) events to history"""
+        if not events:
+            return
+        if self.synchronous:
+            for database, database_events in self.by_database(events):
+                DB.execute_update_query(connection(database), self.query, database_events)
+            after_commit(self._run_flush_callbacks, once=True)
+        else:
+            after_commit(functools.partial(self.enqueue, events))
+
+    def enqueue(self, events):
+        with self._condition:
+            self._events.extend(events)
+            if self._thread is None or not self._thread.is_alive():
+                self._start()
+            if len(self._events) >= self.batch_size:
+                self._condition.notify()
+
+    def _start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='history-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.time() + self.flush_interval
+                while not self._stopping and len(self._events) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                stopping = self._stopping
+            try:
+                written = self.flush()
+            except Exception:
+                logger.exception("Writing todo history failed, %d events kept for retry", len(self._events))
+                written = 0
+            if written:
+                self._run_flush_callbacks()
+            if stopping:
+                return
+
+    def _run_flush_callbacks(self):
+        for callback in self.flush_callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Callback after writing todo history failed")
+
+    @classmethod
+    def by_database(cls, events):
+        """returns list of (database, events) of events grouped by database of their todos"""
+        groups = {}
+        for event in events:
+            groups.setdefault(shard_map.database_of_id(event[0]), []).append(event)
+        return list(groups.items())
+
+    def flush(self):
+        """ Inserts all waiting events in batches of batch_size, one transaction per batch and database.
+        Returns:
+            int: number of written events
+        """
+        written = 0
+        while True:
+            with self._condition:
+                batch = self._events[:self.batch_size]
+                del self._events[:self.batch_size]
+            if not batch:
+                return written
+            groups = self.by_database(batch)
+            for number, (database, events) in enumerate(groups):
+                db = DB.acquire(database, **db_pool_options())
+                try:
+                    with DB.transaction(db):
+                        DB.execute_update_query(db, self.query, events)
+                except Exception:
+                    # events of databases already written are not retried
+                    with self._condition:
+                        self._events[:0] = [event for _, unwritten in groups[number:] for event in unwritten]
+                    raise
+                finally:
+                    DB.release(database, db)
+                written += len(events)
+                self.written += len(events)
+            self.flushes += 1
+
+    def stop(self):
+        """writes all waiting events and stops background thread"""
+        with self._condition:
+            thread = self._thread
+            self._stopping = True
+            self._condition.notify()
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self.flush()
+
+    def forget_events(self):
+        """ Drops state inherited by forked process: events are written by parent process
+        and its thread doesn't run in the child.
+        """
+        self._events = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def stats(self):
+        with self._condition:
+            return {'waiting': len(self._events), 'flushes': self.flushes, 'written': self.written}
+
+
+history_writer = HistoryWriter(batch_size=BaseConfig.HISTORY_BATCH_SIZE,
+                               flush_interval=BaseConfig.HISTORY_FLUSH_INTERVAL,
+                               synchronous=BaseConfig.HISTORY_SYNCHRONOUS)
+atexit.register(history_writer.stop)
+os.register_at_fork(after_in_child=history_writer.forget_events)
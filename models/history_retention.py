@@ -0,0 +1,191 @@
+import csv
+import datetime
+import gzip
+import logging
+import os
+import tempfile
+import time
+from common import connection
+from dbhandle import DB
+from models.daily_stats import DailyTodoStats
+from sharding import shard_map
+
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_COLUMNS = ('id', 'item_id', 'change_date', 'event_id', 'owner_id')
+# adds events of todo_history rows with ids in [?, ?] older than cutoff to per-todo summaries,
+# event ids as in Todo.HISTORY_EVENTS
+SUMMARY_QUERY = """INSERT INTO `todo_history_summary`
+                   (`item_id`, `owner_id`, `first_change`, `last_change`, `events`, `created`, `removed`, `archived`,
+                    `activated`, `updated`, `done`, `undone`)
+                   SELECT `item_id`, MAX(`owner_id`), MIN(`change_date`), MAX(`change_date`), COUNT(*),
+                          SUM(CASE WHEN `event_id` = 1 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 2 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 3 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 4 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 5 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 6 THEN 1 ELSE 0 END),
+                          SUM(CASE WHEN `event_id` = 7 THEN 1 ELSE 0 END)
+                   FROM `todo_history`
+                   WHERE `id` >= ? AND `id` <= ? AND `change_date` < ?
+                   GROUP BY `item_id`
+                   ON CONFLICT (`item_id`) DO UPDATE SET
+                   `owner_id` = COALESCE(excluded.`owner_id`, `owner_id`),
+                   `first_change` = MIN(`first_change`, excluded.`first_change`),
+                   `last_change` = MAX(`last_change`, excluded.`last_change`),
+                   `events` = `events` + excluded.`events`,
+                   `created` = `created` + excluded.`created`,
+                   `removed` = `removed` + excluded.`removed`,
+                   `archived` = `archived` + excluded.`archived`,
+                   `activated` = `activated` + excluded.`activated`,
+                   `updated` = `updated` + excluded.`updated`,
+                   `done` = `done` + excluded.`done`,
+                   `undone` = `undone` + excluded.`undone`;"""
+
+
+class HistoryRetention:
+    """ Retention policy of todo_history: rows older than retention days are written to gzipped csv
+    archive file, counted in todo_history_summary and deleted.
+    Only rows already added to daily statistics are expired. Every archive is recorded in history_archives
+    before its rows are deleted, so interrupted run is finished by the next one. Rows are deleted
+    batch_size at once, each batch in its own short transaction followed by a pause, so requests
+    and history writer are not kept waiting for the write lock.
+    Every shard keeps its own history, retention runs for one database (the main one by default).
+    History ids are unique across shards, so archive file names are too.
+    """
+    def __init__(self, archive_dir, days=365, batch_size=1000, pause=0.05, database=None):
+        self.database = database or shard_map.catalog
+        self.archive_dir = archive_dir
+        self.days = days
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def cutoff_date(self):
+        """history rows changed before this date are expired"""
+        return (datetime.date.today() - datetime.timedelta(days=self.days)).strftime("%Y-%m-%d")
+
+    def run(self):
+        """ Archives, summarizes and deletes expired history rows, then frees unused pages of database file.
+        Returns:
+            list(dict): archives of this run as {'file_name', 'rows', 'deleted'}
+        """
+        db = connection(self.database)
+        done = [self.delete_archived(archive) for archive in self.pending_archives()]
+        # rows not counted in daily statistics yet have to stay
+        rolled_up_id = DailyTodoStats.rollup(database=self.database)
+        archive = self.export(self.cutoff_date(), rolled_up_id)
+        if archive is not None:
+            done.append(self.delete_archived(archive))
+        if done:
+            self.incremental_vacuum(db)
+        return done
+
+    def pending_archives(self):
+        """returns archives written to file but with rows not deleted yet (interrupted run)"""
+        # one row per retention run
+        query = """/* full scan */ SELECT `id`, `file_name`, `first_id`, `last_id`, `cutoff_date`, `rows`
+                   FROM `history_archives`
+                   WHERE `deleted` = 0;"""
+        return [dict(zip(('id', 'file_name', 'first_id', 'last_id', 'cutoff_date', 'rows'), row))
+                for row in DB.execute_select_query(connection(self.database), query)]
+
+    def export(self, cutoff_date, max_id):
+        """ Writes history rows changed before cutoff_date with ids up to max_id to new archive file
+        and records it. File is written under temporary name and renamed when complete.
+        Returns:
+            dict: recorded archive, None if no row is expired
+        """
+        db = connection(self.database)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        # unique name, runs on other databases (shards) or hosts can write to the same directory at once
+        temp_fd, temp_path = tempfile.mkstemp(suffix='.csv.gz.tmp', prefix='todo_history_', dir=self.archive_dir)
+        query = """/* full scan */ SELECT `id`, `item_id`, `change_date`, `event_id`, `owner_id` FROM `todo_history`
+                   WHERE `id` <= ? AND `change_date` < ?
+                   ORDER BY `id`;"""
+        first_id = last_id = None
+        rows = 0
+        try:
+            with os.fdopen(temp_fd, 'wb') as temp_file, gzip.open(temp_file, 'wt', newline='') as archive_file:
+                writer = csv.writer(archive_file)
+                writer.writerow(ARCHIVE_COLUMNS)
+                for row in DB.iter_select_query(db, query, (max_id, cutoff_date)):
+                    writer.writerow(row)
+                    first_id = row[0] if first_id is None else first_id
+                    last_id = row[0]
+                    rows += 1
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        if not rows:
+            os.remove(temp_path)
+            return None
+        file_name = 'todo_history_{:010d}-{:010d}.csv.gz'.format(first_id, last_id)
+        os.replace(temp_path, os.path.join(self.archive_dir, file_name))
+        query = """INSERT INTO `history_archives` (`file_name`, `first_id`, `last_id`, `cutoff_date`, `rows`,
+                                                   `archived_date`)
+                   VALUES (?, ?, ?, ?, ?, ?);"""
+        with DB.transaction(db):
+            archive_id = DB.execute_insert_query(db, query, (file_name, first_id, last_id, cutoff_date, rows,
+                                                             time.strftime("%Y-%m-%d %H:%M")))
+        logger.info("history_archived file=%s rows=%d first_id=%d last_id=%d", file_name, rows, first_id, last_id)
+        return {'id': archive_id, 'file_name': file_name, 'first_id': first_id, 'last_id': last_id,
+                'cutoff_date': cutoff_date, 'rows': rows}
+
+    def delete_archived(self, archive):
+        """ Adds archived rows to summaries and deletes them, batch_size rows in one transaction.
+        History rows never change, so rows of the archive are exactly those with ids in its range
+        changed before its cutoff date.
+        Returns:
+            dict: {'file_name', 'rows', 'deleted'}
+        """
+        db = connection(self.database)
+        deleted = 0
+        lower_id = archive['first_id']
+        while lower_id <= archive['last_id']:
+            with DB.transaction(db):
+                query = """SELECT MAX(`id`) FROM (SELECT `id` FROM `todo_history`
+                                                  WHERE `id` >= ? AND `id` <= ? AND `change_date` < ?
+                                                  ORDER BY `id` LIMIT ?);"""
+                upper_id = DB.execute_select_query(db, query, (lower_id, archive['last_id'], archive['cutoff_date'],
+                                                               self.batch_size))[0][0]
+                if upper_id is None:
+                    break
+                values = (lower_id, upper_id, archive['cutoff_date'])
+                DB.execute_update_query(db, SUMMARY_QUERY, values)
+                query = "DELETE FROM `todo_history` WHERE `id` >= ? AND `id` <= ? AND `change_date` < ?;"
+                deleted += DB.execute_delete_query(db, query, values)
+            lower_id = upper_id + 1
+            time.sleep(self.pause)
+        query = "UPDATE `history_archives` SET `deleted` = 1 WHERE `id` = ?;"
+        DB.execute_update_query(db, query, (archive['id'], ))
+        logger.info("history_deleted file=%s rows=%d", archive['file_name'], deleted)
+        return {'file_name': archive['file_name'], 'rows': archive['rows'], 'deleted': deleted}
+
+    @classmethod
+    def incremental_vacuum(cls, db):
+        """ Returns free pages to the file system when database uses incremental auto vacuum.
+        Returns:
+            bool: False if auto vacuum is not incremental (see enable_incremental_vacuum)
+        """
+        if db.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2:
+            logger.warning("history_vacuum_skipped reason=%r", 'auto_vacuum is not incremental')
+            return False
+        db.execute("PRAGMA incremental_vacuum;").fetchall()
+        return True
+
+    @classmethod
+    def enable_incremental_vacuum(cls, db):
+        """switches database to incremental auto vacuum, needs full vacuum rewriting the whole file once"""
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        db.execute("VACUUM;")
+
+    @classmethod
+    def read_archive(cls, path):
+        """ Reads rows of archive file, for looking into expired history offline.
+        Returns:
+            iterator(dict): rows with ARCHIVE_COLUMNS keys
+        """
+        with gzip.open(path, 'rt', newline='') as archive_file:
+            for row in csv.DictReader(archive_file):
+                yield row
@@ -0,0 +1,293 @@
+import logging
+import time
+from common import connection, fan_out, get_db
+from dbhandle import DB
+from models.daily_stats import DailyTodoStats, ROLLUP_VALUES_QUERY
+from models.todo import Todo
+from models.user_deletion import UserDeletion
+from sharding import shard_map, first_id, MAIN_DATABASE, SHARD_ID_RANGE
+
+
+logger = logging.getLogger(__name__)
+
+PLACEMENT_QUERY = "SELECT `shard`, `moving_to` FROM `user_shards` WHERE `user_id` = ?;"
+MARK_QUERY = """INSERT INTO `user_shards` (`user_id`, `shard`, `moving_to`) VALUES (?, ?, ?)
+                ON CONFLICT (`user_id`) DO UPDATE SET `moving_to` = excluded.`moving_to`;"""
+SWITCH_QUERY = "UPDATE `user_shards` SET `shard` = ?, `moving_to` = NULL WHERE `user_id` = ?;"
+TODOS_QUERY = """SELECT `id`, `name`, `status`, `create_date`, `owner_id`, `is_archived`, `archive_date`, `due_date`,
+                        `priority`, `description`
+                 FROM `todo_items`
+                 WHERE `owner_id` = ? AND `id` > ?
+                 ORDER BY `id` LIMIT ?;"""
+INSERT_TODOS_QUERY = """INSERT INTO `todo_items` (`name`, `status`, `create_date`, `owner_id`, `is_archived`,
+                                                  `archive_date`, `due_date`, `priority`, `description`)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+# history rows written before owner was kept with events
+HISTORY_OWNER_QUERY = """UPDATE `todo_history` SET `owner_id` = ?
+                         WHERE `owner_id` IS NULL AND `item_id` IN (SELECT `id` FROM `todo_items` WHERE `owner_id` = ?);"""
+HISTORY_QUERY = """SELECT `id`, `item_id`, `change_date`, `event_id` FROM `todo_history`
+                   WHERE `owner_id` = ? AND `id` > ?
+                   ORDER BY `id` LIMIT ?;"""
+INSERT_HISTORY_QUERY = """INSERT INTO `todo_history` (`item_id`, `change_date`, `event_id`, `owner_id`)
+                          VALUES (?, ?, ?, ?);"""
+SUMMARY_COLUMNS = ('item_id', 'owner_id', 'first_change', 'last_change', 'events', 'created', 'removed', 'archived',
+                   'activated', 'updated', 'done', 'undone')
+DAILY_COLUMNS = ('day', 'user_id', 'created', 'completed', 'archived', 'removed', 'done_hours_total', 'done_count')
+SUMMARY_QUERY = "SELECT {} FROM `todo_history_summary` WHERE `owner_id` = ?;".format(
+    ', '.join('`{}`'.format(column) for column in SUMMARY_COLUMNS))
+INSERT_SUMMARY_QUERY = "INSERT OR REPLACE INTO `todo_history_summary` ({}) VALUES ({});".format(
+    ', '.join('`{}`'.format(column) for column in SUMMARY_COLUMNS), ', '.join('?' * len(SUMMARY_COLUMNS)))
+DAILY_QUERY = "SELECT {} FROM `daily_todo_stats` WHERE `user_id` = ?;".format(
+    ', '.join('`{}`'.format(column) for column in DAILY_COLUMNS))
+# old ids of copied rows mapped to new ones, in the main database
+MOVED_IDS_QUERY = """INSERT OR REPLACE INTO `moved_ids` (`table_name`, `old_id`, `new_id`, `owner_id`)
+                     VALUES (?, ?, ?, ?);"""
+# ids of rows of aborted move, from ids of user rows still in source ([?, ?) range of source shard)
+ABORT_MOVED_IDS_QUERY = """DELETE FROM `moved_ids`
+                           WHERE `owner_id` = ? AND `table_name` = ? AND `old_id` >= ? AND `old_id` < ?;"""
+COUNT_QUERIES = ("SELECT COUNT(*) FROM `todo_items` WHERE `owner_id` = ?;",
+                 "SELECT COUNT(*) FROM `todo_history` WHERE `owner_id` = ?;")
+
+
+class ShardMove:
+    """ Moves todos, todo history and statistics of users to another shard while application runs.
+    1. Users are marked as moving: their data can be read, writes fail with ShardMoving (answered with 503
+       and retried by clients). After grace period no process writes it: placements are cached for
+       SHARD_MAP_TTL seconds and history writer flushes every HISTORY_FLUSH_INTERVAL.
+    2. Rows are copied to target shard batch_size at once, each batch in its own short transaction, so other
+       users of both shards wait for the write lock only shortly. Todos get ids from range of target shard,
+       copied history and summaries refer to the new ids. Old ids of todos and history rows are mapped
+       to new ones in moved_ids table of the main database, so links and export positions keep working.
+       Rows left in target by interrupted move are deleted first, so move can be simply run again.
+    3. Row counts are compared and users are switched to target. After another grace period nobody reads
+       the source and user rows are deleted from it in batches.
+    """
+    def __init__(self, batch_size=500, grace=10.0, pause=0.05):
+        self.batch_size = batch_size
+        self.grace = grace
+        self.pause = pause
+
+    @classmethod
+    def placement(cls, user_id):
+        """(shard, moving_to) of user read from the main database, not from cache"""
+        rows = DB.execute_select_query(get_db(), PLACEMENT_QUERY, (user_id, ))
+        return tuple(rows[0]) if rows else (MAIN_DATABASE, None)
+
+    def move(self, user_id, target):
+        """ Moves data of user to shard with index target (MAIN_DATABASE for the main database).
+        Returns:
+            dict: {'user_id', 'source', 'target', 'todos', 'history', 'deleted'}
+        """
+        return self.move_many([(user_id, target)])[0]
+
+    def move_many(self, moves):
+        """ Moves data of users, given as list of (user id, target shard), waiting grace periods once for all.
+        Returns:
+            list(dict): {'user_id', 'source', 'target', 'todos', 'history', 'deleted'} of every move
+        """
+        shard_map.database(MAIN_DATABASE)
+        results = []
+        for user_id, target in moves:
+            shard_map.database(target)
+            source, moving_to = self.placement(user_id)
+            if moving_to is not None and moving_to != target:
+                raise ValueError("User {} is being moved to shard {}, abort it first".format(user_id, moving_to))
+            results.append({'user_id': user_id, 'source': source, 'target': target, 'todos': 0, 'history': 0,
+                            'deleted': 0})
+        results = [result for result in results if result['source'] != result['target']]
+        if not results:
+            return []
+        db = get_db()
+        with DB.transaction(db):
+            for result in results:
+                DB.execute_update_query(db, MARK_QUERY, (result['user_id'], result['source'], result['target']))
+        time.sleep(self.grace)
+        for result in results:
+            result['todos'], result['history'] = self.copy(result['user_id'], shard_map.database(result['source']),
+                                                           shard_map.database(result['target']))
+            with DB.transaction(db):
+                DB.execute_update_query(db, SWITCH_QUERY, (result['target'], result['user_id']))
+            shard_map.forget(result['user_id'])
+            logger.info("user_shard_switched user_id=%d source=%d target=%d todos=%d history=%d", result['user_id'],
+                        result['source'], result['target'], result['todos'], result['history'])
+        time.sleep(self.grace)
+        deletion = UserDeletion(self.batch_size, self.pause)
+        for result in results:
+            result['deleted'] = deletion.delete_rows(result['user_id'], shard_map.database(result['source']))
+        return results
+
+    def copy(self, user_id, source, target):
+        """ Copies rows of user from source database to target one, user must not be written meanwhile.
+        Returns:
+            tuple(int, int): number of copied todos and history rows
+        """
+        source_db, target_db, catalog_db = connection(source), connection(target), get_db()
+        UserDeletion(self.batch_size, self.pause).delete_rows(user_id, target)
+        # statistics of source count all its history, target counts only history written to it
+        DailyTodoStats.rollup(database=source)
+        with DB.transaction(source_db):
+            DB.execute_update_query(source_db, HISTORY_OWNER_QUERY, (user_id, user_id))
+        new_ids = {}
+        last_id = 0
+        while True:
+            rows = DB.execute_select_query(source_db, TODOS_QUERY, (user_id, last_id, self.batch_size))
+            if not rows:
+                break
+            with DB.transaction(target_db):
+                max_id = DB.execute_select_query(target_db, "SELECT MAX(`id`) FROM `todo_items`;")[0][0] or 0
+                DB.execute_update_query(target_db, INSERT_TODOS_QUERY, [row[1:] for row in rows])
+                query = "SELECT `id` FROM `todo_items` WHERE `owner_id` = ? AND `id` > ? ORDER BY `id`;"
+                ids = [row[0] for row in DB.execute_select_query(target_db, query, (user_id, max_id))]
+            self.save_moved_ids(catalog_db, 'todo_items', user_id, [row[0] for row in rows], ids)
+            new_ids.update(zip([row[0] for row in rows], ids))
+            last_id = rows[-1][0]
+            time.sleep(self.pause)
+        history = 0
+        last_id = 0
+        while True:
+            rows = DB.execute_select_query(source_db, HISTORY_QUERY, (user_id, last_id, self.batch_size))
+            if not rows:
+                break
+            with DB.transaction(target_db):
+                # copied events are counted in statistics of source already, rolled up position of target
+                # is moved past them, the write lock keeps other rows from being written in between
+                DailyTodoStats.rollup(database=target)
+                max_id = DB.execute_select_query(target_db, "SELECT MAX(`id`) FROM `todo_history`;")[0][0] or 0
+                DB.execute_update_query(target_db, INSERT_HISTORY_QUERY,
+                                        [(new_ids.get(item_id, item_id), change_date, event_id, user_id)
+                                         for _, item_id, change_date, event_id in rows])
+                query = "SELECT `id` FROM `todo_history` WHERE `owner_id` = ? AND `id` > ? ORDER BY `id`;"
+                ids = [row[0] for row in DB.execute_select_query(target_db, query, (user_id, max_id))]
+                query = "REPLACE INTO `stats_rollup_state` (`name`, `last_id`) SELECT ?, MAX(`id`) FROM `todo_history`;"
+                DB.execute_update_query(target_db, query, (DailyTodoStats.STATE_NAME, ))
+            self.save_moved_ids(catalog_db, 'todo_history', user_id, [row[0] for row in rows], ids)
+            history += len(rows)
+            last_id = rows[-1][0]
+            time.sleep(self.pause)
+        with DB.transaction(target_db):
+            self.copy_user_rows(user_id, source_db, target_db, new_ids)
+        for query in COUNT_QUERIES:
+            source_count = DB.execute_select_query(source_db, query, (user_id, ))[0][0]
+            target_count = DB.execute_select_query(target_db, query, (user_id, ))[0][0]
+            if source_count != target_count:
+                raise RuntimeError("Copy of user {} is incomplete ({} of {} rows: {}), run the move again".format(
+                    user_id, target_count, source_count, query))
+        return len(new_ids), history
+
+    @classmethod
+    def save_moved_ids(cls, db, table, user_id, old_ids, new_ids):
+        """ Maps old ids of rows copied in one batch to new ones, both in order of id. Rows copied by
+        interrupted move are mapped again by the next one.
+        """
+        with DB.transaction(db):
+            DB.execute_update_query(db, MOVED_IDS_QUERY, [(table, old_id, new_id, user_id)
+                                                          for old_id, new_id in zip(old_ids, new_ids)])
+
+    @classmethod
+    def copy_user_rows(cls, user_id, source_db, target_db, new_ids):
+        """copies history summaries, daily statistics and data version of user"""
+        rows = [(new_ids.get(row[0], row[0]), ) + tuple(row[1:])
+                for row in DB.execute_select_query(source_db, SUMMARY_QUERY, (user_id, ))]
+        if rows:
+            DB.execute_update_query(target_db, INSERT_SUMMARY_QUERY, rows)
+        rows = DB.execute_select_query(source_db, DAILY_QUERY, (user_id, ))
+        if rows:
+            DB.execute_update_query(target_db, ROLLUP_VALUES_QUERY, rows)
+        # pages validated by version from source must not match pages built from target
+        query = "SELECT `version` FROM `user_data_versions` WHERE `user_id` = ?;"
+        versions = [DB.execute_select_query(db, query, (user_id, )) for db in (source_db, target_db)]
+        query = """INSERT OR REPLACE INTO `user_data_versions` (`user_id`, `version`, `modified_date`)
+                   VALUES (?, ?, strftime('%Y-%m-%d %H:%M:%S', 'now'));"""
+        DB.execute_update_query(target_db, query, (user_id, sum(rows[0][0] for rows in versions if rows) + 1))
+
+    def abort(self, user_id):
+        """ Stops interrupted move of user: deletes rows copied to target and allows writes again.
+        Returns:
+            int: number of deleted rows
+        """
+        source, moving_to = self.placement(user_id)
+        if moving_to is None:
+            return 0
+        deleted = UserDeletion(self.batch_size, self.pause).delete_rows(user_id, shard_map.database(moving_to))
+        source_db, db = connection(shard_map.database(source)), get_db()
+        with DB.transaction(db):
+            # rows copied by the move are the ones still in source, older ids of its range moved before
+            for table in Todo.EXPORT_TABLES:
+                query = Todo.FIRST_ROW_QUERY.format(table=table)
+                first_row_id = DB.execute_select_query(source_db, query, (user_id, ))[0][0]
+                if first_row_id is not None:
+                    values = (user_id, table, first_row_id, first_id(source) + SHARD_ID_RANGE)
+                    DB.execute_delete_query(db, ABORT_MOVED_IDS_QUERY, values)
+            DB.execute_update_query(db, SWITCH_QUERY, (source, user_id))
+        shard_map.forget(user_id)
+        return deleted
+
+
+class ShardRebalancer:
+    """ Plans moves evening out number of todos and users in shards: users still kept in the main database
+    are moved to the least loaded shards first, then users of the most loaded shard whose todos
+    get the loads closest together are moved to the least loaded one, up to max_moves users.
+    """
+    # todos of users placed in database, stale copies of moved users are left out
+    LOADS_QUERY = """/* full scan */ SELECT `user_id`, `active_count` + `archived_count` FROM `user_todo_stats`;"""
+
+    def __init__(self, max_moves=20):
+        self.max_moves = max_moves
+
+    @classmethod
+    def loads(cls):
+        """ Reads number of todos of every user in every database, all at once.
+        Returns:
+            dict: {shard: {user id: number of todos}} with users placed in shard, MAIN_DATABASE included
+        """
+        query = "/* full scan */ SELECT `user_id`, `shard` FROM `user_shards`;"
+        placements = dict(DB.execute_select_query(get_db(), query))
+        query = "/* full scan */ SELECT `id` FROM `users`;"
+        user_ids = [row[0] for row in DB.execute_select_query(get_db(), query)]
+        shards = [MAIN_DATABASE] + list(range(len(shard_map.shards)))
+        todos = fan_out(lambda database, db: dict(DB.execute_select_query(db, cls.LOADS_QUERY)))
+        loads = dict((shard, {}) for shard in shards)
+        for user_id in user_ids:
+            shard = placements.get(user_id, MAIN_DATABASE)
+            loads[shard][user_id] = todos[shards.index(shard)].get(user_id, 0)
+        return loads
+
+    def plan(self, loads=None):
+        """ Returns:
+            list(tuple): moves as (user id, source shard, target shard, number of todos)
+        """
+        loads = self.loads() if loads is None else loads
+        if not shard_map.shards:
+            return []
+        # every user weighs one todo more than they have, so users without todos are spread too
+        totals = dict((shard, sum(users.values()) + len(users)) for shard, users in loads.items()
+                      if shard != MAIN_DATABASE)
+        moves = []
+        for user_id, todos in sorted(loads[MAIN_DATABASE].items(), key=lambda item: (-item[1], item[0])):
+            if len(moves) >= self.max_moves:
+                return moves
+            target = min(totals, key=lambda shard: (totals[shard], shard))
+            moves.append((user_id, MAIN_DATABASE, target, todos))
+            totals[target] += todos + 1
+        moved = set(move[0] for move in moves)
+        while len(moves) < self.max_moves:
+            source = max(totals, key=lambda shard: (totals[shard], -shard))
+            target = min(totals, key=lambda shard: (totals[shard], shard))
+            difference = totals[source] - totals[target]
+            candidates = [(user_id, todos) for user_id, todos in loads[source].items()
+                          if user_id not in moved and todos + 1 < difference]
+            if not candidates:
+                return moves
+            # the move leaving both shards closest to each other
+            user_id, todos = min(candidates, key=lambda item: (abs(difference - 2 * (item[1] + 1)), item[0]))
+            moves.append((user_id, source, target, todos))
+            moved.add(user_id)
+            totals[source] -= todos + 1
+            totals[target] += todos + 1
+        return moves
+
+
+def query_variants():
+    """queries with column lists, explained by flask check-queries"""
+    return [('SUMMARY_QUERY', SUMMARY_QUERY), ('INSERT_SUMMARY_QUERY', INSERT_SUMMARY_QUERY),
+            ('DAILY_QUERY', DAILY_QUERY)]
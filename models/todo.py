@@ -1,10 +1,47 @@
+import datetime
+import re
 import time
 from dbhandle import DB
-from common import get_db
+from common import get_db, get_db_of_id, MATCH_START, MATCH_END
+from models.history import history_writer
+from sharding import shard_map
 
 
 class Todo:
     """ Class representing todo item."""
+    # no per instance __dict__, lists of todos are the biggest collections of objects in the app
+    __slots__ = ('id', 'name', 'status', 'create_date', 'priority', 'due_date', 'is_archived', 'owner_id',
+                 'description')
+    # columns todo lists can be sorted by in database, each has index with owner_id and is_archived
+    SORT_COLUMNS = ('name', 'priority', 'due_date', 'create_date', 'status')
+    # number of description characters read for todo lists, full text is read for single todo only
+    DESCRIPTION_PREVIEW = 200
+    # public data of todo item
+    FIELDS = ('id', 'name', 'status', 'create_date', 'priority', 'due_date', 'is_archived', 'owner_id',
+              'description')
+    # exported todo history data
+    HISTORY_FIELDS = ('id', 'item_id', 'change_date', 'event')
+    # ids of events table rows
+    HISTORY_EVENTS = {'create': 1, 'remove': 2, 'archive': 3, 'activate': 4, 'update': 5,
+                      'status done': 6, 'status undone': 7}
+    # maximum number of ids bound in one IN (...) condition
+    IDS_CHUNK_SIZE = 500
+    # maximum number of full text matches ranked by relevance in one search
+    RANKED_MATCHES = 1000
+    # forms of keyset condition of todo page: first page, after todo without and with sort value
+    PAGE_AFTER_KINDS = (None, 'null', 'value')
+    # extra conditions of _owned_rows
+    ACTIVE_CONDITION = "AND `is_archived` = 0"
+    ACTIVE_DONE_CONDITION = "AND `is_archived` = 0 AND `status` = 1"
+    OWNED_ROWS_QUERY = "SELECT `id`, `status` FROM `todo_items` WHERE `owner_id` = ? AND `id` IN ({ids}) {condition};"
+    ARCHIVE_MANY_QUERY = "UPDATE `todo_items` SET `is_archived` = 1, `archive_date` = ? " \
+                         "WHERE `owner_id` = ? AND `id` IN ({ids});"
+    TOGGLE_MANY_QUERY = "UPDATE `todo_items` SET `status` = CASE WHEN `status` = 0 THEN 1 ELSE 0 END " \
+                        "WHERE `owner_id` = ? AND `id` IN ({ids});"
+    DELETE_MANY_QUERY = "DELETE FROM `todo_items` WHERE `owner_id` = ? AND `id` IN ({ids});"
+    # the lowest id of user rows in todo_items or todo_history
+    FIRST_ROW_QUERY = "SELECT MIN(`id`) FROM `{table}` WHERE `owner_id` = ?;"
+    EXPORT_TABLES = ('todo_items', 'todo_history')
 
     def __init__(self, name, id_=None, status=0, create_date=None, priority=0, due_date=None, owner_id=None,
                  is_archived=False, description=None):
@@ -19,32 +56,188 @@ class Todo:
         self.description = description
 
     @classmethod
-    def get_all(cls, user_id, is_archived=False):
+    def validation_error(cls, name, priority, due_date):
+        """ Checks data of new todo item.
+        Args:
+            name(str): item name, can't be empty
+            priority(int|str): from 1 to 5
+            due_date(str): YYYY-MM-DD date, current or future, or None
+        Returns:
+            str: description of the first problem or None if data is valid
+        """
+        if not name:
+            return 'Name is required'
+        try:
+            if not 1 <= int(priority) <= 5:
+                return 'Priority should be from 1 to 5'
+        except (TypeError, ValueError):
+            return 'Priority should be from 1 to 5'
+        if due_date:
+            try:
+                year, month, day = list(map(lambda x: int(x), due_date.split('-')))
+                date = datetime.date(year, month, day)
+            except (AttributeError, ValueError):
+                return 'Date should have YYYY-MM-DD format'
+            if date < datetime.date.today():
+                return 'Date should be current or future'
+        return None
+
+    def row_version(self):
+        """values of all public fields, todos with equal versions look the same on every page"""
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+    def to_dict(self, fields=None):
+        """returns todo data as dict, only with given fields if they are provided"""
+        return dict((field, getattr(self, field)) for field in (fields or self.FIELDS))
+
+    @classmethod
+    def get_all(cls, user_id, is_archived=False, with_description=True):
         """ Retrieves all Todos form database and returns them as list.
         Returns:
             list(Todo): list of all todos
         """
-        db = get_db()
-        todo_list = []
-        query = "SELECT `name`, `id`, `status`, `create_date`, " \
-                "`priority`, `due_date`, `owner_id`, `is_archived`, `description` " \
-                "FROM `todo_items` " \
-                "WHERE `is_archived` = ? AND `owner_id` = ? ORDER BY create_date DESC;"
+        return list(cls.iter_all(user_id, is_archived, with_description))
+
+    @classmethod
+    def iter_all(cls, user_id, is_archived=False, with_description=True, batch_size=500):
+        """ Retrieves all Todos form database one by one, reading batch_size rows at once,
+        so whole list is never kept in memory.
+        Args:
+            with_description(bool): if False description is not read and is None
+        Returns:
+            generator(Todo): todos of user
+        """
+        db = get_db(user_id)
+        if with_description:
+            query = "SELECT `name`, `id`, `status`, `create_date`, " \
+                    "`priority`, `due_date`, `owner_id`, `is_archived`, `description` " \
+                    "FROM `todo_items` " \
+                    "WHERE `is_archived` = ? AND `owner_id` = ? ORDER BY create_date DESC;"
+        else:
+            query = "SELECT `name`, `id`, `status`, `create_date`, " \
+                    "`priority`, `due_date`, `owner_id`, `is_archived`, NULL " \
+                    "FROM `todo_items` " \
+                    "WHERE `is_archived` = ? AND `owner_id` = ? ORDER BY create_date DESC;"
         values = (int(is_archived), user_id)
-        todo_items_from_db = DB.execute_select_query(db, query, values)
-        for item in todo_items_from_db:
-            todo_list.append(Todo(*item))
-        return todo_list
+        for item in DB.iter_select_query(db, query, values, batch_size):
+            yield Todo(*item)
+
+    @classmethod
+    def iter_export(cls, user_id, after=0, batch_size=500):
+        """ Retrieves all todos of user, archived ones too, in order of id, reading batch_size rows at once.
+        Args:
+            after(int): only todos with greater id are read, id of the last exported todo resumes export
+                        (also one from before user was moved to another shard)
+        Returns:
+            generator(tuple): values of FIELDS
+        """
+        after = cls.export_position('todo_items', user_id, after)
+        db = get_db(user_id)
+        query = """SELECT `id`, `name`, `status`, `create_date`, `priority`, `due_date`, `is_archived`, `owner_id`,
+                          `description`
+                   FROM `todo_items`
+                   WHERE `owner_id` = ? AND `id` > ?
+                   ORDER BY `id`;"""
+        return DB.iter_select_query(db, query, (user_id, after), batch_size)
+
+    @classmethod
+    def iter_history_export(cls, user_id, after=0, batch_size=500):
+        """ Retrieves history of all todos of user, removed ones too, in order of id.
+        Args:
+            after(int): only events with greater id are read (id from before user was moved to another
+                        shard too)
+        Returns:
+            generator(tuple): values of HISTORY_FIELDS, with event name
+        """
+        after = cls.export_position('todo_history', user_id, after)
+        db = get_db(user_id)
+        events = dict((event_id, event) for event, event_id in cls.HISTORY_EVENTS.items())
+        query = """SELECT `id`, `item_id`, `change_date`, `event_id` FROM `todo_history`
+                   WHERE `owner_id` = ? AND `id` > ?
+                   ORDER BY `id`;"""
+        for id_, item_id, change_date, event_id in DB.iter_select_query(db, query, (user_id, after), batch_size):
+            yield id_, item_id, change_date, events.get(event_id, event_id)
+
+    @classmethod
+    def get_page(cls, user_id, is_archived=False, sort_column='create_date', is_desc=False, after=None,
+                 limit=50):
+        """ Retrieves one page of user todos sorted in database (keyset pagination).
+        Rows with equal sort value are ordered by id, NULL values come first in ascending order
+        and last in descending one. Only first DESCRIPTION_PREVIEW characters of description are read.
+        Args:
+            user_id(int): owner id
+            is_archived(bool): archived or active todos
+            sort_column(str): one of SORT_COLUMNS
+            is_desc(bool): descending order
+            after(Todo): last todo from previous page, first page if None
+            limit(int): maximum number of todos on page
+        Returns:
+            tuple(list(Todo), bool): todos on page and information if there is next page
+        """
+        if sort_column not in cls.SORT_COLUMNS:
+            raise ValueError("Can't sort todos by {}".format(sort_column))
+        db = get_db(user_id)
+        values = [user_id, int(is_archived)]
+        after_kind = None
+        if after is not None:
+            after_value = getattr(after, sort_column)
+            after_kind = 'null' if after_value is None else 'value'
+            values += [after.id] if after_value is None else [after_value, after.id]
+            if (after_value is None) != is_desc:
+                # the other kind of values follows in the second select
+                values += [user_id, int(is_archived)]
+        query = cls.page_query(sort_column, is_desc, after_kind)
+        values.append(limit + 1)
+        todo_items_from_db = DB.execute_select_query(db, query, tuple(values))
+        return [Todo(*item) for item in todo_items_from_db[:limit]], len(todo_items_from_db) > limit
+
+    @classmethod
+    def page_query(cls, sort_column, is_desc, after_kind):
+        """ Builds query of get_page. Rows after previous page are selected by row value comparison
+        or range of one value, so the index of sort column is searched from the end of previous page.
+        When they are in two ranges (NULL values are first in ascending order and last in descending one)
+        two ordered selects are merged by UNION ALL.
+        Args:
+            after_kind(str): one of PAGE_AFTER_KINDS, form of condition selecting rows after previous page
+        """
+        select = "SELECT `name`, `id`, `status`, `create_date`, " \
+                 "`priority`, `due_date`, `owner_id`, `is_archived`, " \
+                 "CASE WHEN length(`description`) > {preview} " \
+                 "THEN substr(`description`, 1, {preview}) || '...' ELSE `description` END " \
+                 "FROM `todo_items` " \
+                 "WHERE `owner_id` = ? AND `is_archived` = ?"
+        conditions = ['']
+        if after_kind == 'null':
+            conditions = [" AND `{column}` IS NULL AND `id` {sign} ?"] + \
+                ([] if is_desc else [" AND `{column}` IS NOT NULL"])
+        elif after_kind == 'value':
+            conditions = [" AND (`{column}`, `id`) {sign} (?, ?)"] + ([" AND `{column}` IS NULL"] if is_desc else [])
+        query = " UNION ALL ".join(select + condition for condition in conditions) + \
+            " ORDER BY `{column}` {direction}, `id` {direction} LIMIT ?;"
+        return query.format(column=sort_column, sign='<' if is_desc else '>',
+                            direction='DESC' if is_desc else 'ASC', preview=cls.DESCRIPTION_PREVIEW)
 
     @classmethod
     def get_by_id(cls, id_):
-        """ Retrieves todo item with given id from database.
+        """ Retrieves todo item with given id from database. Todo copied to another shard with its owner
+        is found by its old id too (and has the current one).
         Args:
             id_(int): item id
         Returns:
-            Todo: Todo object with a given id
+            Todo: Todo object with a given id, None if there is no such todo
         """
-        db = get_db()
+        todo = cls._get_from_database_of_id(id_)
+        # rows of moved owner are left in the old shard until they are deleted, but they aren't current
+        if todo is not None and get_db(todo.owner_id) is get_db_of_id(todo.id):
+            return todo
+        moved_id = shard_map.moved_id(get_db(), 'todo_items', id_)
+        return cls._get_from_database_of_id(moved_id) if moved_id is not None else None
+
+    @classmethod
+    def _get_from_database_of_id(cls, id_):
+        db = get_db_of_id(id_)
+        if db is None:
+            return None
         query = "SELECT `name`, `id`, `status`, `create_date`, `priority`, `due_date`," \
                 " `owner_id`, `is_archived`, `description` " \
                 "FROM `todo_items` " \
@@ -54,55 +247,235 @@ class Todo:
         return Todo(*todo_item_from_db[0]) if todo_item_from_db else None
 
     @classmethod
-    def delete_todos_by_user_id(cls, user_id):
-        """ removes all todos belong to user with user_id"""
-        db = get_db()
-        query = "DELETE FROM `todo_items` WHERE `owner_id` = ?"
-        values = (user_id, )
-        DB.execute_delete_query(db, query, values)
+    def current_ids(cls, user_id, ids):
+        """returns ids of user todos, old ids of todos moved to another shard with user replaced by current ones"""
+        db = get_db(user_id)
+        return [id_ if get_db_of_id(id_) is db else shard_map.moved_id(get_db(), 'todo_items', id_) or id_
+                for id_ in ids]
+
+    @classmethod
+    def export_position(cls, table, user_id, after):
+        """ Returns export position (id of the last exported row of table) of user in their current database,
+        given position can be from another shard the user was moved from since.
+        """
+        if not after or not shard_map.shards:
+            return after
+        db = get_db(user_id)
+        first_row_id = DB.execute_select_query(db, cls.FIRST_ROW_QUERY.format(table=table), (user_id, ))[0][0] or 0
+        return shard_map.moved_position(get_db(), table, user_id, after, shard_map.placement(get_db(), user_id)[0],
+                                        first_row_id)
+
+    @classmethod
+    def search_expression(cls, user_id, text):
+        """ Builds full text query matching todos of user whose name or description contain all words
+        of text, the last one as prefix (text typed so far). Returns None if text has no words.
+        """
+        words = re.findall(r'\w+', text or '', re.UNICODE)
+        if not words:
+            return None
+        phrases = ['{{name description}} : "{}"'.format(word) for word in words]
+        phrases[-1] += '*'
+        return 'owner_id : "{}" AND {}'.format(int(user_id), ' AND '.join(phrases))
+
+    @classmethod
+    def search(cls, user_id, text, limit=20):
+        """ Finds todos of user by words of their name and description, best matches first
+        (words in name weigh more than in description). Only RANKED_MATCHES newest matches
+        are ranked, so words common to most todos are found as fast as rare ones.
+        Args:
+            user_id(int): owner id
+            text(str): searched words, the last one is matched as prefix
+            limit(int): maximum number of results
+        Returns:
+            list(tuple(Todo, str, str)): todos with name and description fragment, matched words
+            are wrapped in common.MATCH_START and MATCH_END
+        """
+        expression = cls.search_expression(user_id, text)
+        if expression is None:
+            return []
+        db = get_db(user_id)
+        query = "SELECT `todo_items`.`name`, `id`, `status`, `create_date`, `priority`, `due_date`, " \
+                "`todo_items`.`owner_id`, `is_archived`, " \
+                "CASE WHEN length(`description`) > ? THEN substr(`description`, 1, ?) || '...' ELSE `description` END, " \
+                "`name_highlight`, `description_snippet` " \
+                "FROM (SELECT `rowid`, bm25(`todo_items_fts`, 10.0, 1.0, 0.0) AS `score`, " \
+                "      highlight(`todo_items_fts`, 0, ?, ?) AS `name_highlight`, " \
+                "      snippet(`todo_items_fts`, 1, ?, ?, '...', 16) AS `description_snippet` " \
+                "      FROM `todo_items_fts` WHERE `todo_items_fts` MATCH ? " \
+                "      ORDER BY `rowid` DESC LIMIT ?) AS `matches` " \
+                "JOIN `todo_items` ON `todo_items`.`id` = `matches`.`rowid` " \
+                "ORDER BY `score` LIMIT ?;"
+        values = (cls.DESCRIPTION_PREVIEW, cls.DESCRIPTION_PREVIEW, MATCH_START, MATCH_END, MATCH_START, MATCH_END,
+                  expression,
+                  cls.RANKED_MATCHES, limit)
+        return [(Todo(*row[:9]), row[9], row[10]) for row in DB.execute_select_query(db, query, values)]
+
+    @classmethod
+    def _owned_rows(cls, user_id, ids, condition=''):
+        """returns (id, status) of todos from ids which belong to user and meet extra condition"""
+        db = get_db(user_id)
+        rows = []
+        ids = cls.current_ids(user_id, ids)
+        for start in range(0, len(ids), cls.IDS_CHUNK_SIZE):
+            chunk = ids[start:start + cls.IDS_CHUNK_SIZE]
+            query = cls.OWNED_ROWS_QUERY.format(ids=', '.join('?' * len(chunk)), condition=condition)
+            rows += DB.execute_select_query(db, query, tuple([user_id] + chunk))
+        return rows
+
+    @classmethod
+    def _update_many(cls, query, user_id, ids, args=()):
+        """runs query ending with `owner_id` = ? AND `id` IN ({ids}) condition for chunks of ids,
+        args are values of placeholders before the condition"""
+        db = get_db(user_id)
+        for start in range(0, len(ids), cls.IDS_CHUNK_SIZE):
+            chunk = ids[start:start + cls.IDS_CHUNK_SIZE]
+            DB.execute_update_query(db, query.format(ids=', '.join('?' * len(chunk))),
+                                    tuple(args) + (user_id, ) + tuple(chunk))
+
+    @classmethod
+    def archive_done(cls, user_id):
+        """ Moves all active todos of user with done status to archive.
+        Returns:
+            int: number of archived todos
+        """
+        db = get_db(user_id, for_write=True)
+        with DB.transaction(db):
+            query = "SELECT `id` FROM `todo_items` WHERE `owner_id` = ? AND `is_archived` = 0 AND `status` = 1;"
+            ids = [row[0] for row in DB.execute_select_query(db, query, (user_id, ))]
+            query = "UPDATE `todo_items` SET `is_archived` = 1, `archive_date` = ? " \
+                    "WHERE `owner_id` = ? AND `is_archived` = 0 AND `status` = 1;"
+            DB.execute_update_query(db, query, (time.strftime("%Y-%m-%d %H:%M"), user_id))
+            cls.update_history_many([(id_, 'archive') for id_ in ids], user_id)
+        return len(ids)
+
+    @classmethod
+    def archive_many(cls, user_id, ids):
+        """ Moves todos of user with given ids and done status to archive.
+        Returns:
+            int: number of archived todos
+        """
+        with DB.transaction(get_db(user_id, for_write=True)):
+            ids = [row[0] for row in cls._owned_rows(user_id, ids, cls.ACTIVE_DONE_CONDITION)]
+            cls._update_many(cls.ARCHIVE_MANY_QUERY, user_id, ids, (time.strftime("%Y-%m-%d %H:%M"), ))
+            cls.update_history_many([(id_, 'archive') for id_ in ids], user_id)
+        return len(ids)
+
+    @classmethod
+    def toggle_many(cls, user_id, ids):
+        """ Toggles status of active todos of user with given ids.
+        Returns:
+            int: number of toggled todos
+        """
+        with DB.transaction(get_db(user_id, for_write=True)):
+            rows = cls._owned_rows(user_id, ids, cls.ACTIVE_CONDITION)
+            cls._update_many(cls.TOGGLE_MANY_QUERY, user_id, [id_ for id_, status in rows])
+            cls.update_history_many([(id_, 'status done' if status == 0 else 'status undone')
+                                     for id_, status in rows], user_id)
+        return len(rows)
+
+    @classmethod
+    def delete_many(cls, user_id, ids):
+        """ Removes todos of user with given ids.
+        Returns:
+            int: number of removed todos
+        """
+        with DB.transaction(get_db(user_id, for_write=True)):
+            ids = [row[0] for row in cls._owned_rows(user_id, ids)]
+            cls._update_many(cls.DELETE_MANY_QUERY, user_id, ids)
+            cls.update_history_many([(id_, 'remove') for id_ in ids], user_id)
+        return len(ids)
 
     def toggle(self):
         if self.status == 0:
             self.status = 1
-            self.update_history('status done')
+            self.save('status done')
         else:
             self.status = 0
-            self.update_history('status undone')
-        self.save()
-
-    def save(self):
-        """ Saves/updates todo item in database """
-        db = get_db()
-        if self.id:
-            query = "UPDATE `todo_items` SET `name` = ?, `status` = ?, " \
-                    "`priority` = ?, `due_date` = ?, `is_archived` = ?, `description` = ? " \
-                    "WHERE id = ?;"
-            values = (self.name, self.status, self.priority, self.due_date, int(self.is_archived),
-                      self.description, self.id)
-            DB.execute_update_query(db, query, values)
-            self.update_history('update')
-        else:
-            query = """INSERT INTO
-                    `todo_items` (`name`, `create_date`, `priority`, `due_date`,
-                    `owner_id`, `description`)
-                    VALUES (?, ?, ?, ?, ?, ?); """
-            values = (self.name, self.create_date, self.priority, self.due_date, self.owner_id,
-                      self.description)
-            DB.execute_insert_query(db, query, values)
-            self.update_history('create')
+            self.save('status undone')
+
+    def save(self, history_event='update'):
+        """ Saves/updates todo item in database.
+        Args:
+            history_event(str): event written to history when saving changed stored todo,
+                                nothing is written (and no row updated) if no value changed
+        """
+        db = get_db(self.owner_id, for_write=True)
+        with DB.transaction(db):
+            if self.id:
+                query = "UPDATE `todo_items` SET `name` = ?, `status` = ?, " \
+                        "`priority` = ?, `due_date` = ?, `is_archived` = ?, `description` = ? " \
+                        "WHERE id = ? AND NOT (`name` IS ? AND `status` IS ? AND `priority` IS ? " \
+                        "AND `due_date` IS ? AND `is_archived` IS ? AND `description` IS ?);"
+                changed = (self.name, self.status, self.priority, self.due_date, int(self.is_archived),
+                           self.description)
+                if DB.execute_update_query(db, query, changed + (self.id, ) + changed):
+                    self.update_history(history_event)
+            else:
+                query = """INSERT INTO
+                        `todo_items` (`name`, `create_date`, `priority`, `due_date`,
+                        `owner_id`, `description`)
+                        VALUES (?, ?, ?, ?, ?, ?); """
+                values = (self.name, self.create_date, self.priority, self.due_date, self.owner_id,
+                          self.description)
+                self.id = DB.execute_insert_query(db, query, values)
+                self.update_history('create')
+
+    @classmethod
+    def insert_many(cls, todos, owner_id):
+        """ Saves new todo items of one owner with one insert query and sets their ids.
+        Writes are locked for the whole transaction, so rows are the only ones inserted after the last id.
+        Args:
+            todos(list(Todo)): todos without id
+        """
+        db = get_db(owner_id, for_write=True)
+        with DB.transaction(db):
+            last_id = DB.execute_select_query(db, "SELECT MAX(`id`) FROM `todo_items`;")[0][0] or 0
+            query = """INSERT INTO `todo_items` (`name`, `status`, `create_date`, `priority`, `due_date`, `owner_id`,
+                                                 `description`)
+                       VALUES (?, ?, ?, ?, ?, ?, ?);"""
+            DB.execute_update_query(db, query, [(todo.name, todo.status, todo.create_date, todo.priority,
+                                                 todo.due_date, owner_id, todo.description) for todo in todos])
+            query = "SELECT `id` FROM `todo_items` WHERE `owner_id` = ? AND `id` > ? ORDER BY `id`;"
+            ids = [row[0] for row in DB.execute_select_query(db, query, (owner_id, last_id))]
+            for todo, id_ in zip(todos, ids):
+                todo.id = id_
+                todo.owner_id = owner_id
+            cls.update_history_many([(id_, 'create') for id_ in ids], owner_id)
 
     def delete(self):
         """ Removes todo item from the database """
-        db = get_db()
-        query = "DELETE FROM `todo_items` WHERE `id` = ?"
-        values = (self.id, )
-        DB.execute_delete_query(db, query, values)
-        self.update_history('remove')
+        db = get_db(self.owner_id, for_write=True)
+        with DB.transaction(db):
+            query = "DELETE FROM `todo_items` WHERE `id` = ?;"
+            values = (self.id, )
+            DB.execute_delete_query(db, query, values)
+            self.update_history('remove')
 
     def update_history(self, event):
         """saves events with event time in database"""
-        event_dict = {'create': 1, 'remove': 2, 'archive': 3, 'activate': 4, 'update': 5,
-                      'status done': 6, 'status undone': 7}
-        history_query = "INSERT INTO todo_history (item_id, change_date, event_id) VALUES (?, ?, ?)"
-        values = (self.id, time.strftime("%Y-%m-%d %H:%M"), event_dict[event])
-        DB.execute_insert_query(get_db(), history_query, values)
+        history_writer.add(self.id, time.strftime("%Y-%m-%d %H:%M"), self.HISTORY_EVENTS[event], self.owner_id)
+
+    @classmethod
+    def update_history_many(cls, events, owner_id):
+        """saves (item id, event) pairs of todos of one owner with current time in database at once"""
+        change_date = time.strftime("%Y-%m-%d %H:%M")
+        history_writer.add_many([(item_id, change_date, cls.HISTORY_EVENTS[event], owner_id)
+                                 for item_id, event in events])
+
+
+def query_variants():
+    """every form of todo queries built at run time, explained by flask check-queries"""
+    variants = []
+    for column in Todo.SORT_COLUMNS:
+        for is_desc in (False, True):
+            for after_kind in Todo.PAGE_AFTER_KINDS:
+                variants.append(('Todo.get_page({}, {}, {})'.format(column, 'desc' if is_desc else 'asc', after_kind),
+                                 Todo.page_query(column, is_desc, after_kind)))
+    for condition in ('', Todo.ACTIVE_CONDITION, Todo.ACTIVE_DONE_CONDITION):
+        variants.append(('Todo._owned_rows({})'.format(condition),
+                         Todo.OWNED_ROWS_QUERY.format(ids='?, ?', condition=condition)))
+    for name in ('ARCHIVE_MANY_QUERY', 'TOGGLE_MANY_QUERY', 'DELETE_MANY_QUERY'):
+        variants.append(('Todo.' + name, getattr(Todo, name).format(ids='?, ?')))
+    for table in Todo.EXPORT_TABLES:
+        variants.append(('Todo.export_position({})'.format(table), Todo.FIRST_ROW_QUERY.format(table=table)))
+    return variants
@@ -2,33 +2,44 @@ from models.todo import Todo
 
 
 class TodoList:
-    """Class representing list of todo items for user (owner)"""
-    def __init__(self, owner):
-        self.owner = owner
-        self.active_todos = Todo.get_all(self.owner.id, is_archived=False)
-        self.archived_todos = Todo.get_all(self.owner.id, is_archived=True)
-
-    def sort_by_name(self, is_desc=False):
-        """sorts active and archived todos by name. If is_desc is True sorting is descending"""
-        self.active_todos.sort(key=(lambda x: x.name), reverse=is_desc)
-        self.archived_todos.sort(key=(lambda x: x.name), reverse=is_desc)
+    """Class representing list of todo items for user (owner), sorted and paged in database.
+    Every list is loaded on first use, so archived todos are not read when only active ones are shown"""
+    # sort types offered in todo list view and columns they sort by
+    SORT_TYPES = {'name': 'name',
+                  'priority': 'priority',
+                  'due date': 'due_date',
+                  'create date': 'create_date',
+                  'status': 'status'}
 
-    def sort_by_due_date(self, is_desc=False):
-        """sorts active and archived todos by due date. If is_desc is True sorting is descending"""
-        self.active_todos.sort(key=(lambda x: x.due_date), reverse=is_desc)
-        self.archived_todos.sort(key=(lambda x: x.due_date), reverse=is_desc)
+    def __init__(self, owner, sort_type='create date', is_desc=False, page_size=50):
+        if sort_type not in self.SORT_TYPES:
+            raise ValueError("Unknown sort type {}".format(sort_type))
+        self.owner = owner
+        self.sort_type = sort_type
+        self.is_desc = is_desc
+        self.page_size = page_size
+        self._pages = {}
 
-    def sort_by_create_date(self, is_desc=False):
-        """sorts active and archived todos creation time. If is_desc is True sorting is descending"""
-        self.active_todos.sort(key=(lambda x: x.create_date), reverse=is_desc)
-        self.archived_todos.sort(key=(lambda x: x.create_date), reverse=is_desc)
+    def get_page(self, is_archived=False, after_id=None):
+        """ Returns page of active or archived todos starting after todo with after_id.
+        Returns:
+            tuple(list(Todo), bool): todos on page and information if there is next page
+        """
+        key = (is_archived, after_id)
+        if key not in self._pages:
+            after = Todo.get_by_id(after_id) if after_id is not None else None
+            if after is not None and (after.owner_id != self.owner.id or after.is_archived != is_archived):
+                after = None
+            self._pages[key] = Todo.get_page(self.owner.id, is_archived, self.SORT_TYPES[self.sort_type],
+                                             self.is_desc, after, self.page_size)
+        return self._pages[key]
 
-    def sort_by_priority(self, is_desc=False):
-        """sorts active and archived todos by priority. If is_desc is True sorting is descending"""
-        self.active_todos.sort(key=(lambda x: x.priority), reverse=is_desc)
-        self.archived_todos.sort(key=(lambda x: x.priority), reverse=is_desc)
+    @property
+    def active_todos(self):
+        """first page of active todos"""
+        return self.get_page(is_archived=False)[0]
 
-    def sort_by_status(self, is_desc=False):
-        """sorts active and archived todos by status. If is_desc is True sorting is descending"""
-        self.active_todos.sort(key=(lambda x: x.status), reverse=is_desc)
-        self.archived_todos.sort(key=(lambda x: x.status), reverse=is_desc)
+    @property
+    def archived_todos(self):
+        """first page of archived todos"""
+        return self.get_page(is_archived=True)[0]
@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+from common import connection, get_db, after_commit
+from dbhandle import DB
+from models.daily_stats import DailyTodoStats
+from sharding import shard_map
+
+
+logger = logging.getLogger(__name__)
+
+# rows of user in tables with few rows per user, deleted at once: in database with user data
+USER_ROWS_QUERIES = (
+    "DELETE FROM `user_todo_stats` WHERE `user_id` = ?;",
+    # rollups of all users (user id 0) keep events of removed users
+    "DELETE FROM `daily_todo_stats` WHERE `user_id` = ?;",
+)
+# and in the main database, shard of user is forgotten when nothing is left in it
+CATALOG_QUERIES = (
+    "DELETE FROM `users_permissions` WHERE `user_id` = ?;",
+    "DELETE FROM `users_history` WHERE `user_id` = ?;",
+    "DELETE FROM `user_deletions` WHERE `user_id` = ?;",
+    "DELETE FROM `user_shards` WHERE `user_id` = ?;",
+    "DELETE FROM `moved_ids` WHERE `owner_id` = ?;",
+)
+# the whole user data in one transaction, history of todos first, old history rows may have no owner
+DELETE_QUERIES = (
+    "DELETE FROM `todo_history` WHERE `item_id` IN (SELECT `id` FROM `todo_items` WHERE `owner_id` = ?);",
+    "DELETE FROM `todo_history` WHERE `owner_id` = ?;",
+    "DELETE FROM `todo_history_summary` WHERE `owner_id` = ?;",
+    "DELETE FROM `todo_items` WHERE `owner_id` = ?;",
+) + USER_ROWS_QUERIES
+# the same in batches of at most ? todos or history rows, repeated until nothing is deleted
+BATCH_QUERIES = (
+    ("DELETE FROM `todo_history` WHERE `item_id` IN "
+     "(SELECT `id` FROM `todo_items` WHERE `owner_id` = ? ORDER BY `id` LIMIT ?);",
+     "DELETE FROM `todo_items` WHERE `id` IN "
+     "(SELECT `id` FROM `todo_items` WHERE `owner_id` = ? ORDER BY `id` LIMIT ?);"),
+    ("DELETE FROM `todo_history` WHERE `id` IN "
+     "(SELECT `id` FROM `todo_history` WHERE `owner_id` = ? LIMIT ?);", ),
+    ("DELETE FROM `todo_history_summary` WHERE `item_id` IN "
+     "(SELECT `item_id` FROM `todo_history_summary` WHERE `owner_id` = ? LIMIT ?);", ),
+)
+# ids of users which don't exist any more but still have rows
+ORPHANS_QUERY = """/* full scan */ SELECT `owner_id` FROM `todo_items` WHERE `owner_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `owner_id` FROM `todo_history` WHERE `owner_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `owner_id` FROM `todo_history_summary`
+                         WHERE `owner_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `user_id` FROM `users_permissions` WHERE `user_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `user_id` FROM `users_history` WHERE `user_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `user_id` FROM `user_todo_stats` WHERE `user_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `user_id` FROM `daily_todo_stats`
+                         WHERE `user_id` <> 0 AND `user_id` NOT IN (SELECT `id` FROM `users`)
+                   UNION SELECT `user_id` FROM `user_deletions`;"""
+# owners of rows in shard, users table of shard is empty
+SHARD_OWNERS_QUERY = """/* full scan */ SELECT `owner_id` FROM `todo_items`
+                        UNION SELECT `owner_id` FROM `todo_history`
+                        UNION SELECT `owner_id` FROM `todo_history_summary`
+                        UNION SELECT `user_id` FROM `user_todo_stats`
+                        UNION SELECT `user_id` FROM `daily_todo_stats` WHERE `user_id` <> 0;"""
+
+
+class UserDeletion:
+    """ Removes users together with all their data: todos, todo history and its summaries,
+    permissions, users history and statistics (user data version is kept, see migration 7).
+    Small accounts are deleted in one transaction. Users with many todos are removed from users table
+    at once and the rest is deleted by background job in batches, each in its own short transaction,
+    so the write lock is never held for long.
+    Data of user in a shard is deleted in transaction of the shard, committed before the main database.
+    """
+    def __init__(self, batch_size=500, pause=0.05):
+        self.batch_size = batch_size
+        self.pause = pause
+
+    @classmethod
+    def delete(cls, user_id):
+        """deletes user with all dependent rows in one transaction"""
+        db = get_db(user_id, for_write=True)
+        with DB.transaction(db):
+            # events of user todos stay counted in statistics of all users
+            DailyTodoStats.rollup(database=shard_map.database_for(get_db(), user_id))
+            for query in DELETE_QUERIES:
+                DB.execute_delete_query(db, query, (user_id, ))
+        db = get_db()
+        with DB.transaction(db):
+            for query in CATALOG_QUERIES:
+                DB.execute_delete_query(db, query, (user_id, ))
+            DB.execute_delete_query(db, "DELETE FROM `users` WHERE `id` = ?;", (user_id, ))
+        shard_map.forget(user_id)
+
+    @classmethod
+    def schedule(cls, user_id):
+        """ Removes user so they can't log in any more and leaves deleting their data
+        to background job, started when current request commits.
+        """
+        # job has to find the data where it is now
+        shard_map.database_for(get_db(), user_id, for_write=True)
+        db = get_db()
+        with DB.transaction(db):
+            DB.execute_delete_query(db, "DELETE FROM `users_permissions` WHERE `user_id` = ?;", (user_id, ))
+            DB.execute_delete_query(db, "DELETE FROM `users` WHERE `id` = ?;", (user_id, ))
+            query = "INSERT OR REPLACE INTO `user_deletions` (`user_id`, `requested_date`) VALUES (?, ?);"
+            DB.execute_insert_query(db, query, (user_id, time.strftime("%Y-%m-%d %H:%M")))
+        after_commit(deletion_worker.wake)
+
+    @classmethod
+    def pending(cls):
+        """returns ids of users with data still waiting for deletion"""
+        query = "/* full scan */ SELECT `user_id` FROM `user_deletions` ORDER BY `user_id`;"
+        return [row[0] for row in DB.execute_select_query(get_db(), query)]
+
+    def run_pending(self):
+        """ Deletes data of all scheduled users.
+        Returns:
+            int: number of deleted rows of todos, history and summaries
+        """
+        return sum(self.delete_batched(user_id) for user_id in self.pending())
+
+    def delete_batched(self, user_id, database=None):
+        """ Deletes rows of user which doesn't exist any more, batch_size todos (with their history)
+        or history rows in one transaction. Runs again when interrupted.
+        Args:
+            database(str): database with rows of user, their shard by default
+        Returns:
+            int: number of deleted rows of todos, history and summaries
+        """
+        database = database or shard_map.database_for(get_db(), user_id)
+        deleted = self.delete_rows(user_id, database)
+        db = get_db()
+        with DB.transaction(db):
+            for query in CATALOG_QUERIES:
+                DB.execute_delete_query(db, query, (user_id, ))
+        shard_map.forget(user_id)
+        logger.info("user_data_deleted user_id=%d database=%s rows=%d", user_id, database, deleted)
+        return deleted
+
+    def delete_rows(self, user_id, database):
+        """ Deletes todos, todo history, summaries and statistics of user from one database in batches,
+        rows of the main database (user, permissions, shard) are kept.
+        Returns:
+            int: number of deleted rows of todos, history and summaries
+        """
+        db = connection(database)
+        DailyTodoStats.rollup(database=database)
+        deleted = 0
+        for queries in BATCH_QUERIES:
+            while True:
+                with DB.transaction(db):
+                    for query in queries:
+                        count = DB.execute_delete_query(db, query, (user_id, self.batch_size))
+                        deleted += count
+                if not count:
+                    break
+                time.sleep(self.pause)
+        with DB.transaction(db):
+            for query in USER_ROWS_QUERIES:
+                DB.execute_delete_query(db, query, (user_id, ))
+        return deleted
+
+    def sweep_orphans(self):
+        """ Deletes rows left by users deleted before the whole user data was removed with them
+        (and events written by history writer after their todos were deleted), in the main database
+        and in every shard. History rows without owner can't be attributed to a user and are kept.
+        Returns:
+            dict: number of deleted rows by id of removed user
+        """
+        deleted = {}
+        user_ids = [row[0] for row in DB.execute_select_query(get_db(), ORPHANS_QUERY)]
+        for user_id in user_ids:
+            deleted[user_id] = self.delete_batched(user_id, shard_map.catalog)
+        query = "/* full scan */ SELECT `id` FROM `users`;"
+        existing = set(row[0] for row in DB.execute_select_query(get_db(), query))
+        for database in shard_map.shards:
+            owners = [row[0] for row in DB.execute_select_query(connection(database), SHARD_OWNERS_QUERY)]
+            for user_id in owners:
+                if user_id is not None and user_id not in existing:
+                    deleted[user_id] = deleted.get(user_id, 0) + self.delete_batched(user_id, database)
+        return deleted
+
+
+class DeletionWorker:
+    """ Background thread running target (which deletes data of scheduled users) whenever it is woken up.
+    Target is set by application, which provides it context, until then scheduled deletions wait
+    for the next wake up or `flask delete-users`. Application wakes it when it starts with deletions
+    left unfinished by previous run.
+    """
+    def __init__(self):
+        self.target = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._requested = False
+
+    def wake(self):
+        with self._lock:
+            self._requested = True
+            if self.target is not None and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name='user-deletion')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._requested:
+                    self._thread = None
+                    return
+                self._requested = False
+            try:
+                self.target()
+            except Exception:
+                logger.exception("Deleting data of removed users failed")
+
+
+deletion_worker = DeletionWorker()
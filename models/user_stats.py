@@ -0,0 +1,110 @@
+from common import connection, fan_out, get_db
+from dbhandle import DB
+from sharding import shard_map
+from models.data_version import DataVersion
+
+
+# counters computed from scratch, in the same order as columns of user_todo_stats table
+COUNTERS_QUERY = """/* full scan */ SELECT `owner_id`,
+                           SUM(CASE WHEN `is_archived` = 0 THEN 1 ELSE 0 END),
+                           SUM(CASE WHEN `is_archived` = 0 AND `status` = 1 THEN 1 ELSE 0 END),
+                           SUM(CASE WHEN `is_archived` = 0 AND `status` = 0 THEN 1 ELSE 0 END),
+                           SUM(CASE WHEN `is_archived` = 1 THEN 1 ELSE 0 END)
+                    FROM `todo_items`
+                    GROUP BY `owner_id`
+                    HAVING `owner_id` IS NOT NULL"""
+REBUILD_QUERY = "REPLACE INTO `user_todo_stats` (`user_id`, `active_count`, `active_done_count`, " \
+                "`active_undone_count`, `archived_count`) " + COUNTERS_QUERY + ";"
+MANY_QUERY = """SELECT `user_id`, `active_count`, `active_done_count`, `active_undone_count`, `archived_count`
+                FROM `user_todo_stats`
+                WHERE `user_id` IN ({ids});"""
+
+
+class UserTodoStats:
+    """Class representing todo counters of one user, kept up to date by triggers on todo_items"""
+    def __init__(self, user_id, active_count=0, active_done_count=0, active_undone_count=0, archived_count=0):
+        self.user_id = user_id
+        self.active_count = active_count
+        self.active_done_count = active_done_count
+        self.active_undone_count = active_undone_count
+        self.archived_count = archived_count
+
+    def as_tuple(self):
+        return (self.user_id, self.active_count, self.active_done_count, self.active_undone_count,
+                self.archived_count)
+
+    @classmethod
+    def get_by_user_id(cls, user_id):
+        """ Retrieves counters of user with given id from database.
+        Args:
+            user_id(int): user id
+        Returns:
+            UserTodoStats: counters of user, all zero for user without todos
+        """
+        db = get_db(user_id)
+        query = """SELECT `user_id`, `active_count`, `active_done_count`, `active_undone_count`, `archived_count`
+                   FROM `user_todo_stats`
+                   WHERE `user_id` = ?;"""
+        values = (user_id, )
+        stats_from_db = DB.execute_select_query(db, query, values)
+        return UserTodoStats(*stats_from_db[0]) if stats_from_db else UserTodoStats(user_id)
+
+    @classmethod
+    def get_many(cls, databases):
+        """ Retrieves counters of many users, from all their databases at once.
+        Args:
+            databases(dict): database with data of user by user id
+        Returns:
+            dict: UserTodoStats by user id, all zero for users without todos
+        """
+        user_ids = {}
+        for user_id, database in databases.items():
+            user_ids.setdefault(database, []).append(user_id)
+
+        def read(database, db):
+            query = MANY_QUERY.format(ids=', '.join('?' * len(user_ids[database])))
+            return DB.execute_select_query(db, query, tuple(user_ids[database]))
+        stats = dict((user_id, UserTodoStats(user_id)) for user_id in databases)
+        for rows in fan_out(read, list(user_ids)):
+            stats.update((row[0], UserTodoStats(*row)) for row in rows)
+        return stats
+
+    @classmethod
+    def find_drift(cls, database=None):
+        """ Recomputes counters from todo_items of database (the main one by default) and compares them
+        with stored ones.
+        Returns:
+            list(tuple(UserTodoStats, UserTodoStats)): (stored, expected) counters which differ
+        """
+        db = connection(database or shard_map.catalog)
+        query = """/* full scan */ SELECT `user_id`, `active_count`, `active_done_count`, `active_undone_count`,
+                                          `archived_count`
+                   FROM `user_todo_stats`;"""
+        stored = dict((row[0], UserTodoStats(*row)) for row in DB.execute_select_query(db, query))
+        expected = dict((row[0], UserTodoStats(*row)) for row in DB.execute_select_query(db, COUNTERS_QUERY + ";"))
+        drift = []
+        for user_id in sorted(set(stored) | set(expected)):
+            stored_stats = stored.get(user_id, UserTodoStats(user_id))
+            expected_stats = expected.get(user_id, UserTodoStats(user_id))
+            if stored_stats.as_tuple() != expected_stats.as_tuple():
+                drift.append((stored_stats, expected_stats))
+        return drift
+
+    @classmethod
+    def rebuild(cls, database=None):
+        """ Recomputes counters of all users from todo_items of database (the main one by default) """
+        db = connection(database or shard_map.catalog)
+        with DB.transaction(db):
+            DB.execute_update_query(db, REBUILD_QUERY, ())
+            query = """/* full scan */ DELETE FROM `user_todo_stats`
+                       WHERE `user_id` NOT IN (SELECT DISTINCT `owner_id` FROM `todo_items`
+                                               WHERE `owner_id` IS NOT NULL);"""
+            DB.execute_delete_query(db, query, ())
+            # counters are shown on user pages validated by data version
+            DataVersion.bump_all(database)
+
+
+def query_variants():
+    """every form of counter queries built at run time, explained by flask check-queries"""
+    return [('COUNTERS_QUERY', COUNTERS_QUERY + ";"), ('REBUILD_QUERY', REBUILD_QUERY),
+            ('UserTodoStats.get_many', MANY_QUERY.format(ids='?, ?'))]
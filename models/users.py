@@ -1,6 +1,10 @@
-from common import get_db
+from cache import LRUCache
+from common import get_db, after_commit
+from config import BaseConfig
 from dbhandle import DB
-from models.todo import Todo
+from models.user_stats import UserTodoStats
+from models.user_deletion import UserDeletion
+from sharding import shard_map, MAIN_DATABASE
 import time
 
 
@@ -13,6 +17,10 @@ class User:
         self.email = email
         #  for new user registration date is set (current time), for existing user is taken from db
         self.registration_date = registration_date if registration_date else time.strftime("%Y-%m-%d %H:%M")
+        #  values precomputed by batched loaders, None means that they are read from db on demand
+        self._active_todos_count = None
+        self._is_admin = None
+        self._todo_stats = None
 
     @classmethod
     def get_users_list(cls):
@@ -22,124 +30,215 @@ class User:
         """
         db = get_db()
         users = []
-        query = """SELECT `name`, `password`, `id`, `email`, `registration_date` FROM `users`;"""
+        query = """/* full scan */ SELECT `name`, `password`, `id`, `email`, `registration_date` FROM `users`;"""
         users_from_db = DB.execute_select_query(db, query)
         for user in users_from_db:
             users.append(User(*user))
         return users
 
+    @classmethod
+    def get_users_page(cls, after_id=None, limit=50):
+        """ Retrieves one page of users ordered by id together with their admin status and shard
+        in a single query (keyset pagination), and their todo counters from all shards at once.
+        Args:
+            after_id(int): id of the last user from previous page, first page if None
+            limit(int): maximum number of users on page
+        Returns:
+            tuple(list(User), bool): users on page and information if there is next page
+        """
+        db = get_db()
+        users = []
+        query = """SELECT `page`.`name`, `page`.`password`, `page`.`id`, `page`.`email`,
+                          `page`.`registration_date`, MAX(`permission_types`.`id` IS NOT NULL),
+                          `user_shards`.`shard`
+                   FROM (SELECT `id`, `name`, `password`, `email`, `registration_date` FROM `users`
+                         WHERE `id` > ? ORDER BY `id` LIMIT ?) AS `page`
+                   LEFT JOIN `user_shards` ON `user_shards`.`user_id` = `page`.`id`
+                   LEFT JOIN `users_permissions` ON `users_permissions`.`user_id` = `page`.`id`
+                   LEFT JOIN `permission_types`
+                        ON `permission_types`.`id` = `users_permissions`.`permission_id`
+                        AND `permission_types`.`name` = 'admin'
+                   GROUP BY `page`.`id`
+                   ORDER BY `page`.`id`;"""
+        values = (after_id if after_id is not None else -1, limit + 1)
+        users_from_db = DB.execute_select_query(db, query, values)
+        databases = dict((row[2], shard_map.database(row[6] if shard_map.shards and row[6] is not None
+                                                      else MAIN_DATABASE))
+                         for row in users_from_db[:limit])
+        todo_stats = UserTodoStats.get_many(databases)
+        for row in users_from_db[:limit]:
+            user = User(*row[:5])
+            user._is_admin = bool(row[5])
+            user._todo_stats = todo_stats[user.id]
+            users.append(user)
+        return users, len(users_from_db) > limit
+
+    # user data with admin status and version of user row, read by all single user lookups
+    USER_QUERY = """SELECT `name`, `password`, `id`, `email`, `registration_date`,
+                           EXISTS(SELECT 1 FROM `users_permissions`
+                                  JOIN `permission_types`
+                                       ON `users_permissions`.`permission_id` = `permission_types`.`id`
+                                  WHERE `users_permissions`.`user_id` = `users`.`id`
+                                  AND `permission_types`.`name` = 'admin'),
+                           (SELECT `version` FROM `user_data_versions` WHERE `user_id` = `users`.`id`)
+                    FROM `users`
+                    WHERE {condition};"""
+    # bumped by triggers on every change of user, their permissions and removal (see migrations 7 and 15)
+    VERSION_QUERY = "SELECT `version` FROM `user_data_versions` WHERE `user_id` = ?;"
+    # keys of users read by _get_by, each has unique index
+    LOOKUP_KEYS = ('id', 'name', 'email')
+    LOGIN_CONDITION = "`name` = ? OR `email` = ? ORDER BY `name` = ? DESC LIMIT 1"
+
+    @classmethod
+    def _from_row(cls, row):
+        user = User(*row[:5])
+        user._is_admin = bool(row[5])
+        return user
+
+    @classmethod
+    def _cached(cls, key, value):
+        """ Returns user found in cache by ('id'|'name'|'email', value) key or None. Cached row is used
+        only while version of user in database is the same, so changes made by other processes
+        are seen at once.
+        """
+        user_id = value if key == 'id' else user_cache.get((key, value))
+        row = user_cache.get(('id', user_id)) if user_id is not None else None
+        # name and email entries point to id entry, they are stale if user data changed
+        if row is None or (key == 'name' and row[0] != value) or (key == 'email' and row[3] != value):
+            return None
+        version = DB.execute_select_query(get_db(), cls.VERSION_QUERY, (user_id, ))
+        if (version[0][0] if version else None) != row[6]:
+            user_cache.delete(('id', user_id))
+            return None
+        return cls._from_row(row)
+
+    @classmethod
+    def _cache(cls, row):
+        user_cache.set(('id', row[2]), row)
+        user_cache.set(('name', row[0]), row[2])
+        user_cache.set(('email', row[3]), row[2])
+
+    @classmethod
+    def invalidate_cache(cls, user_id):
+        """removes user from cache, now and again after current request commits"""
+        user_cache.delete(('id', user_id))
+        after_commit(lambda: user_cache.delete(('id', user_id)))
+
+    @classmethod
+    def _get_by(cls, key, value):
+        user = cls._cached(key, value)
+        if user is not None:
+            return user
+        db = get_db()
+        query = cls.USER_QUERY.format(condition="`{}` = ?".format(key))
+        values = (value, )
+        user_from_db = DB.execute_select_query(db, query, values)
+        if not user_from_db:
+            return None
+        cls._cache(user_from_db[0])
+        return cls._from_row(user_from_db[0])
+
     @classmethod
     def get_by_id(cls, id_):
-        """ Retrieves user with given id from database.
+        """ Retrieves user with given id from cache or database.
         Args:
             id_(int): user id
         Returns:
             Todo: User object with a given id
         """
-        db = get_db()
-        query = """SELECT `name`, `password`, `id`, `email`, `registration_date`
-                   FROM `users`
-                   WHERE `id` = ?;"""
-        values = (id_, )
-        user_from_db = DB.execute_select_query(db, query, values)
-        return User(*user_from_db[0]) if user_from_db else None
+        return cls._get_by('id', id_)
 
     @classmethod
     def get_by_name(cls, name):
-        """ Retrieves user with given name from database.
+        """ Retrieves user with given name from cache or database.
         Args:
-            name(string): user name,
-            db: dababase object
+            name(string): user name
         Returns:
-            User object with a given name
+            User object with a given name or None
         """
-        db = get_db()
-        query = """SELECT `name`, `password`, `id`, `email`, `registration_date`
-                   FROM `users`
-                   WHERE `name` = ?;"""
-        values = (name, )
-        user_from_db = DB.execute_select_query(db, query, values)
-        return User(*user_from_db[0])
+        return cls._get_by('name', name)
 
     @classmethod
     def get_by_email(cls, email):
-        """ Retrieves user with given name from database.
+        """ Retrieves user with given email from cache or database.
+        Args:
+            email(string): user email
+        Returns:
+            User object with a given email or None
+        """
+        return cls._get_by('email', email)
+
+    @classmethod
+    def get_by_login(cls, login):
+        """ Retrieves user whose name or email is equal to login with one query,
+        user with such name wins over user with such email.
         Args:
-            name(string): user name,
-            db: dababase object
+            login(string): user name or email
         Returns:
-            User object with a given name
+            User object or None
         """
+        # cached user with such email can't be used, user with such name (not cached) wins over them
+        user = cls._cached('name', login)
+        if user is not None:
+            return user
         db = get_db()
-        query = """SELECT `name`, `password`, `id`, `email`, `registration_date`
-                   FROM `users`
-                   WHERE `email` = ?;"""
-        values = (email, )
+        query = cls.USER_QUERY.format(condition=cls.LOGIN_CONDITION)
+        values = (login, login, login)
         user_from_db = DB.execute_select_query(db, query, values)
-        return User(*user_from_db[0])
+        if not user_from_db:
+            return None
+        cls._cache(user_from_db[0])
+        return cls._from_row(user_from_db[0])
 
     @classmethod
     def is_user_with_name_in_user_list(cls, name):
         """checks that is user with given name in database"""
-        db = get_db()
-        query = "SELECT * FROM users WHERE name=?"
-        values = (name, )
-        user_from_db = DB.execute_select_query(db, query, values)
-        return bool(user_from_db)
+        return cls.get_by_name(name) is not None
 
     @classmethod
     def is_user_with_email_in_user_list(cls, email):
         """checks that is user with given email in database"""
-        db = get_db()
-        query = "SELECT * FROM users WHERE email=?"
-        values = (email, )
-        user_from_db = DB.execute_select_query(db, query, values)
-        return bool(user_from_db)
+        return cls.get_by_email(email) is not None
+
+    @property
+    def todo_stats(self):
+        """reads all todo counters of user with one query and keeps them for next properties"""
+        if self._todo_stats is None:
+            self._todo_stats = UserTodoStats.get_by_user_id(self.id)
+        return self._todo_stats
 
     @property
     def active_todos_count(self):
-        """connects with db and counts active todos for user"""
-        db = get_db()
-        query = """SELECT COUNT(`id`) FROM `todo_items`
-                   WHERE `owner_id` = ? AND `is_archived` = 0;"""
-        values = (self.id, )
-        return DB.execute_select_query(db, query, values)[0][0]
+        """returns number of active todos for user"""
+        if self._active_todos_count is not None:
+            return self._active_todos_count
+        return self.todo_stats.active_count
 
     @property
     def active_todos_done_count(self):
-        """connects with db and counts active todos with done status for user"""
-        db = get_db()
-        query = """SELECT COUNT(`id`) FROM `todo_items`
-                   WHERE `owner_id` = ? AND `is_archived` = 0 AND `status` = 1;"""
-        values = (self.id, )
-        return DB.execute_select_query(db, query, values)[0][0]
+        """returns number of active todos with done status for user"""
+        return self.todo_stats.active_done_count
 
     @property
     def active_todos_undone_count(self):
-        """connects with db and counts active todos with undone status for user"""
-        db = get_db()
-        query = """SELECT COUNT(`id`) FROM `todo_items`
-                   WHERE `owner_id` = ? AND `is_archived` = 0 AND `status` = 0;"""
-        values = (self.id, )
-        return DB.execute_select_query(db, query, values)[0][0]
+        """returns number of active todos with undone status for user"""
+        return self.todo_stats.active_undone_count
 
     @property
     def archived_todos_count(self):
-        """connects with db and counts archived todos for user"""
-        db = get_db()
-        query = """SELECT COUNT(`id`) FROM `todo_items`
-                   WHERE `owner_id` = ? AND `is_archived` = 1;"""
-        values = (self.id, )
-        return DB.execute_select_query(db, query, values)[0][0]
+        """returns number of archived todos for user"""
+        return self.todo_stats.archived_count
 
     @property
     def is_admin(self):
         """checks that user has admin status """
+        if self._is_admin is not None:
+            return self._is_admin
         db = get_db()
         query = "SELECT users.id FROM users_permissions " \
                 "JOIN users ON users.id=users_permissions.user_id " \
                 "JOIN permission_types ON users_permissions.permission_id = permission_types.id " \
-                "WHERE users.id = ? AND permission_types.name = ?"
+                "WHERE users.id = ? AND permission_types.name = ?;"
         values = (self.id, 'admin')
         return bool(DB.execute_select_query(db, query, values))
 
@@ -151,33 +250,54 @@ class User:
                     " WHERE id = ?;"
             values = (self.name, self.password, self.email, self.registration_date, self.id)
             DB.execute_update_query(db, query, values)
+            User.invalidate_cache(self.id)
         else:  # new user
             query = "INSERT INTO `users` (`name`, `password`, `email`, `registration_date`) " \
                     "VALUES (?, ?, ?, ?); "
             values = (self.name, self.password, self.email, self.registration_date)
-            DB.execute_insert_query(db, query, values)
+            with DB.transaction(db):
+                self.id = DB.execute_insert_query(db, query, values)
+                shard_map.assign(db, self.id)
 
     def delete(self):
-        """ Removes user from the database """
-        db = get_db()
-        query = "DELETE FROM `users` WHERE `id` = ?"
-        values = (self.id, )
-        DB.execute_delete_query(db, query, values)
-        Todo.delete_todos_by_user_id(self.id)
+        """ Removes user with all their data from the database. Data of user with more than
+        USER_DELETE_SYNC_LIMIT todos is deleted by background job in batches.
+        """
+        with DB.transaction(get_db()):
+            if self.todo_stats.active_count + self.todo_stats.archived_count > BaseConfig.USER_DELETE_SYNC_LIMIT:
+                UserDeletion.schedule(self.id)
+            else:
+                UserDeletion.delete(self.id)
+            User.invalidate_cache(self.id)
 
     def set_admin_status(self, is_admin):
         """toggle admin status for user - add new record or delete existed record
            in user permission table"""
         db = get_db()
-        if self.is_admin != is_admin:
-            if self.is_admin:
-                query = "DELETE FROM users_permissions WHERE user_id = ?"
-                values = (self.id, )
-                DB.execute_delete_query(db, query, values)
-            else:
-                query = "INSERT INTO `users_permissions` (user_id, permission_id) VALUES (?, ?)"
-                values = (self.id, 1)
-                DB.execute_insert_query(db, query, values)
+        with DB.transaction(db):
+            if self.is_admin != is_admin:
+                if self.is_admin:
+                    query = "DELETE FROM users_permissions WHERE user_id = ?;"
+                    values = (self.id, )
+                    DB.execute_delete_query(db, query, values)
+                else:
+                    query = "INSERT INTO `users_permissions` (user_id, permission_id) VALUES (?, ?);"
+                    values = (self.id, 1)
+                    DB.execute_insert_query(db, query, values)
+                self._is_admin = is_admin
+                User.invalidate_cache(self.id)
 
     def get_password(self):
         return self.password
+
+
+def query_variants():
+    """every form of user queries built at run time, explained by flask check-queries"""
+    variants = [('User._get_by({})'.format(key), User.USER_QUERY.format(condition="`{}` = ?".format(key)))
+                for key in User.LOOKUP_KEYS]
+    return variants + [('User.get_by_login', User.USER_QUERY.format(condition=User.LOGIN_CONDITION))]
+
+
+# process local cache of user rows keyed by id, with name and email entries pointing to id,
+# rows are validated against user version on every lookup
+user_cache = LRUCache(BaseConfig.USER_CACHE_SIZE, BaseConfig.USER_CACHE_TTL)
@@ -0,0 +1,92 @@
+import heapq
+import logging
+from flask import g, has_request_context
+from config import BaseConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in testing mode (or with QUERY_BUDGET_STRICT) when request executes more queries than its budget"""
+
+
+def query_budget(budget):
+    """decorator setting maximum number of queries of a view, instead of QUERY_BUDGET from config"""
+    def decorator(f):
+        f.query_budget = budget
+        return f
+    return decorator
+
+
+def redact(args):
+    """describes query parameters by their types only, so values never get into logs"""
+    if args is None:
+        return ()
+    if isinstance(args, list):
+        return '<{} rows>'.format(len(args))
+    return tuple(type(arg).__name__ for arg in args)
+
+
+class QueryStats:
+    """ Queries executed while handling one request: their number, total time and the slowest ones.
+    With strict budget, the query over budget raises QueryBudgetExceeded, so traceback shows
+    the code which issued it.
+    """
+    def __init__(self, budget=None, strict=False, keep_slowest=5):
+        self.budget = budget
+        self.strict = strict
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.duration = 0.0
+        self._slowest = []
+
+    def record(self, query, args, duration):
+        self.count += 1
+        self.duration += duration
+        entry = (duration, self.count, ' '.join(query.split()), redact(args))
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        else:
+            heapq.heappushpop(self._slowest, entry)
+        if self.strict and self.over_budget:
+            raise QueryBudgetExceeded("Query {} is over budget of {} queries: {}".format(
+                self.count, self.budget, entry[2]))
+
+    @property
+    def over_budget(self):
+        return self.budget is not None and self.count > self.budget
+
+    @property
+    def slowest(self):
+        """list of (duration, query, redacted args), the slowest first"""
+        return [(duration, query, args) for duration, _, query, args in sorted(self._slowest, reverse=True)]
+
+    def server_timing(self, total):
+        """Server-Timing header value with database and whole request time"""
+        return 'db;dur={:.2f};desc="{} queries", total;dur={:.2f}'.format(self.duration * 1000, self.count,
+                                                                            total * 1000)
+
+
+def record_query(query, args, duration):
+    """ Query hook of DB: counts query in statistics of current request and logs it when it is slow.
+    Queries of background threads (like history writer) are checked against slow query threshold only.
+    """
+    if duration >= BaseConfig.SLOW_QUERY_THRESHOLD:
+        logger.warning("slow_query duration_ms=%.2f query=%r args=%r", duration * 1000, ' '.join(query.split()),
+                       redact(args))
+    stats = g.get('query_stats') if has_request_context() else None
+    if stats is not None:
+        stats.record(query, args, duration)
+
+
+def log_request(stats, method, path, endpoint, status, total):
+    """writes one structured line with query statistics of finished request"""
+    logger.info("request method=%s path=%s endpoint=%s status=%d queries=%d db_ms=%.2f total_ms=%.2f",
+                method, path, endpoint, status, stats.count, stats.duration * 1000, total * 1000)
+    for duration, query, args in stats.slowest:
+        logger.debug("request_query endpoint=%s duration_ms=%.2f query=%r args=%r", endpoint, duration * 1000,
+                     query, args)
+    if stats.over_budget:
+        logger.warning("query_budget_exceeded endpoint=%s queries=%d budget=%d", endpoint, stats.count,
+                       stats.budget)
@@ -0,0 +1,244 @@
+""" Prefork production server: master process opens listening socket, applies migrations and forks
+worker processes (one per CPU core by default) serving the application on the shared socket.
+
+Workers import the application after fork, so every worker opens its own database connections
+and background threads. Master restarts workers which died.
+Signals of master: HUP reloads (config is read again, modules imported by master are reloaded and
+new workers importing current application code start, then old ones finish their requests and exit),
+TERM and INT stop all workers gracefully. Updates of Python or installed packages need a restart.
+
+    python serve.py --bind 0.0.0.0:8000 --workers 4
+"""
+import argparse
+import importlib
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+import cache
+import config
+import dbhandle
+import migrations
+import sharding
+
+
+logger = logging.getLogger('serve')
+
+
+def parse_address(bind):
+    host, _, port = bind.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class RequestHandler(WSGIRequestHandler):
+    """closes connection after every response, so idle keep-alive connections never hold a request thread"""
+    protocol_version = 'HTTP/1.0'
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """ WSGI server handling at most `threads` requests at once in a pool of threads. Next connection
+    is accepted only when a thread is free, until then it waits in the listening socket shared
+    with other workers, which can take it.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        # base class calls server_close on socket it opened before it uses fd
+        self._executor = None
+        BaseWSGIServer.__init__(self, host, port, app, handler=RequestHandler, fd=fd)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='request')
+        self._free_threads = threading.Semaphore(threads)
+        self._thread_taken = False
+
+    def handle_request(self):
+        """waits up to timeout for a free thread, then for a connection handed to it"""
+        if not self._free_threads.acquire(timeout=self.timeout):
+            return
+        self._thread_taken = False
+        try:
+            BaseWSGIServer.handle_request(self)
+        finally:
+            if not self._thread_taken:
+                self._free_threads.release()
+
+    def process_request(self, request, client_address):
+        self._thread_taken = True
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._free_threads.release()
+
+    def server_close(self):
+        """waits for requests being handled, then closes socket"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        BaseWSGIServer.server_close(self)
+
+
+def run_worker(listener, threads):
+    """ Serves requests on inherited socket until TERM signal, then finishes current requests and returns.
+    Master has applied migrations already, so the worker doesn't.
+    """
+    running = [True]
+
+    def stop(signum, frame):
+        running[0] = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # environment of this process only, read again by wsgi
+    os.environ[config.ENVIRONMENT_PREFIX + 'AUTO_MIGRATE'] = '0'
+    import wsgi
+    host, port = listener.getsockname()[:2]
+    if threads > 1:
+        # requests being handled are finished by server_close, so their history is written by stop below
+        server = PooledWSGIServer(host, port, wsgi.app, threads, fd=listener.fileno())
+    else:
+        server = BaseWSGIServer(host, port, wsgi.app, fd=listener.fileno())
+    # handle_request returns after timeout, so stop signal is noticed in a second
+    server.timeout = 1.0
+    while running[0]:
+        server.handle_request()
+    server.server_close()
+    import main
+    main.history_writer.stop()
+
+
+class PreforkServer:
+    """Master process keeping given number of worker processes running"""
+    def __init__(self, bind, workers, threads=1, backlog=2048):
+        self.address = parse_address(bind)
+        self.worker_count = workers
+        self.threads = threads
+        self.backlog = backlog
+        self.workers = {}
+        self.generation = 0
+        self._signals = []
+
+    def listen(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self.address)
+        listener.listen(self.backlog)
+        listener.set_inheritable(True)
+        return listener
+
+    def prepare(self):
+        """ Reads config and applies migrations once, before workers start.
+        Modules imported by master are inherited by workers, so they are reloaded (in order of their
+        imports, config reads configuration when it is imported) to give workers current code.
+        Master never opens pooled connections, so none is inherited by workers.
+        """
+        for module in (config, dbhandle, cache, migrations, sharding):
+            importlib.reload(module)
+        if config.BaseConfig.AUTO_MIGRATE:
+            for database, version, name in sharding.upgrade_databases():
+                logger.info("Applied migration %d to %s: %s", version, database, name)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = self.generation
+            return
+        status = 0
+        try:
+            run_worker(self.listener, self.threads)
+        except BaseException:
+            logger.exception("Worker %d failed", os.getpid())
+            status = 1
+        finally:
+            logging.shutdown()
+            # never return to master code in the child
+            os._exit(status)
+
+    def run(self):
+        os.environ.setdefault(config.ENVIRONMENT_PREFIX + 'DEBUG', '0')
+        self.prepare()
+        self.listener = self.listen()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+        logger.info("Listening on %s:%d with %d workers", self.address[0], self.address[1], self.worker_count)
+        for _ in range(self.worker_count):
+            self.spawn()
+        while True:
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    return self.stop()
+            self.reap()
+            for _ in range(self.worker_count - self.current_workers()):
+                self.spawn()
+            time.sleep(0.2)
+
+    def current_workers(self):
+        return len([pid for pid, generation in self.workers.items() if generation == self.generation])
+
+    def reap(self):
+        """forgets finished workers"""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            generation = self.workers.pop(pid, None)
+            if generation == self.generation and status:
+                logger.warning("Worker %d exited with status %d, restarting it", pid, status)
+
+    def reload(self):
+        """starts new generation of workers and stops the old one when the new is running"""
+        logger.info("Reloading")
+        old_workers = list(self.workers)
+        self.prepare()
+        self.generation += 1
+        for _ in range(self.worker_count):
+            self.spawn()
+        for pid in old_workers:
+            self.kill(pid, signal.SIGTERM)
+
+    def stop(self, timeout=30):
+        """asks all workers to finish and waits for them, kills the ones still running after timeout"""
+        logger.info("Stopping %d workers", len(self.workers))
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGTERM)
+        deadline = time.time() + timeout
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            self.kill(pid, signal.SIGKILL)
+        self.listener.close()
+
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            self.workers.pop(pid, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bind', default='127.0.0.1:8000', help='host:port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=1, help='requests handled at once by every worker')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(name)s %(levelname)s %(message)s')
+    PreforkServer(args.bind, args.workers, args.threads).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
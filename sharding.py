@@ -0,0 +1,233 @@
+""" Placement of user data in database files (shards).
+
+The main database (DATABASE) is the catalog: users, their permissions and users history live only there.
+Todos, todo history and everything computed from them (counters, daily statistics, data versions, search
+index) of one user live together in one shard from SHARDS, or in the main database for users created
+before shards were configured. user_shards table of the main database keeps index of every user's shard.
+
+Ids of todos and todo history rows are unique across databases: shard n allocates them from range
+starting at (n + 1) * SHARD_ID_RANGE and the main database below SHARD_ID_RANGE, so database of a todo
+is known from its id alone. User moved to another shard gets new ids from its range, moved_ids table
+of the main database maps old ids to them, so old ids keep working.
+"""
+import logging
+import os
+import sqlite3
+import migrations
+from cache import LRUCache
+from config import BaseConfig
+from dbhandle import DB
+
+
+logger = logging.getLogger(__name__)
+
+# shard index of the main database
+MAIN_DATABASE = -1
+SHARD_ID_RANGE = 10 ** 12
+# tables with ids allocated from range of shard
+ID_RANGE_TABLES = ('todo_items', 'todo_history')
+# current id of row copied to another shard
+MOVED_ID_QUERY = "SELECT `new_id` FROM `moved_ids` WHERE `table_name` = ? AND `old_id` = ?;"
+# new id of the last moved row of owner with old id in [?, ?] range of one shard; without the index
+# hint SQLite walks back primary key through rows of all users
+MOVED_POSITION_QUERY = """SELECT `new_id` FROM `moved_ids` INDEXED BY `moved_ids_owner`
+                          WHERE `owner_id` = ? AND `table_name` = ? AND `old_id` <= ? AND `old_id` >= ?
+                          ORDER BY `old_id` DESC LIMIT 1;"""
+# tables of the schema before the first migration, created in new shard before migrations are applied
+BASE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS `users` ("
+    "`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT, `password` TEXT, `email` TEXT, "
+    "`registration_date` TEXT);",
+    "CREATE TABLE IF NOT EXISTS `users_permissions` ("
+    "`id` INTEGER PRIMARY KEY AUTOINCREMENT, `user_id` INTEGER, `permission_id` INTEGER);",
+    "CREATE TABLE IF NOT EXISTS `permission_types` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` INTEGER);",
+    "CREATE TABLE IF NOT EXISTS `users_history` ("
+    "`id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, `user_id` INTEGER, `change_date` TEXT, `event_id` INTEGER);",
+    "CREATE TABLE IF NOT EXISTS `todo_history` ("
+    "`id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, `item_id` INTEGER, `change_date` TEXT, `event_id` INTEGER);",
+    "CREATE TABLE IF NOT EXISTS `events` (`id` INTEGER PRIMARY KEY AUTOINCREMENT, `name` TEXT);",
+    "CREATE TABLE IF NOT EXISTS `todo_items` ("
+    "`id` INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, `name` TEXT NOT NULL, `status` INTEGER DEFAULT 0, "
+    "`create_date` TEXT, `owner_id` INTEGER, `is_archived` INTEGER DEFAULT 0, `archive_date` TEXT, "
+    "`due_date` TEXT, `priority` INTEGER, `description` TEXT);",
+)
+# tables with rows copied from the main database to new shard
+REFERENCE_TABLES = ('events', 'permission_types')
+
+
+class ShardMoving(Exception):
+    """Raised on write to data of user which is being moved to another shard, it can be retried soon"""
+    def __init__(self, user_id):
+        Exception.__init__(self, "Data of user {} is being moved to another shard".format(user_id))
+        self.user_id = user_id
+
+
+class ShardMap:
+    """ Finds database with data of user. Placements are read from user_shards table of the main
+    database and cached in each process for ttl seconds. Without configured shards every user's data
+    is in the main database and nothing is read.
+    """
+    def __init__(self, cache_size=10000, ttl=2):
+        self._placements = LRUCache(cache_size, ttl)
+
+    @property
+    def catalog(self):
+        return BaseConfig.DATABASE
+
+    @property
+    def shards(self):
+        return tuple(BaseConfig.SHARDS)
+
+    def database(self, shard):
+        """file name of database with given shard index"""
+        if not self.is_shard(shard):
+            raise ValueError("No shard {}, there are {}".format(shard, len(self.shards)))
+        return self.catalog if shard == MAIN_DATABASE else self.shards[shard]
+
+    def is_shard(self, shard):
+        """checks that shard index is the main database or one of configured shards"""
+        return MAIN_DATABASE <= shard < len(self.shards)
+
+    def databases(self):
+        """all databases which can keep user data, the main one first"""
+        return (self.catalog, ) + self.shards
+
+    def shard_of_id(self, row_id):
+        """index of shard with todo or todo history row of given id, None if it isn't a number"""
+        if not row_id:
+            return MAIN_DATABASE
+        try:
+            return int(row_id) // SHARD_ID_RANGE - 1
+        except (TypeError, ValueError):
+            return None
+
+    def database_of_id(self, row_id):
+        """ database with todo or todo history row of given id, None if id is outside ranges of all shards
+        or isn't a number (like id from url or JSON), so no such row is found
+        """
+        shard = self.shard_of_id(row_id)
+        return self.database(shard) if shard is not None and self.is_shard(shard) else None
+
+    def moved_id(self, db, table, row_id):
+        """ Returns current id of todo (or todo history row, by table) which was copied to another shard
+        with its owner, once or more, None if row of given id wasn't moved. db is connection with the
+        main database.
+        """
+        if not self.shards:
+            return None
+        moved = None
+        while True:
+            rows = DB.execute_select_query(db, MOVED_ID_QUERY, (table, row_id))
+            if not rows:
+                return moved
+            moved = row_id = rows[0][0]
+
+    def moved_position(self, db, table, owner_id, row_id, shard, first_row_id):
+        """ Translates position in rows of owner ordered by id (like export cursor) given by id from
+        another shard to ids of shard with their data now, where moved rows keep their order.
+        Args:
+            row_id(int): id of the last row before position
+            first_row_id(int): the lowest id of owner rows in shard (0 without rows), lower ids there are
+                               from before the owner was moved away and back
+        Returns:
+            int: id in shard of the last moved row up to position, 0 if position is before all of them
+        """
+        moved = row_id and (self.shard_of_id(row_id) != shard or row_id < first_row_id)
+        while moved:
+            values = (owner_id, table, row_id, first_id(self.shard_of_id(row_id)))
+            rows = DB.execute_select_query(db, MOVED_POSITION_QUERY, values)
+            row_id = rows[0][0] if rows else 0
+            moved = row_id and self.shard_of_id(row_id) != shard
+        return row_id
+
+    def placement(self, db, user_id):
+        """ Returns (shard, moving_to) of user: index of shard with their data and index of shard
+        it is being copied to (None if it isn't). db is connection with the main database.
+        """
+        if not self.shards:
+            return MAIN_DATABASE, None
+        placement = self._placements.get(user_id)
+        if placement is None:
+            query = "SELECT `shard`, `moving_to` FROM `user_shards` WHERE `user_id` = ?;"
+            rows = DB.execute_select_query(db, query, (user_id, ))
+            placement = tuple(rows[0]) if rows else (MAIN_DATABASE, None)
+            self._placements.set(user_id, placement)
+        return placement
+
+    def database_for(self, db, user_id, for_write=False):
+        """ Returns database with data of user.
+        Args:
+            for_write(bool): data will be changed, raises ShardMoving while it is being moved
+        """
+        shard, moving_to = self.placement(db, user_id)
+        if for_write and moving_to is not None:
+            raise ShardMoving(user_id)
+        return self.database(shard)
+
+    def default_shard(self, user_id):
+        """shard of new user"""
+        return user_id % len(self.shards) if self.shards else MAIN_DATABASE
+
+    def assign(self, db, user_id):
+        """places data of new user in their default shard"""
+        if not self.shards:
+            return
+        query = "INSERT OR REPLACE INTO `user_shards` (`user_id`, `shard`, `moving_to`) VALUES (?, ?, NULL);"
+        DB.execute_update_query(db, query, (user_id, self.default_shard(user_id)))
+        self.forget(user_id)
+
+    def forget(self, user_id):
+        """drops cached placement of user in this process"""
+        self._placements.delete(user_id)
+
+    def stats(self):
+        return dict(self._placements.stats(), shards=len(self.shards))
+
+
+def first_id(shard):
+    """the lowest todo and todo history id of shard"""
+    return (shard + 1) * SHARD_ID_RANGE
+
+
+def create_shard(db, catalog, shard):
+    """ Creates tables of schema before migrations in empty shard database, copies reference rows
+    from the main database (catalog) and starts ids at range of the shard.
+    """
+    for statement in BASE_SCHEMA:
+        db.execute(statement)
+    for table in REFERENCE_TABLES:
+        rows = catalog.execute("SELECT * FROM `{}`;".format(table)).fetchall()
+        if rows:
+            db.executemany("INSERT INTO `{}` VALUES ({});".format(table, ', '.join('?' * len(rows[0]))), rows)
+    db.executemany("INSERT INTO `sqlite_sequence` (`name`, `seq`) VALUES (?, ?);",
+                   [(table, first_id(shard) - 1) for table in ID_RANGE_TABLES])
+    db.commit()
+
+
+def upgrade_databases(target=None):
+    """ Creates missing shards and applies pending migrations to the main database and every shard.
+    Uses its own connections, not pooled ones, so it can run in master process before workers fork.
+    Returns:
+        list(tuple): applied migrations as (database, version, name)
+    """
+    applied = []
+    catalog = sqlite3.connect(BaseConfig.DATABASE)
+    try:
+        applied += [(BaseConfig.DATABASE, version, name) for version, name in migrations.upgrade(catalog, target)]
+        for shard, database in enumerate(BaseConfig.SHARDS):
+            if os.path.dirname(database):
+                os.makedirs(os.path.dirname(database), exist_ok=True)
+            db = sqlite3.connect(database)
+            try:
+                if not db.execute("SELECT 1 FROM `sqlite_master` WHERE `name` = 'todo_items';").fetchall():
+                    create_shard(db, catalog, shard)
+                    logger.info("Created shard %d in %s", shard, database)
+                applied += [(database, version, name) for version, name in migrations.upgrade(db, target)]
+            finally:
+                db.close()
+    finally:
+        catalog.close()
+    return applied
+
+
+shard_map = ShardMap(ttl=BaseConfig.SHARD_MAP_TTL)
@@ -0,0 +1,96 @@
+import atexit
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+SOURCE_DATABASE = os.path.join(ROOT, 'data', 'todo.db')
+
+# application modules read configuration when imported: they must never touch data/todo.db,
+# sign sessions with a fixed key and write todo history in the request transaction
+_import_directory = tempfile.mkdtemp()
+shutil.copy(SOURCE_DATABASE, os.path.join(_import_directory, 'todo.db'))
+atexit.register(shutil.rmtree, _import_directory, True)
+os.environ['TODO_DATABASE'] = os.path.join(_import_directory, 'todo.db')
+os.environ['TODO_SECRET_KEY'] = 'tests'
+os.environ['TODO_HISTORY_SYNCHRONOUS'] = '1'
+
+import main  # noqa: E402
+import sharding  # noqa: E402
+from config import BaseConfig  # noqa: E402
+from dbhandle import DB  # noqa: E402
+from models.users import user_cache  # noqa: E402
+
+
+# users of data/todo.db: 'admin' with todos and 'user' without them
+ADMIN_ID = 14
+USER_ID = 23
+
+
+def clear_caches():
+    main.fragment_cache.clear()
+    user_cache.clear()
+    sharding.shard_map._placements.clear()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """application using its own migrated copy of data/todo.db"""
+    database = str(tmp_path / 'todo.db')
+    shutil.copy(SOURCE_DATABASE, database)
+    monkeypatch.setattr(BaseConfig, 'DATABASE', database)
+    monkeypatch.setattr(BaseConfig, 'SHARDS', ())
+    monkeypatch.setattr(main.app, 'testing', True)
+    clear_caches()
+    sharding.upgrade_databases()
+    yield main.app
+    clear_caches()
+    for path in (database, ) + tuple(BaseConfig.SHARDS):
+        DB.get_pool(path).close()
+
+
+@pytest.fixture
+def client(app):
+    """returns function making test client logged in as user with given id"""
+    def make_client(user_id=ADMIN_ID, is_admin=True):
+        test_client = app.test_client()
+        with test_client.session_transaction() as session:
+            session['logged_in'] = True
+            session['user_id'] = user_id
+            session['user_name'] = 'user {}'.format(user_id)
+            session['is_admin'] = True if is_admin else None
+            session['sort_type'] = 'create date'
+            session['sort_direct'] = 'desc'
+        return test_client
+    return make_client
+
+
+@pytest.fixture
+def query(app):
+    """ returns function running query on database file with connection of its own, outside of application
+    (like another process would), changes are committed
+    """
+    def run(sql, values=(), database=None):
+        db = sqlite3.connect(database or BaseConfig.DATABASE)
+        try:
+            rows = db.execute(sql, values).fetchall()
+            db.commit()
+            return rows
+        finally:
+            db.close()
+    return run
+
+
+@pytest.fixture
+def shards(app, tmp_path, monkeypatch):
+    """two empty shards next to the main database, which keeps data of all existing users"""
+    paths = (str(tmp_path / 'shard0.db'), str(tmp_path / 'shard1.db'))
+    monkeypatch.setattr(BaseConfig, 'SHARDS', paths)
+    sharding.upgrade_databases()
+    clear_caches()
+    return paths
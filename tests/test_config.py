@@ -0,0 +1,31 @@
+import multiprocessing
+import os
+import pytest
+import config
+
+
+def test_processes_starting_together_read_the_same_key(tmp_path):
+    path = str(tmp_path / 'keys' / 'secret_key')
+    with multiprocessing.get_context('fork').Pool(8) as pool:
+        keys = pool.map(config.read_secret_key, [path] * 32)
+    assert len(set(keys)) == 1
+    assert len(keys[0]) == 64
+    assert os.listdir(str(tmp_path / 'keys')) == ['secret_key']
+
+
+def test_empty_key_is_never_used(tmp_path):
+    path = tmp_path / 'secret_key'
+    path.write_text('')
+    with pytest.raises(OSError):
+        config.read_secret_key(str(path), attempts=2)
+    assert os.listdir(str(tmp_path)) == ['secret_key']
+
+
+def test_configure_reads_environment(tmp_path):
+    class Config(config.BaseConfig):
+        pass
+    config.configure(Config, {'TODO_AUTO_MIGRATE': '0', 'TODO_SHARDS': '["a.db", "b.db"]',
+                              'TODO_SECRET_KEY_FILE': str(tmp_path / 'secret_key'), 'TODO_SECRET_KEY': ''})
+    assert Config.AUTO_MIGRATE is False
+    assert Config.SHARDS == ('a.db', 'b.db')
+    assert Config.SECRET_KEY == (tmp_path / 'secret_key').read_text()
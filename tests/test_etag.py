@@ -0,0 +1,92 @@
+from common import commit_db, release_db
+from dbhandle import DB
+from models.todo import Todo
+from models.users import User
+from conftest import ADMIN_ID, USER_ID
+
+
+def first_todo(query):
+    return query("SELECT MIN(`id`) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, ))[0][0]
+
+
+def revalidate(client, url, response):
+    return client().get(url, headers={'If-None-Match': response.headers['ETag']})
+
+
+def test_unchanged_pages_are_not_modified(app, client, query):
+    for url in ('/', '/todo/{}'.format(first_todo(query)), '/users/{}'.format(ADMIN_ID)):
+        response = client().get(url)
+        assert response.status_code == 200
+        assert response.headers['ETag'].startswith('W/')
+        not_modified = revalidate(client, url, response)
+        assert not_modified.status_code == 304
+        assert not_modified.data == b''
+        assert not_modified.headers['ETag'] == response.headers['ETag']
+
+
+def test_todo_change_makes_pages_stale(app, client, query):
+    todo_id = first_todo(query)
+    pages = dict((url, client().get(url)) for url in ('/', '/todo/{}'.format(todo_id), '/users/{}'.format(ADMIN_ID)))
+    assert client().get('/todo/{}/toggle'.format(todo_id)).status_code == 302
+    for url, response in pages.items():
+        changed = revalidate(client, url, response)
+        assert changed.status_code == 200, url
+        assert changed.headers['ETag'] != response.headers['ETag']
+
+
+def test_user_change_makes_user_page_stale(app, client):
+    url = '/users/{}'.format(ADMIN_ID)
+    response = client().get(url)
+    with app.test_request_context():
+        user = User.get_by_id(ADMIN_ID)
+        user.email = 'changed@example.com'
+        user.save()
+        commit_db()
+        release_db()
+    assert revalidate(client, url, response).status_code == 200
+
+
+def test_page_depends_on_viewer_and_sort(app, client):
+    response = client().get('/')
+    other_sort = client()
+    with other_sort.session_transaction() as session:
+        session['sort_type'] = 'priority'
+    assert other_sort.get('/', headers={'If-None-Match': response.headers['ETag']}).status_code == 200
+    assert revalidate(lambda: client(ADMIN_ID, is_admin=False), '/', response).status_code == 200
+
+
+def test_pages_of_other_users_stay_valid(app, client):
+    url = '/users/{}'.format(ADMIN_ID)
+    response = client().get(url)
+    with app.test_request_context():
+        Todo('todo of other user', priority=1, owner_id=USER_ID).save()
+        commit_db()
+        release_db()
+    assert revalidate(client, url, response).status_code == 304
+
+
+def test_own_todo_page_is_revalidated_without_reading_todo(app, client, query):
+    url = '/todo/{}'.format(first_todo(query))
+    response = client().get(url)
+    queries = []
+    DB.add_query_hook(lambda sql, args, duration: queries.append(sql))
+    try:
+        assert revalidate(client, url, response).status_code == 304
+    finally:
+        DB.query_hooks.pop()
+    assert queries and not [sql for sql in queries if 'todo_items' in sql]
+
+
+def test_todo_page_of_other_user_is_revalidated(app, client, query):
+    with app.test_request_context():
+        todo = Todo('todo of other user', priority=1, owner_id=USER_ID)
+        todo.save()
+        commit_db()
+        release_db()
+    url = '/todo/{}'.format(todo.id)
+    response = client().get(url)
+    assert revalidate(client, url, response).status_code == 304
+    # page of admin is not valid for its owner
+    assert revalidate(lambda: client(USER_ID, is_admin=False), url, response).status_code == 200
+    query("UPDATE `todo_items` SET `name` = 'renamed' WHERE `id` = ?;", (todo.id, ))
+    assert revalidate(client, url, response).status_code == 200
@@ -0,0 +1,90 @@
+from common import commit_db, release_db
+from models.daily_stats import DailyTodoStats
+from models.history import history_writer
+from models.todo import Todo
+from conftest import ADMIN_ID
+
+
+def history_count(query, todo_id):
+    return query("SELECT COUNT(*) FROM `todo_history` WHERE `item_id` = ?;", (todo_id, ))[0][0]
+
+
+def first_todo(query):
+    return query("SELECT MIN(`id`) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, ))[0][0]
+
+
+def test_synchronous_mode_writes_history_with_change(app, query):
+    assert history_writer.synchronous
+    todo_id = first_todo(query)
+    before = history_count(query, todo_id)
+    with app.test_request_context():
+        todo = Todo.get_by_id(todo_id)
+        todo.toggle()
+        commit_db()
+        release_db()
+    assert history_count(query, todo_id) == before + 1
+    assert history_writer.stats()['waiting'] == 0
+
+
+def test_synchronous_mode_rolls_back_history_with_change(app, query):
+    todo_id = first_todo(query)
+    before = history_count(query, todo_id)
+    with app.test_request_context():
+        todo = Todo.get_by_id(todo_id)
+        todo.toggle()
+        release_db(RuntimeError('view failed'))
+    assert history_count(query, todo_id) == before
+
+
+def test_synchronous_mode_writes_history_of_many_todos(app, query):
+    ids = [row[0] for row in query("SELECT `id` FROM `todo_items` WHERE `owner_id` = ? AND `is_archived` = 0;",
+                                   (ADMIN_ID, ))]
+    before = dict((todo_id, history_count(query, todo_id)) for todo_id in ids)
+    with app.test_request_context():
+        assert Todo.toggle_many(ADMIN_ID, ids) == len(ids)
+        commit_db()
+        release_db()
+    assert dict((todo_id, history_count(query, todo_id)) for todo_id in ids) == \
+        dict((todo_id, count + 1) for todo_id, count in before.items())
+
+
+def test_write_behind_mode_queues_events_of_committed_requests_only(app, query, monkeypatch):
+    monkeypatch.setattr(history_writer, 'synchronous', False)
+    # written by test, not by background thread
+    monkeypatch.setattr(history_writer, 'enqueue', lambda events: history_writer._events.extend(events))
+    todo_id = first_todo(query)
+    before = history_count(query, todo_id)
+    with app.test_request_context():
+        Todo.get_by_id(todo_id).toggle()
+        release_db(RuntimeError('view failed'))
+    assert history_writer.stats()['waiting'] == 0
+    with app.test_request_context():
+        Todo.get_by_id(todo_id).toggle()
+        assert history_writer.stats()['waiting'] == 0
+        commit_db()
+        release_db()
+    assert history_writer.stats()['waiting'] == 1
+    assert history_count(query, todo_id) == before
+    assert history_writer.flush() == 1
+    assert history_count(query, todo_id) == before + 1
+
+
+def test_synchronous_mode_rolls_up_daily_stats_once_after_commit(app, query, monkeypatch):
+    todo_id = first_todo(query)
+    with app.app_context():
+        DailyTodoStats.rollup_all()
+    calls = []
+    monkeypatch.setattr(history_writer, 'flush_callbacks', history_writer.flush_callbacks + [lambda: calls.append(1)])
+    completed = "SELECT TOTAL(`completed`) FROM `daily_todo_stats` WHERE `user_id` = ?;"
+    before = query(completed, (ADMIN_ID, ))[0][0]
+    with app.test_request_context():
+        todo = Todo.get_by_id(todo_id)
+        # one of the toggles marks todo done
+        todo.toggle()
+        todo.toggle()
+        assert not calls
+        commit_db()
+        release_db()
+    assert calls == [1]
+    assert query(completed, (ADMIN_ID, ))[0][0] == before + 1
+    assert query("SELECT `last_id` FROM `stats_rollup_state`;") == query("SELECT MAX(`id`) FROM `todo_history`;")
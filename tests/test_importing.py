@@ -0,0 +1,51 @@
+import io
+import pytest
+import importing
+from common import after_commit, get_db, release_db
+from dbhandle import DB
+from models.todo import Todo
+from conftest import USER_ID
+
+
+CSV = 'name,priority,due_date,description,status\nfirst,1,,,0\nsecond,2,2030-01-01,text,1\nthird,x,,,0\n'
+
+
+def todo_names(query):
+    return [row[0] for row in query("SELECT `name` FROM `todo_items` WHERE `owner_id` = ? ORDER BY `id`;",
+                                    (USER_ID, ))]
+
+
+def test_chunks_are_committed_apart_from_request(app, query):
+    callbacks = []
+    with app.test_request_context():
+        db = get_db()
+        after_commit(lambda: callbacks.append('request'))
+        report = importing.import_todos(io.BytesIO(CSV.encode('utf-8')), 'csv', USER_ID, chunk_size=1)
+        assert report['imported'] == 2 and report['failed'] == 1
+        assert todo_names(query) == ['first', 'second']
+        # unit and callbacks of the request are left for its end
+        assert get_db() is db and DB.in_unit(db)
+        assert callbacks == []
+        release_db(RuntimeError('request failed'))
+    assert todo_names(query) == ['first', 'second']
+
+
+def test_failed_chunk_is_rolled_back(app, query, monkeypatch):
+    def failing_insert(todos, owner_id):
+        insert_many(todos, owner_id)
+        raise RuntimeError('failed after insert')
+    insert_many = Todo.insert_many
+    monkeypatch.setattr(Todo, 'insert_many', failing_insert)
+    with app.test_request_context():
+        with pytest.raises(RuntimeError):
+            importing.import_todos(io.BytesIO(CSV.encode('utf-8')), 'csv', USER_ID, chunk_size=10)
+        release_db()
+    assert todo_names(query) == []
+
+
+def test_import_request(app, client, query):
+    response = client(USER_ID, is_admin=False).post('/api/v1/todos/import?format=csv', data=CSV)
+    assert response.status_code == 200
+    report = response.get_json()
+    assert (report['imported'], report['failed'], report['errors'][0]['row']) == (2, 1, 3)
+    assert todo_names(query) == ['first', 'second']
@@ -0,0 +1,45 @@
+import socket
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import serve
+
+
+def test_pooled_server_handles_at_most_threads_requests_at_once():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def app(environ, start_response):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.1)
+        with lock:
+            running[0] -= 1
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    server = serve.PooledWSGIServer('127.0.0.1', listener.getsockname()[1], app, 2, fd=listener.fileno())
+    server.timeout = 0.1
+    stopping = []
+
+    def serve_requests():
+        while not stopping:
+            server.handle_request()
+        server.server_close()
+    thread = threading.Thread(target=serve_requests)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}/'.format(listener.getsockname()[1])
+        with ThreadPoolExecutor(6) as executor:
+            bodies = list(executor.map(lambda _: urllib.request.urlopen(url, timeout=10).read(), range(6)))
+    finally:
+        stopping.append(True)
+        thread.join(10)
+        listener.close()
+    assert bodies == [b'done'] * 6
+    assert running == [0, 2]
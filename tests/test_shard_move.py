@@ -0,0 +1,176 @@
+import json
+import pytest
+import models.shard_move
+from common import commit_db, release_db
+from models.daily_stats import DailyTodoStats
+from models.shard_move import ShardMove
+from models.users import User
+from sharding import shard_map, first_id, MAIN_DATABASE
+from conftest import ADMIN_ID
+
+
+def move(app, user_id, target, **options):
+    with app.app_context():
+        return ShardMove(batch_size=4, grace=0, pause=0, **options).move(user_id, target)
+
+
+def export(client, kind, after=0):
+    response = client().get('/api/v1/export/{}?format=ndjson&after={}'.format(kind, after))
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def without_ids(rows, *fields):
+    return [dict((key, value) for key, value in row.items() if key not in fields) for row in rows]
+
+
+def user_rows(query, database, sql):
+    return query(sql, (ADMIN_ID, ), database=database)
+
+
+DAILY_QUERY = "SELECT * FROM `daily_todo_stats` WHERE `user_id` = ? ORDER BY `day`;"
+STATS_QUERY = "SELECT * FROM `user_todo_stats` WHERE `user_id` = ?;"
+
+
+@pytest.fixture
+def rolled_up(app, shards):
+    with app.app_context():
+        DailyTodoStats.rollup_all()
+    return shards
+
+
+def test_move_keeps_data_statistics_and_old_ids(app, rolled_up, client, query):
+    todos, history = export(client, 'todos'), export(client, 'history')
+    daily, stats = user_rows(query, None, DAILY_QUERY), user_rows(query, None, STATS_QUERY)
+    assert todos and history and daily
+    page = client().get('/')
+
+    result = move(app, ADMIN_ID, 1)
+    assert (result['todos'], result['history']) == (len(todos), len(history))
+
+    moved_todos, moved_history = export(client, 'todos'), export(client, 'history')
+    assert without_ids(moved_todos, 'id') == without_ids(todos, 'id')
+    assert all(todo['id'] >= first_id(1) for todo in moved_todos)
+    new_ids = dict((todo['id'], moved['id']) for todo, moved in zip(todos, moved_todos))
+    assert [event['item_id'] for event in moved_history] == [new_ids.get(event['item_id'], event['item_id'])
+                                                             for event in history]
+    assert without_ids(moved_history, 'id', 'item_id') == without_ids(history, 'id', 'item_id')
+    assert user_rows(query, rolled_up[1], DAILY_QUERY) == daily
+    assert user_rows(query, rolled_up[1], STATS_QUERY) == stats
+    assert user_rows(query, None, "SELECT COUNT(*) FROM `todo_items` WHERE `owner_id` = ?;") == [(0, )]
+
+    # pages built from the old shard are stale
+    revalidated = client().get('/', headers={'If-None-Match': page.headers['ETag']})
+    assert revalidated.status_code == 200
+    assert revalidated.headers['ETag'] != page.headers['ETag']
+
+    # old ids keep working
+    old_id, new_id = todos[0]['id'], moved_todos[0]['id']
+    response = client().get('/api/v1/todos/{}'.format(old_id))
+    assert response.status_code == 200 and response.get_json()['id'] == new_id
+    assert client().get('/todo/{}'.format(old_id)).status_code == 200
+    assert export(client, 'todos', after=todos[2]['id']) == moved_todos[3:]
+    assert export(client, 'history', after=history[4]['id']) == moved_history[5:]
+    response = client().post('/api/v1/todos/batch', json={'operations': [
+        {'op': 'update', 'id': old_id, 'data': {'name': 'renamed by old id'}}]})
+    assert response.get_json() == {'results': [{'op': 'update', 'id': new_id}]}
+
+
+def test_ids_from_every_earlier_shard_resolve(app, rolled_up, client):
+    todos = export(client, 'todos')
+    move(app, ADMIN_ID, 1)
+    in_shard1 = export(client, 'todos')
+    move(app, ADMIN_ID, 0)
+    in_shard0 = export(client, 'todos')
+    assert without_ids(in_shard0, 'id') == without_ids(todos, 'id')
+    for ids in (todos, in_shard1):
+        response = client().get('/api/v1/todos/{}'.format(ids[1]['id']))
+        assert response.get_json()['id'] == in_shard0[1]['id']
+        assert export(client, 'todos', after=ids[1]['id']) == in_shard0[2:]
+    # moved back to the main database: the oldest ids are in the current range, but not current
+    move(app, ADMIN_ID, MAIN_DATABASE)
+    in_main = export(client, 'todos')
+    assert in_main[0]['id'] > todos[-1]['id']
+    assert export(client, 'todos', after=todos[1]['id']) == in_main[2:]
+    assert client().get('/api/v1/todos/{}'.format(todos[1]['id'])).get_json()['id'] == in_main[1]['id']
+
+
+def test_bulk_action_with_old_ids(app, rolled_up, client, query):
+    todos = export(client, 'todos')
+    active = [todo for todo in todos if not todo['is_archived']][:2]
+    move(app, ADMIN_ID, 1)
+    response = client().post('/todo/bulk', data={'action': 'toggle', 'ids': [todo['id'] for todo in active]})
+    assert response.status_code == 302
+    statuses = dict((todo['name'], todo['status']) for todo in export(client, 'todos'))
+    assert [statuses[todo['name']] for todo in active] == [1 - todo['status'] for todo in active]
+
+
+def test_writes_during_move_are_answered_with_503(app, rolled_up, client, monkeypatch):
+    todo_id = export(client, 'todos')[0]['id']
+    responses = {}
+    sleep = models.shard_move.time.sleep
+
+    def requests_in_grace_period(seconds):
+        if not responses:
+            # placements cached before the move expire during grace period
+            shard_map._placements.clear()
+            responses['toggle'] = client().get('/todo/{}/toggle'.format(todo_id))
+            responses['batch'] = client().post('/api/v1/todos/batch', json={'operations': [
+                {'op': 'update', 'id': todo_id, 'data': {'name': 'changed while moving'}}]})
+            responses['read'] = client().get('/api/v1/todos/{}'.format(todo_id))
+        sleep(seconds)
+    monkeypatch.setattr(models.shard_move.time, 'sleep', requests_in_grace_period)
+    move(app, ADMIN_ID, 1)
+    assert responses['toggle'].status_code == 503
+    assert responses['batch'].status_code == 503
+    assert responses['batch'].headers['Retry-After'] == str(int(app.config['SHARD_MOVE_GRACE']) or 1)
+    assert responses['read'].status_code == 200
+    assert 'changed while moving' not in [todo['name'] for todo in export(client, 'todos')]
+
+
+def test_aborted_move_keeps_old_ids(app, rolled_up, client, query, monkeypatch):
+    todos = export(client, 'todos')
+
+    def interrupted(*args):
+        raise RuntimeError('move interrupted')
+    monkeypatch.setattr(ShardMove, 'copy_user_rows', interrupted)
+    with pytest.raises(RuntimeError):
+        move(app, ADMIN_ID, 1)
+    assert query("SELECT COUNT(*) FROM `moved_ids` WHERE `owner_id` = ?;", (ADMIN_ID, ))[0][0] > 0
+    with app.app_context():
+        ShardMove(grace=0, pause=0).abort(ADMIN_ID)
+    assert query("SELECT COUNT(*) FROM `moved_ids` WHERE `owner_id` = ?;", (ADMIN_ID, )) == [(0, )]
+    assert query("SELECT COUNT(*) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, ),
+                 database=rolled_up[1]) == [(0, )]
+    assert export(client, 'todos') == todos
+    assert client().get('/api/v1/todos/{}'.format(todos[0]['id'])).get_json()['id'] == todos[0]['id']
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_ids_of_unknown_shards_are_not_found(app, client, request, sharded):
+    if sharded:
+        request.getfixturevalue('shards')
+    unknown = 50000000000000
+    assert client().get('/api/v1/todos/{}'.format(unknown)).status_code == 404
+    assert client().get('/todo/{}'.format(unknown)).status_code == 302
+    assert client().get('/todo/{}/toggle'.format(unknown)).status_code == 302
+
+
+def test_removed_user_leaves_no_moved_ids(app, rolled_up, query):
+    move(app, ADMIN_ID, 1)
+    with app.test_request_context():
+        User.get_by_id(ADMIN_ID).delete()
+        commit_db()
+        release_db()
+    assert query("SELECT COUNT(*) FROM `moved_ids` WHERE `owner_id` = ?;", (ADMIN_ID, )) == [(0, )]
+
+
+@pytest.mark.parametrize('sharded', [False, True])
+def test_ids_which_are_not_numbers_are_not_found(app, client, request, sharded):
+    if sharded:
+        request.getfixturevalue('shards')
+    assert client().get('/todo/abc/activate').status_code == 404
+    response = client().post('/api/v1/todos/batch', json={'operations': [
+        {'op': 'update', 'id': 'abc', 'data': {'name': 'renamed'}}]})
+    assert response.status_code == 404
+    assert response.get_json() == {'error': 'No such todo item', 'id': 'abc', 'operation': 0}
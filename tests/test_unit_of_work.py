@@ -0,0 +1,90 @@
+import pytest
+from common import after_commit, commit_db, get_db, release_db, transaction
+from models.todo import Todo
+from conftest import ADMIN_ID
+
+
+def first_todo_id(query):
+    return query("SELECT MIN(`id`) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, ))[0][0]
+
+
+def stored_name(query, todo_id):
+    return query("SELECT `name` FROM `todo_items` WHERE `id` = ?;", (todo_id, ))[0][0]
+
+
+def test_writes_of_request_are_committed_together_at_the_end(app, query):
+    todo_id = first_todo_id(query)
+    name = stored_name(query, todo_id)
+    with app.test_request_context():
+        todo = Todo.get_by_id(todo_id)
+        todo.name = 'renamed in unit of work'
+        todo.save()
+        assert get_db().in_transaction
+        # other connections don't see the write before the unit commits
+        assert stored_name(query, todo_id) == name
+        commit_db()
+        assert not get_db().in_transaction
+        release_db()
+    assert stored_name(query, todo_id) == 'renamed in unit of work'
+
+
+def test_request_ending_without_commit_is_rolled_back(app, query):
+    todo_id = first_todo_id(query)
+    name = stored_name(query, todo_id)
+    history = query("SELECT COUNT(*) FROM `todo_history`;")[0][0]
+    callbacks = []
+    with app.test_request_context():
+        todo = Todo.get_by_id(todo_id)
+        todo.name = 'never committed'
+        todo.save()
+        after_commit(lambda: callbacks.append('run'))
+        release_db(RuntimeError('view failed'))
+    assert stored_name(query, todo_id) == name
+    assert query("SELECT COUNT(*) FROM `todo_history`;")[0][0] == history
+    assert callbacks == []
+
+
+def test_failed_block_rolls_back_to_savepoint_only(app, query):
+    first_id, second_id = [row[0] for row in query(
+        "SELECT `id` FROM `todo_items` WHERE `owner_id` = ? ORDER BY `id` LIMIT 2;", (ADMIN_ID, ))]
+    callbacks = []
+    with app.test_request_context():
+        first, second = Todo.get_by_id(first_id), Todo.get_by_id(second_id)
+        first.name = 'kept'
+        first.save()
+        with pytest.raises(ValueError):
+            with transaction(ADMIN_ID):
+                second.name = 'rolled back'
+                second.save()
+                after_commit(lambda: callbacks.append('rolled back'))
+                raise ValueError()
+        after_commit(lambda: callbacks.append('kept'))
+        commit_db()
+        release_db()
+    assert stored_name(query, first_id) == 'kept'
+    assert stored_name(query, second_id) != 'rolled back'
+    assert callbacks == ['kept']
+
+
+def test_toggle_request_saves_todo_with_history(app, client, query):
+    todo_id = first_todo_id(query)
+    status = query("SELECT `status` FROM `todo_items` WHERE `id` = ?;", (todo_id, ))[0][0]
+    history = query("SELECT COUNT(*) FROM `todo_history` WHERE `item_id` = ?;", (todo_id, ))[0][0]
+    response = client().get('/todo/{}/toggle'.format(todo_id))
+    assert response.status_code == 302
+    assert query("SELECT `status` FROM `todo_items` WHERE `id` = ?;", (todo_id, ))[0][0] == 1 - status
+    assert query("SELECT COUNT(*) FROM `todo_history` WHERE `item_id` = ?;", (todo_id, ))[0][0] == history + 1
+
+
+def test_view_error_leaves_no_writes(app, client, query, monkeypatch):
+    todo_id = first_todo_id(query)
+    status = query("SELECT `status` FROM `todo_items` WHERE `id` = ?;", (todo_id, ))[0][0]
+
+    def failing_toggle(todo):
+        todo.status = 1 - todo.status
+        todo.save()
+        raise RuntimeError('failed after write')
+    monkeypatch.setattr(Todo, 'toggle', failing_toggle)
+    with pytest.raises(RuntimeError):
+        client().get('/todo/{}/toggle'.format(todo_id))
+    assert query("SELECT `status` FROM `todo_items` WHERE `id` = ?;", (todo_id, ))[0][0] == status
@@ -0,0 +1,26 @@
+import main
+from models.user_deletion import deletion_worker
+from conftest import ADMIN_ID
+
+
+def test_deletion_left_by_previous_run_is_resumed_on_start(app, query):
+    # state after crash: user removed, worker thread never deleted their data
+    query("DELETE FROM `users` WHERE `id` = ?;", (ADMIN_ID, ))
+    query("INSERT INTO `user_deletions` (`user_id`, `requested_date`) VALUES (?, '2026-10-18 10:00');", (ADMIN_ID, ))
+    assert query("SELECT COUNT(*) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, ))[0][0]
+
+    main.resume_user_deletions()
+    thread = deletion_worker._thread
+    # None when the worker has finished already
+    if thread is not None:
+        thread.join(10)
+    assert query("SELECT COUNT(*) FROM `todo_items` WHERE `owner_id` = ?;", (ADMIN_ID, )) == [(0, )]
+    assert query("SELECT COUNT(*) FROM `todo_history` WHERE `owner_id` = ?;", (ADMIN_ID, )) == [(0, )]
+    assert query("SELECT COUNT(*) FROM `user_deletions`;") == [(0, )]
+
+
+def test_nothing_is_started_without_pending_deletions(app, monkeypatch):
+    woken = []
+    monkeypatch.setattr(deletion_worker, 'wake', lambda: woken.append(1))
+    main.resume_user_deletions()
+    assert woken == []
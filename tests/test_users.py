@@ -0,0 +1,54 @@
+import pytest
+from common import release_db
+from dbhandle import DB
+from models.users import User, user_cache
+from conftest import ADMIN_ID
+
+
+def get_user(app, lookup, value):
+    with app.test_request_context():
+        try:
+            return getattr(User, lookup)(value)
+        finally:
+            release_db()
+
+
+@pytest.mark.parametrize('change', [
+    "UPDATE `users` SET `password` = 'changed' WHERE `id` = ?;",
+    "DELETE FROM `users_permissions` WHERE `user_id` = ?;",
+    "DELETE FROM `users` WHERE `id` = ?;",
+])
+def test_cached_user_changed_by_another_process_is_read_again(app, query, change):
+    user = get_user(app, 'get_by_id', ADMIN_ID)
+    assert user.is_admin and len(user_cache)
+    query(change, (ADMIN_ID, ))
+    fresh = query("SELECT `password`, EXISTS(SELECT 1 FROM `users_permissions` "
+                  "WHERE `users_permissions`.`user_id` = `users`.`id`) FROM `users` WHERE `id` = ?;", (ADMIN_ID, ))
+    for lookup, value in (('get_by_id', ADMIN_ID), ('get_by_name', user.name), ('get_by_login', user.name)):
+        cached = get_user(app, lookup, value)
+        if fresh:
+            assert [(cached.password, cached.is_admin)] == fresh
+        else:
+            assert cached is None
+
+
+def test_unchanged_cached_user_is_not_read_again(app):
+    user = get_user(app, 'get_by_id', ADMIN_ID)
+    with app.test_request_context():
+        User.get_by_id(ADMIN_ID)
+        queries = []
+        DB.add_query_hook(lambda query, args, duration: queries.append(query))
+        try:
+            assert User.get_by_name(user.name).id == ADMIN_ID
+        finally:
+            DB.query_hooks.pop()
+        release_db()
+    assert queries == [User.VERSION_QUERY]
+
+
+def test_login_prefers_name_over_cached_email(app, query):
+    query("INSERT INTO `users` (`name`, `password`, `email`) VALUES ('bob', 'first', 'bob@example.com');")
+    query("INSERT INTO `users` (`name`, `password`, `email`) VALUES ('bob@example.com', 'second', 'other');")
+    assert get_user(app, 'get_by_email', 'bob@example.com').name == 'bob'
+    assert get_user(app, 'get_by_login', 'bob@example.com').password == 'second'
+    assert get_user(app, 'get_by_login', 'bob').password == 'first'
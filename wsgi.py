@@ -0,0 +1,19 @@
+""" WSGI entry point: application configured from file named by TODO_CONFIG and TODO_* environment variables.
+
+    TODO_CONFIG=/etc/todo/config.py python serve.py --bind 0.0.0.0:8000
+"""
+import config
+
+
+def load_app():
+    """ Returns configured application. Config is read before application modules are imported
+    (they read it at import time), so worker started by reload uses current config file.
+    Application is built once per process by importing main, later calls return the same one.
+    """
+    config.configure()
+    import main
+    main.resume_user_deletions()
+    return main.app
+
+
+app = load_app()